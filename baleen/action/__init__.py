@@ -1,15 +1,19 @@
+import os
 import sys
-import yaml
-import gearman
+import signal
+import threading
+import subprocess
 import json
 import logging
 import traceback
 
 from django.conf import settings
-from StringIO import StringIO
 from contextlib import closing
 
 from baleen.utils import statsd_label_converter
+from baleen.artifact.models import output_types
+from baleen.action.stream import OutputRecorder, stream_process
+from baleen.job.queue import get_queue
 from baleen.project.models import Project, Hook
 
 
@@ -32,6 +36,15 @@ class Action(object):
         self.name = name
         self.index = index
         self.outputs = {}
+        self.processes = []
+        # Open API connections with a close(), like docker_api.DockerStream
+        self.connections = []
+        self.recorders = None
+        self.cancelled = False
+        # Seconds the action can run for before the watchdog stops it
+        self.timeout = kwarg.get('timeout') or settings.ACTION_TIMEOUT
+        self.timed_out = False
+        self.timeout_message = None
 
     def __unicode__(self):
         return "Action: %s" % self.name
@@ -45,18 +58,21 @@ class Action(object):
             'name': self.name,
             'status': status
         }
-        gearman_client = gearman.GearmanClient([settings.GEARMAN_SERVER])
-        gearman_client.submit_job(settings.GEARMAN_JOB_LABEL, json.dumps({'event': event}), background=True)
+        get_queue().submit_event(event)
     
     @property
     def statsd_name(self):
         return statsd_label_converter(self.name)
 
-    def run(self, job):
+    def run(self, job, action_result=None):
+        """
+        Run the action for job. If the ActionResult for the action has
+        already been recorded, it can be passed in as action_result.
+        """
         self.job = job
         log.info("Job %s - doing action: '%s - %s'" % (unicode(job.id), self.project.name, self.name))
 
-        out_f, err_f = job.get_live_job_filenames()
+        out_f, err_f = job.get_live_job_filenames(self)
 
         with closing(open(out_f, 'w')) as stdoutlog, closing(open(err_f, 'w')) as stderrlog: 
             stdoutlog.write("Project=%s Action=%s\n" % (self.project.name, self.name))
@@ -66,21 +82,35 @@ class Action(object):
                 # Record that an action is about to be run before executing it.
                 # This makes it easier to show actions in progress on the job details/status
                 # screens.
-                action_result = job.record_action_start(self)
-
-                response = self.execute(stdoutlog, stderrlog, action_result)
+                if action_result is None:
+                    action_result = job.record_action_start(self)
+                self.action_result = action_result
+                self.stdoutlog = stdoutlog
+                self.stderrlog = stderrlog
+
+                watchdog = self.start_watchdog()
+                try:
+                    response = self.execute(stdoutlog, stderrlog, action_result)
+                finally:
+                    if watchdog:
+                        watchdog.cancel()
+                    if self.recorders:
+                        for r in self.recorders:
+                            r.close()
             except Exception as e:
                 # Any exception that leaks from running the action has stuff recorded
                 # and is then raised to the caller
                 tb_str = traceback.format_exc(sys.exc_info()[2])
                 log.error("Got an exception %s: %s" % (str(e), tb_str))
-                job.record_action_response(self, {
+                job.record_action_response(self, self.timeout_response({
                     'success': False,
                     'message': str(e),
                     'detail': tb_str 
-                })
+                }))
                 raise ActionFailure(e)
 
+        response = self.timeout_response(response)
+
         log.info("Job %s - completed action: '%s - %s' with code %s" % (
             unicode(job.id), self.project.name, self.name, str(response.get('code', 'missing'))
             ))
@@ -89,6 +119,103 @@ class Action(object):
 
         return response
 
+    def popen(self, args, **kwargs):
+        """
+        Start a subprocess for this action in its own process group, so that
+        cancel can kill it along with anything it has started.
+        """
+        kwargs.setdefault('preexec_fn', os.setsid)
+        p = subprocess.Popen(args, **kwargs)
+        self.processes.append(p)
+        return p
+
+    def output_recorders(self):
+        """
+        OutputRecorders for this action's stdout and stderr, closed once the
+        action has run.
+        """
+        if self.recorders is None:
+            self.recorders = (
+                OutputRecorder(getattr(self, 'action_result', None), output_types.STDOUT,
+                    getattr(self, 'stdoutlog', None)),
+                OutputRecorder(getattr(self, 'action_result', None), output_types.STDERR,
+                    getattr(self, 'stderrlog', None)),
+                )
+        return self.recorders
+
+    def run_command(self, args, cwd=None, env=None):
+        """
+        Run a command for this action, streaming its output to the live log
+        files and the action's stdout/stderr outputs as it runs.
+
+        Returns a response with the exit code and the tail of the output,
+        which record_action_response knows not to store over the streamed
+        output.
+        """
+        stdout_recorder, stderr_recorder = self.output_recorders()
+        process = self.popen(args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=cwd,
+                env=env
+                )
+        status = stream_process(process, stdout_recorder, stderr_recorder)
+        return {
+            'stdout': stdout_recorder.tail,
+            'stderr': stderr_recorder.tail,
+            'code': status,
+            'streamed': True,
+        }
+
+    def cancel(self):
+        """
+        Stop the action from another thread. Kills the process groups of any
+        subprocesses still running and closes its connections, execute will
+        then see them fail.
+        """
+        self.cancelled = True
+        for p in self.processes:
+            if p.poll() is None:
+                try:
+                    os.killpg(p.pid, signal.SIGTERM)
+                except OSError:
+                    # Already exited
+                    pass
+        for c in self.connections:
+            c.close()
+
+    def start_watchdog(self):
+        """ Start a timer that stops the action if it runs for too long """
+        if not self.timeout:
+            return None
+        watchdog = threading.Timer(self.timeout, self.time_out)
+        watchdog.daemon = True
+        watchdog.start()
+        return watchdog
+
+    def time_out(self, message=None):
+        """
+        Stop the action for running too long. message says what ran out of
+        time, by default the action itself.
+        """
+        if message is None:
+            message = 'Timed out after %s seconds.' % self.timeout
+        log.warning("Action '%s' stopped: %s" % (self.name, message))
+        self.timeout_message = message
+        self.timed_out = True
+        self.cancel()
+
+    def timeout_response(self, response):
+        """ Mark the response of an action that was stopped by time_out """
+        if self.timed_out and response.get('code') != 0:
+            response = dict(response)
+            response['timed_out'] = True
+            if response.get('code') is None:
+                response['code'] = -1
+            response['message'] = (self.timeout_message + ' '
+                    + response.get('message', ''))
+        return response
+
     def execute(self, stdoutlog, stderrlog, action_result):
         """ Execute this Action
 
@@ -154,10 +281,18 @@ class ActionPlan(object):
     def __iter__(self):
         return self
 
-    def append_step(self, details):
+    def append_step(self, details, depends_on=None):
+        """
+        Add a step to the plan, returning its index. depends_on is a list of
+        the indexes of steps that have to succeed before this one can run,
+        by default just the step before it.
+        """
         d_copy = dict(details)
         d_copy['index'] = len(self.plan)
+        if depends_on is not None:
+            d_copy['depends_on'] = list(depends_on)
         self.plan.append(d_copy)
+        return d_copy['index']
 
     def next(self):
         self.current_index += 1
@@ -170,7 +305,7 @@ class ActionPlan(object):
 class DockerActionPlan(ActionPlan):
 
     def formulate_plan(self):
-        build_data = yaml.safe_load(StringIO(self.build_definition))
+        build_data = self.job.get_build_data()
         current_project = self.project
 
         log.debug("Build data for %s is: %s" % (self.project, build_data))
@@ -189,8 +324,8 @@ class DockerActionPlan(ActionPlan):
                 return []
 
             # set up a trigger for when dependent_project has built
-            h = Hook(project=dependent_project, trigger_build=current_project)
-            h.save()
+            Hook.objects.get_or_create(project=dependent_project,
+                    trigger_build=current_project, defaults={'one_off': True})
 
             # TODO: Need to remove all temporary hooks for a given project when that
             # project is synced with github (since dependencies may change).
@@ -209,15 +344,24 @@ class DockerActionPlan(ActionPlan):
         #)
         #index+=1
 
+        # Images are built in parallel, tests run once they are all built,
+        # then artifacts are fetched and finally the images are tagged.
+        builds = []
         for image_name, context in containers_to_build_and_test.iteritems():
-            self.append_step({
+            # Either just the build context, or a dict with context and timeout
+            timeout = None
+            if isinstance(context, dict):
+                timeout = context.get('timeout')
+                context = context.get('context')
+            builds.append(self.append_step({
                'group': 'docker',
                'action': 'build_image',
                'name': 'Build docker image %s' % image_name,
                'image': image_name,
                'context': context,
-               'project': self.project.name
-            })
+               'project': self.project.name,
+               'timeout': timeout,
+            }, depends_on=[]))
 
         # in the case of any missing projects, the plan returned is one to
         # create/fetch/build one of the dependencies first.
@@ -226,15 +370,19 @@ class DockerActionPlan(ActionPlan):
         # try and deal to the dependencies first, while creating a post-success
         # hook waiting for them all.
 
+        tests = []
         if build_data.get('test'):
-            self.append_step({
+            compose_data = dict(build_data.get('test'))
+            tests.append(self.append_step({
                        'group': 'docker',
                        'action': 'test_with_compose',
                        'name': 'Test with docker-compose',
-                       'compose_data': build_data.get('test'), #'compose_test.yml',
+                       'timeout': compose_data.pop('timeout', None),
+                       'compose_data': compose_data, #'compose_test.yml',
                        'project': self.project.name,
-                    })
+                    }, depends_on=builds))
 
+        artifacts = []
         for artifact_type, location in build_data.get('artifacts', {}).items():
             if not build_data.get('test'):
                 # TODO support doing a null run of a container and extracting
@@ -250,21 +398,22 @@ class DockerActionPlan(ActionPlan):
                 paths.append(p)
 
             for p in paths: 
-                self.append_step({
+                artifacts.append(self.append_step({
                            'group': 'docker',
                            'action': 'get_build_artifact',
                            'project':  self.project.name,
                            'name': 'Get %s build artifact: %s' % (artifact_type, p),
                            'artifact_type': artifact_type,
-                           'artifact_path': p 
-                        })
+                           'artifact_path': p,
+                           'timeout': location.get('timeout'),
+                        }, depends_on=tests))
 
         self.append_step({
                'group': 'docker',
                'action': 'tag_good_image',
                'project':  self.project.name,
                'name': 'Tag successfully tested image as "latest"',
-            })
+            }, depends_on=builds + tests + artifacts)
         return self.plan
 
     def dependencies_ok(self, dependencies):
@@ -99,11 +99,23 @@ def _load_module(group, module):
     return action_map
 
 
-def get_action_object(action_details):
+def load_actions():
+    """
+    Import the action modules in settings.ACTION_MODULES and run their
+    init_actions, unless that has already been done in this process.
+
+    Normally happens on first use, but workers can call this at startup so
+    that the work is done once before forking children for jobs.
+    """
     from django.conf import settings
     global _action_map
     if _action_map is None:
         _action_map = _load_action_map(settings.ACTION_MODULES)
+    return _action_map
+
+
+def get_action_object(action_details):
+    load_actions()
     # copy so we don't destroy it
     ad = dict(action_details)
 
@@ -1,5 +1,10 @@
 import subprocess
+import threading
+import httplib
 import logging
+import copy
+import hashlib
+import json
 import os
 import re
 import yaml
@@ -10,8 +15,11 @@ from django.conf import settings
 from contextlib import closing
 
 from baleen.action import Action
-from baleen.utils import mkdir_p, cd, full_path_split
+from baleen.action import docker_api
+from baleen.action.docker_api import DockerAPIError
+from baleen.utils import mkdir_p, full_path_split
 from baleen.artifact.models import XUnitOutput, CoverageXMLOutput, CoverageHTMLOutput
+from baleen.job.models import Job, ImageBuild
 
 
 log = logging.getLogger('baleen.action.docker')
@@ -46,6 +54,17 @@ def login_registry(registry, creds):
     }
 
 
+def docker_env(job):
+    """
+    Environment for running docker commands against the docker host that
+    job was placed on.
+    """
+    env = dict(os.environ)
+    if job.docker_url:
+        env['DOCKER_HOST'] = job.docker_url
+    return env
+
+
 def init_actions():
     """
     init_actions is called when this module is first loaded
@@ -53,17 +72,429 @@ def init_actions():
 
     We ensure docker host environment variable is setup,
     and that we are signed into any registries that we have
-    credentials for.
+    credentials for. Jobs override DOCKER_HOST with the host
+    they have been placed on, see docker_env.
     """
-    os.environ['DOCKER_HOST'] = settings.DOCKER_HOST
+    os.environ['DOCKER_HOST'] = getattr(settings, 'DOCKER_HOST', '')
     for url, details in settings.DOCKER_REGISTRIES.items():
         login_registry(url, details)
 
 
+def compose_down(job):
+    """
+    Stop and remove the containers docker-compose started for job, if any.
+    Used to clean up after a job is cancelled part way through its tests.
+    """
+    project_name = job.stash.get('compose_project_name')
+    if not project_name:
+        return None
+    args = ["docker-compose", "-p", project_name]
+    if job.stash.get('compose_file'):
+        args += ["-f", job.stash['compose_file']]
+    compose = subprocess.Popen(args + ["down"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=docker_env(job)
+        )
+    stdout, stderr = compose.communicate()
+    if compose.returncode != 0:
+        log.warning('"compose down" for job %d returned %d: %s' % (
+            job.id, compose.returncode, stderr))
+    return compose.returncode
+
+
+def context_tree_hash(build_dir, context):
+    """
+    The git tree hash of the build context directory in the commit checked
+    out in build_dir, or None if the context isn't committed as it is.
+    """
+    path = os.path.normpath(context or '.')
+    rev = 'HEAD:' if path == '.' else 'HEAD:' + path
+    git = subprocess.Popen(['git', 'rev-parse', '--verify', '-q', rev],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=build_dir
+        )
+    tree_hash, stderr = git.communicate()
+    if git.returncode != 0:
+        return None
+    # Uncommitted changes would be in the image but not the tree
+    git = subprocess.Popen(['git', 'status', '--porcelain', '--', path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=build_dir
+        )
+    changes, stderr = git.communicate()
+    if git.returncode != 0 or changes.strip():
+        return None
+    return tree_hash.strip()
+
+
+def build_cache_key(job, step):
+    """
+    Key identifying what an image would be built from: the git tree of its
+    build context and its build step from baleen.yml. None if it can't be
+    worked out, in which case the image is always built.
+    """
+    tree_hash = context_tree_hash(job.job_dirs['build'], step.get('context'))
+    if tree_hash is None:
+        return None
+    return hashlib.sha1(json.dumps({
+        'tree': tree_hash,
+        'image': step.get('image'),
+        'context': step.get('context'),
+    }, sort_keys=True)).hexdigest()
+
+
+def tested_job(job, build_data):
+    """
+    If every image job built was reused from the same earlier job, and that
+    job ran the same tests, return it. Testing again would test the same
+    images in the same way.
+    """
+    images = job.stash.get('images', {}).values()
+    reused_from = set(i.get('reused_from') for i in images)
+    if not images or len(reused_from) != 1 or None in reused_from:
+        return None
+    previous = Job.objects.filter(id=reused_from.pop(), success=True).first()
+    if previous is None or not previous.build_definition:
+        return None
+    previous_data = previous.get_build_data() or {}
+    for key in ('test', 'credentials'):
+        if previous_data.get(key) != build_data.get(key):
+            return None
+    return previous
+
+
+def docker_client(job):
+    """ The Engine API client for job's docker host """
+    return docker_api.get_client(job.docker_url or os.environ.get('DOCKER_HOST'))
+
+
+def pull_image(job, image):
+    """ Pull image onto job's docker host, returns whether it could be """
+    if getattr(settings, 'DOCKER_EXECUTOR', 'cli') == 'api':
+        try:
+            stream = docker_client(job).pull(image,
+                    getattr(settings, 'DOCKER_REGISTRIES', None)).open()
+            for event in stream.json_objects():
+                if 'error' in event:
+                    log.info("Couldn't pull %s: %s" % (image, event['error']))
+                    return False
+        except (DockerAPIError, EnvironmentError, httplib.HTTPException), e:
+            log.info("Couldn't pull %s: %s" % (image, e))
+            return False
+        return True
+    docker = subprocess.Popen(["docker", "pull", image],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=docker_env(job)
+        )
+    stdout, stderr = docker.communicate()
+    if docker.returncode != 0:
+        log.info("Couldn't pull %s: %s" % (image, stderr.strip()))
+    return docker.returncode == 0
+
+
+def dockerfile_base_images(path):
+    """ The images the FROM lines of a Dockerfile build on """
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except IOError:
+        return []
+    images = []
+    stages = set()
+    for line in lines:
+        parts = line.split()
+        if len(parts) < 2 or parts[0].upper() != 'FROM':
+            continue
+        args = [a for a in parts[1:] if not a.startswith('--')]
+        if not args:
+            continue
+        image = args[0]
+        if len(args) >= 3 and args[1].upper() == 'AS':
+            stages.add(args[2].lower())
+        # Earlier stages and build args aren't images to pull
+        if image == 'scratch' or image.lower() in stages or '$' in image:
+            continue
+        if image not in images:
+            images.append(image)
+    return images
+
+
+def prefetch_images(job):
+    """
+    Images worth having on job's docker host before it builds: the images
+    the Dockerfiles of the images it builds are FROM. Only images in the
+    registries of DOCKER_REGISTRIES are pulled, pulling a name like "web"
+    would fetch library/web from the Docker Hub over the local image. Images
+    baleen builds itself are left alone too, as baleen tags their good
+    builds :latest on the docker host and never pushes them.
+
+    A queued job's baleen.yml isn't imported until after checkout, so until
+    then this goes by the project's last imported one, and the Dockerfiles
+    left from its last checkout.
+    """
+    build_data = job.get_build_data()
+    if not build_data:
+        previous = Job.objects.filter(project=job.project, build_data__isnull=False
+                ).exclude(id=job.id).order_by('-id').only('build_data').first()
+        build_data = previous and previous.build_data
+    if not build_data or not isinstance(build_data.get('build'), dict):
+        return []
+    images = []
+    for image, context in sorted(build_data['build'].items()):
+        if isinstance(context, dict):
+            context = context.get('context')
+        images.extend(dockerfile_base_images(
+            os.path.join(job.job_dirs['build'], context or '.', 'Dockerfile')))
+    registries = getattr(settings, 'DOCKER_REGISTRIES', None)
+    images = [i for i in images if docker_api.registry_url(i, registries)]
+    built = set(build_data['build']) | set(ImageBuild.objects.filter(
+            image__in=[docker_api.split_image(i)[0] for i in images]
+            ).values_list('image', flat=True))
+    images = [i for i in images if docker_api.split_image(i)[0] not in built]
+    return sorted(set(images), key=images.index)
+
+
+class ImagePrefetch(object):
+    """
+    Pulls images onto a job's docker host in the background, while the job
+    checks out its code. Nothing waits for the pulls, docker build shares
+    any that are still in progress when it gets to them.
+    """
+
+    def __init__(self, job, images):
+        self.job = job
+        self.images = images
+
+    def start(self):
+        for image in self.images:
+            t = threading.Thread(target=self._pull, args=(image,),
+                    name='pull-%s' % image)
+            t.daemon = True
+            t.start()
+        return self
+
+    def _pull(self, image):
+        try:
+            pull_image(self.job, image)
+        except Exception:
+            log.exception("Pulling %s for job %d failed" % (image, self.job.id))
+
+
+def start_prefetch(job):
+    """ Start pulling the images job is likely to build from, see ImagePrefetch """
+    if not getattr(settings, 'IMAGE_PREFETCH', True):
+        return None
+    return ImagePrefetch(job, prefetch_images(job)).start()
+
+
+class DockerCLI(object):
+    """ Runs the docker commands of an action with the docker client """
+
+    def __init__(self, action):
+        self.action = action
+        self.env = docker_env(action.job)
+
+    def build(self, image, context):
+        return self.action.run_command(
+            ["docker", "build", "-t", image, context],
+            cwd=self.action.job.job_dirs["build"],
+            env=self.env
+            )
+
+    def tag(self, source, target):
+        return self.action.run_command(
+            ["docker", "tag", source, target],
+            env=self.env
+            )
+
+    def test_container(self, project_name):
+        return project_name + '_subject_1'
+
+    def logs(self, container):
+        return self.action.run_command(
+            ["docker", "logs", "-f", container],
+            env=self.env
+            )
+
+    def wait(self, container):
+        """ A response with the exit status of container as its code """
+        docker = self.action.popen(
+            ["docker", "wait", container],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=self.env
+            )
+        stdout, stderr = docker.communicate()
+        if docker.returncode != 0:
+            log.debug('"docker wait" returned %d' % docker.returncode)
+            return {'code': docker.returncode, 'message': stderr.decode('utf-8')}
+        return {'code': int(stdout)}
+
+    def copy(self, container, path, dest):
+        """ Copy path out of container into the dest directory """
+        docker = self.action.popen(
+            ["docker", "cp", container + ":" + path, dest],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=self.env
+            )
+        stdout, stderr = docker.communicate()
+        return {
+            'stdout': stdout.decode('utf-8'),
+            'stderr': stderr.decode('utf-8'),
+            'code': docker.returncode,
+        }
+
+
+class DockerAPI(object):
+    """
+    Does what DockerCLI does through the Docker Engine API, over a kept open
+    connection to the job's docker host. See baleen.action.docker_api.
+    """
+
+    def __init__(self, action):
+        self.action = action
+        self.client = docker_client(action.job)
+
+    def open(self, stream):
+        """ Open stream, letting cancelling the action close it """
+        self.action.connections.append(stream)
+        if self.action.cancelled:
+            stream.close()
+        return stream.open()
+
+    def response(self, code):
+        stdout, stderr = self.action.output_recorders()
+        stdout.flush()
+        stderr.flush()
+        return {
+            'stdout': stdout.tail,
+            'stderr': stderr.tail,
+            'code': -1 if self.action.cancelled else code,
+            'streamed': True,
+        }
+
+    def build(self, image, context):
+        stdout, stderr = self.action.output_recorders()
+        context_dir = os.path.join(self.action.job.job_dirs["build"], context or '.')
+        code = 0
+        with closing(docker_api.context_tar(context_dir)) as tar:
+            stream = self.open(self.client.build(tar, image,
+                    getattr(settings, 'DOCKER_REGISTRIES', None)))
+            for event in stream.json_objects():
+                if 'error' in event:
+                    stderr.write(event['error'].encode('utf-8') + '\n')
+                    code = 1
+                elif 'stream' in event:
+                    stdout.write(event['stream'].encode('utf-8'))
+                elif 'status' in event and not event.get('progressDetail'):
+                    # Pulling a base image, leave out the progress bars
+                    status = event['status']
+                    if event.get('id'):
+                        status = event['id'] + ': ' + status
+                    stdout.write(status.encode('utf-8') + '\n')
+        return self.response(code)
+
+    def tag(self, source, target):
+        try:
+            self.client.tag(source, target)
+        except DockerAPIError, e:
+            return {'code': 1, 'message': unicode(e)}
+        return {'code': 0}
+
+    def test_container(self, project_name):
+        """ Find the container by the labels docker-compose gives it """
+        containers = self.client.containers({
+            'com.docker.compose.project': project_name,
+            'com.docker.compose.service': 'subject',
+        })
+        if not containers:
+            return project_name + '_subject_1'
+        return containers[0]['Id']
+
+    def logs(self, container):
+        stdout, stderr = self.action.output_recorders()
+        try:
+            tty = self.client.inspect_container(container)['Config'].get('Tty')
+            stream = self.open(self.client.logs(container))
+        except DockerAPIError, e:
+            stderr.write(unicode(e).encode('utf-8') + '\n')
+            return self.response(1)
+        if tty:
+            for data in stream.chunks():
+                stdout.write(data)
+        else:
+            recorders = {docker_api.STDOUT: stdout, docker_api.STDERR: stderr}
+            for stream_type, data in stream.frames():
+                recorders.get(stream_type, stdout).write(data)
+        return self.response(0)
+
+    def wait(self, container):
+        try:
+            stream = self.open(self.client.wait(container))
+        except DockerAPIError, e:
+            return {'code': 1, 'message': unicode(e)}
+        try:
+            data = stream.read()
+        finally:
+            stream.close()
+        if self.action.cancelled or not data:
+            return {'code': -1, 'message': 'Stopped waiting for %s' % container}
+        return {'code': json.loads(data)['StatusCode']}
+
+    def copy(self, container, path, dest):
+        try:
+            stream = self.open(self.client.archive(container, path))
+            try:
+                docker_api.extract_tar(stream, dest)
+            finally:
+                stream.close()
+        except DockerAPIError, e:
+            return {'stdout': '', 'stderr': unicode(e), 'code': 1}
+        return {'stdout': '', 'stderr': '', 'code': -1 if self.action.cancelled else 0}
+
+
+DOCKER_EXECUTORS = {
+    'cli': DockerCLI,
+    'api': DockerAPI,
+}
+
+
+def docker_executor(action):
+    """ How action runs docker, see settings.DOCKER_EXECUTOR """
+    return DOCKER_EXECUTORS[getattr(settings, 'DOCKER_EXECUTOR', 'cli')](action)
+
+
+def default_image(stash):
+    """
+    The image for test containers that don't name one: the one built by the
+    last build step in the plan.
+    """
+    images = stash.get('images')
+    if not images:
+        return stash.get('docker_image')
+    return max(images, key=lambda i: images[i].get('index'))
+
+
 class BuildImageAction(Action):
+    """
+    Builds an image, tagged with the job.
+
+    If a successful job on the same docker host has an image built from the
+    same source (see build_cache_key) that image is tagged for this job
+    instead, and if that's true of all the job's images then testing is
+    skipped as well.
+
+    Otherwise the build reuses layers from the image's latest, if the job's
+    ImagePrefetch could pull it.
+    """
 
     def __init__(self, project, name, index, *arg, **kwarg):
-        super(BuildImageAction, self).__init__(project, name, index)
+        super(BuildImageAction, self).__init__(project, name, index, *arg, **kwarg)
         self.context = kwarg.get('context')
         self.image_name = kwarg.get('image')
 
@@ -72,37 +503,42 @@ class BuildImageAction(Action):
 
     def execute(self, stdoutlog, stderrlog, action_result):
         self.docker_tag = 'baleen_' + str(self.job.id)
-        self.job.stash['docker_image'] = self.image_name
         self.job.stash['docker_tag'] = self.docker_tag
-
-        path = self.job.job_dirs["build"]
-        with cd(path):
-            docker = subprocess.Popen(
-                ["docker", "build", "-t",
-                    self.image_name + ":" + self.docker_tag,
-                    self.context],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
+        # Keyed by image, as images can be built in parallel
+        images = self.job.stash.setdefault('images', {})
+
+        cache_key = build_cache_key(self.job, {
+            'image': self.image_name,
+            'context': self.context,
+        })
+        docker = docker_executor(self)
+        previous = cache_key and ImageBuild.find(self.job, self.image_name, cache_key)
+        if previous:
+            response = docker.tag(
+                self.image_name + ":" + previous.tag,
+                self.image_name + ":" + self.docker_tag
                 )
-
-        stdout, stderr = docker.communicate()
-        status = docker.returncode
-
-        stdout = stdout.decode('utf-8')
-        stderr = stderr.decode('utf-8')
-        log.debug('BuildImage stdout: %s' % stdout)
-        log.debug('BuildImage stderr: %s' % stderr)
-        return {
-            'stdout': stdout,
-            'stderr': stderr,
-            'code': status,
-        }
+            if response['code'] == 0:
+                images[self.image_name] = {'cache_key': cache_key,
+                        'reused_from': previous.job_id, 'index': self.index}
+                response['message'] = 'Source unchanged, reused image %s from job %d.' % (
+                        previous, previous.job_id)
+                return response
+            # Probably removed from the docker host since
+            log.info('Could not reuse image %s, building it' % previous)
+
+        response = docker.build(self.image_name + ":" + self.docker_tag,
+                self.context)
+        images[self.image_name] = {'cache_key': cache_key,
+                'reused_from': None, 'index': self.index}
+        log.debug('BuildImage exited with %d' % response['code'])
+        return response
 
 
 class ComposeAction(Action):
 
     def __init__(self, project, name, index, *arg, **kwarg):
-        super(ComposeAction, self).__init__(project, name, index)
+        super(ComposeAction, self).__init__(project, name, index, *arg, **kwarg)
         self.compose_file = kwarg.get('compose_file')
 
     def __unicode__(self):
@@ -115,7 +551,7 @@ class ComposeAction(Action):
 class TestWithComposeAction(Action):
 
     def __init__(self, project, name, index, *arg, **kwarg):
-        super(TestWithComposeAction, self).__init__(project, name, index)
+        super(TestWithComposeAction, self).__init__(project, name, index, *arg, **kwarg)
         self.compose_raw_data = kwarg.get('compose_data')
         # compose_data looks like:
         #{'subject':
@@ -124,7 +560,11 @@ class TestWithComposeAction(Action):
                 #'command': ['./run_tests.sh']
             #}
         #}
-        self.compose_data = yaml.load(StringIO(self.compose_raw_data))
+        if isinstance(self.compose_raw_data, dict):
+            # From the job's stored plan, already parsed
+            self.compose_data = copy.deepcopy(self.compose_raw_data)
+        else:
+            self.compose_data = yaml.safe_load(StringIO(self.compose_raw_data))
         self.volume_dir = None
 
     def _inject_baleen_data(self, data, credentials, stash):
@@ -134,7 +574,7 @@ class TestWithComposeAction(Action):
             if 'image' in data[container]:
                 image = data[container]['image']
             else:
-                image = stash['docker_image']
+                image = default_image(stash)
             image_parts = image.rsplit(':')
             if len(image_parts) > 1:
                 image = image_parts[0] 
@@ -169,7 +609,15 @@ class TestWithComposeAction(Action):
         return compose_fn
 
     def execute(self, stdoutlog, stderrlog, action_result):
-        build_data = yaml.load(StringIO(self.job.build_definition))
+        build_data = self.job.get_build_data()
+
+        previous = tested_job(self.job, build_data)
+        if previous:
+            self.job.stash['tests_skipped'] = True
+            return {
+                'code': 0,
+                'message': 'Skipped, the same images passed these tests in job %d.' % previous.id,
+            }
 
         compose_data_with_images = self._inject_baleen_data(self.compose_data,
                 build_data.get('credentials'),
@@ -189,103 +637,56 @@ class TestWithComposeAction(Action):
         # Set the COMPOSE_PROJECT_NAME environment variable to build id
         # to avoid concurrent builds getting funky:
         # https://github.com/docker/compose/issues/748
-        os.environ['COMPOSE_PROJECT_NAME'] = sanitised_project_name + str(self.job.id)
+        env = docker_env(self.job)
+        env['COMPOSE_PROJECT_NAME'] = sanitised_project_name + str(self.job.id)
 
-        self.job.stash['compose_project_name'] = os.environ['COMPOSE_PROJECT_NAME']
+        self.job.stash['compose_project_name'] = env['COMPOSE_PROJECT_NAME']
         self.job.stash['compose_test_container'] = (
-                os.environ['COMPOSE_PROJECT_NAME']
+                env['COMPOSE_PROJECT_NAME']
                 + '_' + 'subject' + '_1' 
                 )
 
         fn = self.write_compose_file(compose_data_with_images)
-        compose = subprocess.Popen(
+        self.job.stash['compose_file'] = fn
+        response = self.run_command(
             ["docker-compose", "-f", fn, "up", "-d"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            env=env
             )
 
-        stdout, stderr = compose.communicate()
-        status = compose.returncode
-        
-        if status != 0:
-            log.debug('"compose up" returned %d' % status)
-            return {
-                'stdout': stdout,
-                'stderr': stderr,
-                'code': status,
-            }
+        if response['code'] != 0:
+            log.debug('"compose up" returned %d' % response['code'])
+            return response
 
-        # TODO: make collecting the test container logs a separate action
-        stdout = stdout.decode('utf-8')
-        stderr = stderr.decode('utf-8')
-        log.debug('Compose test stdout: %s' % stdout)
-        log.debug('Compose test stderr: %s' % stderr)
+        docker = docker_executor(self)
+        self.job.stash['compose_test_container'] = docker.test_container(
+                env['COMPOSE_PROJECT_NAME'])
 
+        # TODO: make collecting the test container logs a separate action
         # Get test container stdout/stderr
-        docker = subprocess.Popen(
-            ["docker", "logs", "-f", self.job.stash['compose_test_container'] ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-            )
+        log.debug('Following the test container output')
+        response = docker.logs(self.job.stash['compose_test_container'])
 
-        log.debug('Using "docker logs -f" to trace test process output')
-        stdout, stderr = docker.communicate()
-        status = docker.returncode
-
-        if status != 0:
-            log.debug('"docker logs -f" returned %d' % status)
-            return {
-                'stdout': stdout,
-                'stderr': stderr,
-                'code': status,
-            }
-
-
-        stdout = stdout.decode('utf-8')
-        stderr = stderr.decode('utf-8')
-        log.debug('docker log stdout: %s' % stdout)
-        log.debug('docker log stderr: %s' % stderr)
+        if response['code'] != 0:
+            log.debug('Following the test container returned %d' % response['code'])
+            return response
 
         # Get test container exit code
-        docker2 = subprocess.Popen(
-            ["docker", "wait", self.job.stash['compose_test_container'] ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-            )
+        log.debug('Waiting for the return code of test process')
+        status = docker.wait(self.job.stash['compose_test_container'])
+        response['code'] = status['code']
+        if 'message' in status:
+            response['message'] = status['message']
+            return response
 
-        log.debug('Using "docker wait" to get return code of test process')
-        stdout2, stderr2 = docker2.communicate()
-        status = docker2.returncode
+        log.debug('Result of compose test was status code %d' % response['code'])
 
-        if status != 0:
-            log.debug('"docker wait" returned %d' % status)
-            return {
-                'stdout': stdout2,
-                'stderr': stderr2,
-                'code': status,
-            }
-
-        stdout2 = stdout2.decode('utf-8')
-        stderr2 = stderr2.decode('utf-8')
-        log.debug('docker wait stdout: %s' % stdout2)
-        log.debug('docker wait stderr: %s' % stderr2)
-
-        status = int(stdout2)
-        log.debug('Result of compose test was status code %d' % status)
-
-        del os.environ['COMPOSE_PROJECT_NAME']
-
-        return {
-            'stdout': stdout,
-            'stderr': stderr,
-            'code': status,
-        }
+        return response
 
 
 class GetBuildArtifactAction(Action):
 
     def __init__(self, project, name, index, *arg, **kwarg):
-        super(GetBuildArtifactAction, self).__init__(project, name, index)
+        super(GetBuildArtifactAction, self).__init__(project, name, index, *arg, **kwarg)
         self.artifact_path = kwarg.get('artifact_path')
         self.artifact_type = kwarg.get('artifact_type')
 
@@ -294,39 +695,27 @@ class GetBuildArtifactAction(Action):
 
 
     def execute(self, stdoutlog, stderrlog, action_result):
+        if self.job.stash.get('tests_skipped'):
+            return {
+                'code': 0,
+                'message': 'Skipped, the tests were not run.',
+            }
         CONTAINER_NAME = self.job.stash['compose_test_container']
         path = self.job.job_dirs['artifact']
         mkdir_p(path)
 
-        docker = subprocess.Popen(
-                ["docker", "cp",
-                    CONTAINER_NAME + ":" + self.artifact_path,
-                    path
-                ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-            )
-
-        stdout, stderr = docker.communicate()
-        status = docker.returncode
-
-        stdout = stdout.decode('utf-8')
-        stderr = stderr.decode('utf-8')
-        log.debug(str(self) + ' stdout: %s' % stdout)
-        log.debug(str(self) + ' stderr: %s' % stderr)
+        response = docker_executor(self).copy(CONTAINER_NAME, self.artifact_path, path)
+        log.debug(str(self) + ' stdout: %s' % response.get('stdout'))
+        log.debug(str(self) + ' stderr: %s' % response.get('stderr'))
 
-        if status == 0:
+        if response['code'] == 0:
             self.record_artifact(
                     action_result,
                     self.artifact_type,
                     os.path.join(path, os.path.basename(self.artifact_path))
                 )
 
-        return {
-            'stdout': stdout,
-            'stderr': stderr,
-            'code': status,
-        }
+        return response
 
     def record_artifact(self, ar, artifact_type, path):
         if artifact_type == 'xunit':
@@ -353,27 +742,25 @@ class TagGoodImageAction(Action):
         return "TagGoodImageAction: %s" % self.name
 
     def execute(self, stdoutlog, stderrlog, action_result):
-        path = self.job.job_dirs['build']
-        with cd(path):
-            docker = subprocess.Popen(
-                ["docker", "tag", "--force",
-                    self.job.stash['docker_image'] + ":" +
-                    self.job.stash['docker_tag'],
-                    self.job.stash['docker_image'] + ":latest",
-                    ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
+        docker = docker_executor(self)
+        images = self.job.stash.get('images', {})
+        response = {'code': 0}
+        for image in sorted(images, key=lambda i: images[i].get('index')):
+            response = docker.tag(
+                image + ":" + self.job.stash['docker_tag'],
+                image + ":latest"
                 )
-
-        stdout, stderr = docker.communicate()
-        status = docker.returncode
-
-        stdout = stdout.decode('utf-8')
-        stderr = stderr.decode('utf-8')
-        log.debug('BuildImage stdout: %s' % stdout)
-        log.debug('BuildImage stderr: %s' % stderr)
-        return {
-            'stdout': stdout,
-            'stderr': stderr,
-            'code': status,
-        }
+            log.debug('TagGoodImage for %s exited with %d' % (image, response['code']))
+            if response['code'] != 0:
+                return response
+        self.record_image_builds()
+        return response
+
+    def record_image_builds(self):
+        """ Let later jobs reuse the images this job has now tested """
+        for image, details in self.job.stash.get('images', {}).items():
+            if details.get('cache_key'):
+                ImageBuild.objects.create(project=self.job.project, job=self.job,
+                        image=image, tag=self.job.stash['docker_tag'],
+                        cache_key=details['cache_key'],
+                        docker_host=self.job.docker_host)
@@ -0,0 +1,418 @@
+"""
+A small client for the Docker Engine API, used by the docker actions when
+settings.DOCKER_EXECUTOR is 'api' (see baleen.action.docker).
+
+Short requests share one kept open connection per docker host. Requests
+whose responses stream for as long as something runs (builds, logs, waiting
+on a container) are DockerStreams with a connection of their own, which can
+be closed from another thread to cancel them.
+"""
+import os
+import json
+import base64
+import socket
+import struct
+import fnmatch
+import httplib
+import logging
+import tarfile
+import tempfile
+import threading
+import urllib
+
+from urlparse import urlparse
+from contextlib import closing
+
+log = logging.getLogger('baleen.action.docker')
+
+DEFAULT_DOCKER_HOST = 'unix:///var/run/docker.sock'
+
+# Seconds to wait on a response to a short request
+REQUEST_TIMEOUT = 60
+
+# Stream types in the header of each frame of a multiplexed log stream
+STDOUT = 1
+STDERR = 2
+
+
+class DockerAPIError(Exception):
+
+    def __init__(self, status, message):
+        super(DockerAPIError, self).__init__(message)
+        self.status = status
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """ An HTTPConnection to a server listening on a unix socket """
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = path
+        self.timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def error_message(status, data):
+    """ The message from the JSON body of an error response """
+    try:
+        return json.loads(data)['message']
+    except (ValueError, TypeError, KeyError):
+        return data.strip() or httplib.responses.get(status, str(status))
+
+
+def split_image(name):
+    """ Split an image name into repository and tag, the tag may be None """
+    repo, sep, tag = name.rpartition(':')
+    if not sep or '/' in tag:
+        # No tag, the colon is before a registry's port
+        return name, None
+    return repo, tag
+
+
+def registry_credentials(url, creds):
+    return {
+        'username': creds['user'],
+        'password': creds['password'],
+        'email': creds.get('email'),
+        'serveraddress': url,
+    }
+
+
+def registry_config(registries):
+    """ The X-Registry-Config header for credentials for several registries """
+    return base64.urlsafe_b64encode(json.dumps(dict(
+        (url, registry_credentials(url, creds)) for url, creds in registries.items())))
+
+
+def registry_url(repo, registries):
+    """
+    The key in registries of repo's registry, None if repo is on the Docker
+    Hub or its registry isn't one of them.
+    """
+    host = repo.split('/', 1)[0]
+    if '/' not in repo or not ('.' in host or ':' in host or host == 'localhost'):
+        # On the Docker Hub
+        return None
+    for url in (registries or {}):
+        if (urlparse(url).netloc or url).rstrip('/') == host:
+            return url
+    return None
+
+
+def registry_auth(repo, registries):
+    """
+    The X-Registry-Auth header for pulling from repo's registry, None if
+    there are no credentials for it.
+    """
+    url = registry_url(repo, registries)
+    if url is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(registry_credentials(url, registries[url])))
+
+
+class DockerStream(object):
+    """
+    A request whose response is read as it arrives. Made by open(), close()
+    may be called from another thread at any point after that, reading then
+    stops as if the response had ended.
+    """
+
+    def __init__(self, connection, method, url, body=None, headers=None):
+        self.connection = connection
+        self.request = (method, url, body, headers or {})
+        self.response = None
+        self.closed = False
+
+    def open(self):
+        """ Make the request, returns the stream """
+        if self.closed:
+            return self
+        try:
+            self.connection.request(*self.request)
+            self.response = self.connection.getresponse()
+        except (socket.error, httplib.HTTPException):
+            if not self.closed:
+                self.close()
+                raise
+            return self
+        if self.response.status >= 400:
+            data = self.response.read()
+            self.close()
+            raise DockerAPIError(self.response.status,
+                    error_message(self.response.status, data))
+        return self
+
+    def chunks(self, read_size=65536):
+        """ Yield the body as the daemon sends it """
+        if self.response is None:
+            return
+        try:
+            if self.response.chunked:
+                # HTTPResponse.read(n) waits for n bytes, which would hold up
+                # output until enough of it has built up, so read the chunks
+                # as they come
+                fp = self.response.fp
+                while True:
+                    size = int(fp.readline().split(';', 1)[0], 16)
+                    if size == 0:
+                        break
+                    data = fp.read(size)
+                    fp.read(2)
+                    yield data
+            else:
+                while True:
+                    data = self.response.read(read_size)
+                    if not data:
+                        break
+                    yield data
+        except (socket.error, ValueError, httplib.HTTPException):
+            if not self.closed:
+                raise
+        finally:
+            self.close()
+
+    def read(self, amt=None):
+        """ Read like a file, e.g. for tarfile """
+        if self.response is None:
+            return ''
+        try:
+            return self.response.read(amt)
+        except (socket.error, ValueError, httplib.HTTPException):
+            if not self.closed:
+                raise
+            return ''
+
+    def json_objects(self):
+        """ Yield each JSON object in a stream of them, like build progress """
+        decoder = json.JSONDecoder()
+        buf = ''
+        for data in self.chunks():
+            buf += data
+            while True:
+                buf = buf.lstrip()
+                if not buf:
+                    break
+                try:
+                    obj, end = decoder.raw_decode(buf)
+                except ValueError:
+                    # Wait for the rest of it
+                    break
+                yield obj
+                buf = buf[end:]
+
+    def frames(self):
+        """
+        Yield (stream type, data) for each frame of a multiplexed stream, the
+        output of a container run without a tty.
+        """
+        buf = ''
+        for data in self.chunks():
+            buf += data
+            while len(buf) >= 8:
+                stream_type, size = struct.unpack('>BxxxL', buf[:8])
+                if len(buf) < 8 + size:
+                    break
+                yield stream_type, buf[8:8 + size]
+                buf = buf[8 + size:]
+
+    def close(self):
+        self.closed = True
+        sock = self.connection.sock
+        if sock is not None:
+            try:
+                # Wakes up a read blocked in another thread
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.connection.close()
+
+
+class DockerClient(object):
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url or DEFAULT_DOCKER_HOST
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self, timeout=None):
+        url = urlparse(self.base_url)
+        if url.scheme == 'unix':
+            return UnixHTTPConnection(url.path, timeout=timeout)
+        if url.scheme in ('tcp', 'http'):
+            return httplib.HTTPConnection(url.hostname, url.port or 2375, timeout=timeout)
+        raise DockerAPIError(None, "Can't connect to docker host %s" % self.base_url)
+
+    def url(self, path, params=None):
+        if params:
+            path += '?' + urllib.urlencode(params)
+        return path
+
+    def request(self, method, path, params=None, body=None):
+        """
+        Make a request on the kept open connection, returning the decoded
+        JSON response, if any.
+        """
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        with self.lock:
+            for attempt in (1, 2):
+                if self.connection is None:
+                    self.connection = self.connect(REQUEST_TIMEOUT)
+                try:
+                    self.connection.request(method, self.url(path, params), body, headers)
+                    response = self.connection.getresponse()
+                    data = response.read()
+                    break
+                except (socket.error, httplib.HTTPException):
+                    # The daemon may have closed the connection while it was idle
+                    self.connection.close()
+                    self.connection = None
+                    if attempt == 2:
+                        raise
+        if response.status >= 400:
+            raise DockerAPIError(response.status, error_message(response.status, data))
+        if data and 'json' in (response.getheader('Content-Type') or ''):
+            return json.loads(data)
+        return data or None
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def stream(self, method, path, params=None, body=None, headers=None):
+        """ A DockerStream for a request on a connection of its own """
+        return DockerStream(self.connect(), method, self.url(path, params), body, headers)
+
+    def build(self, context, tag, registries=None):
+        """
+        Build an image from a tar of its context, see context_tar. The
+        daemon logs in to registries (like settings.DOCKER_REGISTRIES) to
+        pull base images.
+        """
+        params = {'t': tag, 'rm': 1}
+        context.seek(0, os.SEEK_END)
+        length = context.tell()
+        context.seek(0)
+        headers = {
+            'Content-Type': 'application/x-tar',
+            'Content-Length': str(length),
+        }
+        if registries:
+            headers['X-Registry-Config'] = registry_config(registries)
+        return self.stream('POST', '/build', params, context, headers)
+
+    def pull(self, image, registries=None):
+        """ Pull an image, a stream of its progress, see DockerStream.json_objects """
+        repo, tag = split_image(image)
+        headers = {}
+        auth = registry_auth(repo, registries)
+        if auth:
+            headers['X-Registry-Auth'] = auth
+        return self.stream('POST', '/images/create',
+                {'fromImage': repo, 'tag': tag or 'latest'}, headers=headers)
+
+    def tag(self, source, target):
+        repo, tag = split_image(target)
+        params = {'repo': repo, 'force': 1}
+        if tag:
+            params['tag'] = tag
+        self.request('POST', '/images/%s/tag' % urllib.quote(source, safe='/:'), params)
+
+    def containers(self, labels):
+        """ All containers, running or not, with labels (a dict) """
+        filters = json.dumps({'label': ['%s=%s' % l for l in sorted(labels.items())]})
+        return self.request('GET', '/containers/json', {'all': 1, 'filters': filters})
+
+    def inspect_container(self, container):
+        return self.request('GET', '/containers/%s/json' % container)
+
+    def logs(self, container):
+        """ Follow the output of a container, see DockerStream.frames """
+        return self.stream('GET', '/containers/%s/logs' % container,
+                {'follow': 1, 'stdout': 1, 'stderr': 1})
+
+    def wait(self, container):
+        """ A stream whose response arrives when the container exits """
+        return self.stream('POST', '/containers/%s/wait' % container)
+
+    def archive(self, container, path):
+        """ A tar stream of path in the container """
+        return self.stream('GET', '/containers/%s/archive' % container, {'path': path})
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(base_url=None):
+    """ The process wide DockerClient for a docker host """
+    base_url = base_url or DEFAULT_DOCKER_HOST
+    with _clients_lock:
+        if base_url not in _clients:
+            _clients[base_url] = DockerClient(base_url)
+        return _clients[base_url]
+
+
+def read_dockerignore(context_dir):
+    try:
+        with open(os.path.join(context_dir, '.dockerignore')) as f:
+            lines = [l.strip() for l in f]
+    except IOError:
+        return []
+    return [os.path.normpath(l) if not l.startswith('!') else '!' + os.path.normpath(l[1:])
+            for l in lines if l and not l.startswith('#')]
+
+
+def is_ignored(path, patterns):
+    """ Whether .dockerignore patterns leave out path, the last match wins """
+    ignored = False
+    for pattern in patterns:
+        exclude = not pattern.startswith('!')
+        pattern = pattern.lstrip('!')
+        if (fnmatch.fnmatch(path, pattern)
+                or path.startswith(pattern.rstrip('/') + '/')):
+            ignored = exclude
+    return ignored
+
+
+def context_tar(context_dir):
+    """
+    A temporary file with a tar of a build context, leaving out what its
+    .dockerignore does.
+    """
+    patterns = read_dockerignore(context_dir)
+    f = tempfile.TemporaryFile()
+    with closing(tarfile.open(fileobj=f, mode='w')) as tar:
+        for root, dirs, files in os.walk(context_dir):
+            for name in sorted(dirs + files):
+                path = os.path.join(root, name)
+                arcname = os.path.relpath(path, context_dir)
+                if is_ignored(arcname, patterns):
+                    if name in dirs:
+                        dirs.remove(name)
+                    continue
+                tar.add(path, arcname=arcname, recursive=False)
+    f.seek(0)
+    return f
+
+
+def extract_tar(fileobj, dest):
+    """ Extract a tar stream into dest, refusing paths that lead out of it """
+    with closing(tarfile.open(fileobj=fileobj, mode='r|')) as tar:
+        for member in tar:
+            path = os.path.normpath(member.name)
+            if os.path.isabs(path) or path.split(os.sep)[0] == '..':
+                raise DockerAPIError(None, "Unsafe path in archive: %s" % member.name)
+            if member.issym() or member.islnk():
+                log.warning("Not extracting link %s" % member.name)
+                continue
+            tar.extract(member, dest)
@@ -0,0 +1,89 @@
+import sys
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+log = logging.getLogger('baleen.action')
+
+
+class PlanExecutor(object):
+    """
+    Runs the steps of an action plan, starting each step as soon as the
+    steps it depends_on have succeeded, with up to max_parallel steps running
+    at once. Steps without depends_on wait for the step before them.
+
+    start_step(step) is called on the calling thread, one step at a time in
+    index order, so anything it records (like the ActionResult for the step)
+    is ordered the same way as the plan. Its return value is passed to
+    run_step(step, started), which runs in a thread of its own.
+
+    If a step raises, no more steps are started and, once the running steps
+    have finished, the exception is raised from run.
+    """
+
+    def __init__(self, steps, max_parallel=None):
+        self.steps = sorted(steps, key=lambda s: s['index'])
+        if max_parallel is None:
+            max_parallel = settings.MAX_PARALLEL_ACTIONS
+        self.max_parallel = max(1, max_parallel)
+        self.done = set()
+        self.running = {}
+        self.pending = list(self.steps)
+        self.exc_info = None
+        self.finished = threading.Condition()
+
+    def dependencies(self, step):
+        depends_on = step.get('depends_on')
+        if depends_on is None:
+            previous = [s['index'] for s in self.steps if s['index'] < step['index']]
+            return previous[-1:]
+        return depends_on
+
+    def ready_steps(self):
+        return [s for s in self.pending
+                if all(d in self.done for d in self.dependencies(s))]
+
+    def _run_step(self, step, started, run_step):
+        try:
+            run_step(step, started)
+        except Exception:
+            with self.finished:
+                if self.exc_info is None:
+                    self.exc_info = sys.exc_info()
+        finally:
+            # Each thread gets its own db connection
+            connection.close()
+            with self.finished:
+                del self.running[step['index']]
+                self.done.add(step['index'])
+                self.finished.notify()
+
+    def run(self, start_step, run_step):
+        with self.finished:
+            while True:
+                if self.exc_info is None:
+                    for step in self.ready_steps()[:self.max_parallel - len(self.running)]:
+                        self.pending.remove(step)
+                        try:
+                            started = start_step(step)
+                        except Exception:
+                            self.exc_info = sys.exc_info()
+                            break
+                        t = threading.Thread(target=self._run_step,
+                                args=(step, started, run_step),
+                                name='step-%d' % step['index'])
+                        t.daemon = True
+                        self.running[step['index']] = t
+                        t.start()
+                if not self.running:
+                    break
+                # With a timeout so that signals still get handled
+                self.finished.wait(1)
+
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        if self.pending:
+            raise Exception("Steps %s depend on steps that aren't in the plan" %
+                    ', '.join(str(s['index']) for s in self.pending))
@@ -2,7 +2,6 @@ import stat
 import logging
 import os
 import shutil
-import subprocess
 import tempfile
 
 from contextlib import closing
@@ -10,7 +9,7 @@ from django.conf import settings
 
 from baleen.action import Action
 
-from baleen.utils import mkdir_p, cd
+from baleen.utils import mkdir_p
 
 
 log = logging.getLogger('baleen.action.project')
@@ -52,82 +51,58 @@ class GitAction(Action):
         identity_fn = self.write_ssh_identity(self.project.private_key.value)
         git_ssh_fn = self.write_git_wrapper(identity_fn)
 
-        os.environ['GIT_SSH'] = git_ssh_fn
-        
-        with cd(self.job.job_dirs['checkout']):
-            response = self.git_action(self.job)
-        del os.environ['GIT_SSH']
+        env = dict(os.environ)
+        env['GIT_SSH'] = git_ssh_fn
 
-        # Clean up after outselves
-        os.remove(identity_fn)
-        os.remove(git_ssh_fn)
+        try:
+            response = self.git_action(self.job, env)
+        finally:
+            # Clean up after outselves
+            os.remove(identity_fn)
+            os.remove(git_ssh_fn)
         if response.get('code', -1) != 0:
             response['success'] = False
         return response
 
-    def clone_repo(self, job):
-
-        git = subprocess.Popen(
+    def clone_repo(self, job, env=None):
+        response = self.run_command(
             ["git", "clone",
                 job.project.repo_url,
                 job.job_dirs['build']
                 ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            cwd=job.job_dirs['checkout'],
+            env=env
             )
+        log.debug('Git clone exited with %d' % response['code'])
+        return response
 
-        stdoutdata, stderrdata = git.communicate()
-        status = git.returncode
-
-        stdout = stdoutdata.decode('utf-8')
-        stderr = stderrdata.decode('utf-8')
-        log.debug('Git clone stdout: %s' % stdout)
-        log.debug('Git clone stderr: %s' % stderr)
-        return {
-            'stdout': stdout,
-            'stderr': stderr,
-            'code': status,
-        }
-
-    def pull_repo(self, job):
-        with cd(self.job.job_dirs['build']):
-            git = subprocess.Popen(
-                ["git", "pull", "origin", "master"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-                )
-
-        stdout, stderr = git.communicate()
-        status = git.returncode
-
-        stdout = stdout.decode('utf-8')
-        stderr = stderr.decode('utf-8')
-        log.debug('Git pull origin master stdout: %s' % stdout)
-        log.debug('Git pull origin master stderr: %s' % stderr)
-        return {
-            'stdout': stdout,
-            'stderr': stderr,
-            'code': status,
-        }
+    def pull_repo(self, job, env=None):
+        response = self.run_command(
+            ["git", "pull", "origin", "master"],
+            cwd=job.job_dirs['build'],
+            env=env
+            )
+        log.debug('Git pull origin master exited with %d' % response['code'])
+        return response
 
 
 class CloneRepoAction(GitAction):
 
-    def git_action(self, job):
+    def git_action(self, job, env=None):
         d = job.job_dirs['build']
         if os.path.exists(d):
             shutil.rmtree(d)
 
-        return self.clone_repo(job)
+        return self.clone_repo(job, env)
  
 
 class SyncRepoAction(GitAction):
 
-    def git_action(self, job):
+    def git_action(self, job, env=None):
         if not os.path.exists(job.job_dirs['build']):
-            response = self.clone_repo(job)
+            response = self.clone_repo(job, env)
         else:
-            response = self.pull_repo(job)
+            response = self.pull_repo(job, env)
         return response
 
 
@@ -135,12 +110,10 @@ class ImportBuildDefinitionAction(Action):
 
     def execute(self, stdoutlog, stderrlog, action_result):
         full_path = self.job.job_dirs['build']
-        with cd(full_path):
-            with open('baleen.yml') as fd:
-                raw_plan = fd.read()
+        with open(os.path.join(full_path, 'baleen.yml')) as fd:
+            raw_plan = fd.read()
 
-        action_result.job.build_definition = raw_plan
-        action_result.job.save()
+        self.job.import_build_definition(raw_plan)
         return {
             'stdout': 'imported baleen.yml',
             'stderr': '',
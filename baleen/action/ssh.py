@@ -1,22 +1,73 @@
-import time
 import os
+import Queue
+import select
 import paramiko
+import threading
 import subprocess
 import tempfile
 
 from django.conf import settings
-from contextlib import closing
+from contextlib import closing, contextmanager
 
-from stat import S_ISDIR
+from stat import S_ISDIR, S_ISLNK
 from StringIO import StringIO
 
 from baleen.action import Action
 
-from baleen.artifact.models import output_types, ActionOutput
+from baleen.action.stream import OutputRecorder
+from baleen.artifact.models import output_types
 
 from baleen.utils import get_credential_key_pair
 
 
+class SSHConnectionPool(object):
+    """
+    Authenticated ssh connections shared by the actions of a job, one per
+    (username, host address). Actions open their own channels on them.
+    """
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, action):
+        key = (action.username, action.host_address)
+        # Actions can run in parallel, only one of them connects
+        with self.lock:
+            ssh = self.connections.get(key)
+            transport = ssh.get_transport() if ssh else None
+            if transport is None or not transport.is_active():
+                ssh = action.get_ssh_connection()
+                self.connections[key] = ssh
+            return ssh
+
+    def close(self):
+        with self.lock:
+            for ssh in self.connections.values():
+                ssh.close()
+            self.connections = {}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_ssh_pool(job_id):
+    """ The SSHConnectionPool for job_id in this process """
+    with _pools_lock:
+        if job_id not in _pools:
+            _pools[job_id] = SSHConnectionPool()
+        return _pools[job_id]
+
+
+def close_ssh_pool(job_id):
+    """ Close any ssh connections job_id's actions left open """
+    with _pools_lock:
+        pool = _pools.pop(job_id, None)
+    if pool:
+        pool.close()
+
+
 class RemoteSSHAction(Action):
     """
     Abstract action to do something on a remote host with ssh access.
@@ -35,7 +86,7 @@ class RemoteSSHAction(Action):
     abstract = True
 
     def __init__(self, project, name, index, *arg, **kwarg):
-        super(RemoteSSHAction, self).__init__(project, name, index)
+        super(RemoteSSHAction, self).__init__(project, name, index, *arg, **kwarg)
 
         self.username = kwarg.get('username')
         self.host = kwarg.get('host')
@@ -96,6 +147,19 @@ class RemoteSSHAction(Action):
 
         return ssh
 
+    @contextmanager
+    def ssh_connection(self):
+        """
+        An ssh connection to the host, from the job's pool so that actions
+        on the same host reuse it. Outside of a job it is closed afterwards.
+        """
+        job = getattr(self, 'job', None)
+        if job is None:
+            with closing(self.get_ssh_connection()) as ssh:
+                yield ssh
+        else:
+            yield get_ssh_pool(job.id).get(self)
+
     def as_form_data(self):
         output = super(RemoteSSHAction, self).as_form_data()
 
@@ -112,6 +176,8 @@ class RunCommandAction(RemoteSSHAction):
     label = 'run_command'
 
     STREAM_BUFFER_SIZE = 1048576
+    # Longest wait for output before checking whether the action was cancelled
+    POLL_INTERVAL = 1
 
     def __init__(self, *arg, **kwarg):
         super(RunCommandAction, self).__init__(*arg, **kwarg)
@@ -119,7 +185,7 @@ class RunCommandAction(RemoteSSHAction):
         self.command = kwarg.get('command')
 
     def execute(self, stdoutlog, stderrlog, action_result):
-        with closing(self.get_ssh_connection()) as ssh:
+        with self.ssh_connection() as ssh:
             transport = ssh.get_transport()
 
             response = self._run_command(self.command, transport,
@@ -138,44 +204,58 @@ class RunCommandAction(RemoteSSHAction):
                 self.command, self.username, self.host, action_result.status_code)
 
     def _run_command(self, command, transport, stdoutlog=None, stderrlog=None, action_result=None):
-        response = {'stdout': '', 'stderr': '', 'code': None}
+        response = {'stdout': '', 'stderr': '', 'code': None, 'streamed': True}
 
         chan = transport.open_session()
         chan.exec_command(command)
 
-        a_stdout = ActionOutput(action_result=action_result,
-                output_type=output_types.STDOUT) if action_result else None
-        a_stderr = ActionOutput(action_result=action_result,
-                output_type=output_types.STDERR) if action_result else None
-
-        def save_stream(data, action_output, log):
-            if log:
-                log.write(data)
-                log.flush()
-            if action_output:
-                if action_output.output is None:
-                    action_output.output = ''
-
-                action_output.output += data
-                action_output.save()
-            return data
+        stdout = OutputRecorder(action_result, output_types.STDOUT, stdoutlog)
+        stderr = OutputRecorder(action_result, output_types.STDERR, stderrlog)
 
         buff_size = self.STREAM_BUFFER_SIZE
 
-        while not chan.exit_status_ready():
-            time.sleep(1)
-            if chan.recv_ready():
-                response['stdout'] += save_stream(chan.recv(buff_size), a_stdout, stdoutlog)
-            if chan.recv_stderr_ready():
-                response['stderr'] += save_stream(chan.recv_stderr(buff_size), a_stderr, stderrlog)
-
-        # Read any remaining data in the streams
-        while chan.recv_ready():
-            response['stdout'] += save_stream(chan.recv(buff_size), a_stdout, stdoutlog)
-        while chan.recv_stderr_ready():
-            response['stderr'] += save_stream(chan.recv_stderr(buff_size), a_stderr, stderrlog)
-
-        response['code'] = chan.recv_exit_status()
+        try:
+            while True:
+                if self.cancelled:
+                    # Closing the channel, below, hangs up on the remote command
+                    response['code'] = -1
+                    return response
+                # The channel is readable as soon as there is output, or it
+                # is closed. The timeout is only so cancelling is noticed.
+                try:
+                    select.select([chan], [], [], self.POLL_INTERVAL)
+                except select.error:
+                    # Interrupted by a signal
+                    continue
+                got_output = False
+                while chan.recv_ready():
+                    stdout.write(chan.recv(buff_size))
+                    got_output = True
+                while chan.recv_stderr_ready():
+                    stderr.write(chan.recv_stderr(buff_size))
+                    got_output = True
+                if chan.exit_status_ready():
+                    # Read any remaining data in the streams
+                    while chan.recv_ready():
+                        stdout.write(chan.recv(buff_size))
+                    while chan.recv_stderr_ready():
+                        stderr.write(chan.recv_stderr(buff_size))
+                    break
+                if not got_output and chan.eof_received:
+                    # The command closed its output but is still running, the
+                    # channel stays readable so wait for the exit status instead
+                    chan.status_event.wait(self.POLL_INTERVAL)
+            response['code'] = chan.recv_exit_status()
+        finally:
+            stdout.close()
+            stderr.close()
+            # The connection is kept for other actions, but not the channel
+            chan.close()
+
+        response.update({
+            'stdout': stdout.tail,
+            'stderr': stderr.tail,
+        })
         return response
 
 
@@ -183,39 +263,138 @@ class FetchFileAction(RemoteSSHAction):
     """
     Fetch a individual file or directory from a remote host.
 
-    Output locations are presumed to be accessable via scp.
-
-    scp -v -f -- src_file
+    Output locations are presumed to be accessable via sftp. The files of a
+    directory are fetched over FETCH_CONCURRENCY sftp sessions at once.
     """
     label = 'fetch_file'
 
+    FETCH_CONCURRENCY = 4
+    # Seconds between progress reports on stdout while fetching a directory
+    PROGRESS_INTERVAL = 2
+
     def __init__(self, *arg, **kwarg):
         super(FetchFileAction, self).__init__(*arg, **kwarg)
 
         self.path_to_fetch = kwarg['path']
         self.path_is_dir = kwarg.get('is_dir', False)
+        self.files_fetched = 0
+        self.bytes_fetched = 0
 
     def execute(self, stdoutlog, stderrlog, action_result):
-        with closing(self.get_ssh_connection()) as ssh:
+        with self.ssh_connection() as ssh:
             transport = ssh.get_transport()
 
             # TODO: catch sftp errors
-            sftp = paramiko.SFTPClient.from_transport(transport)
+            with closing(paramiko.SFTPClient.from_transport(transport)) as sftp:
+                local_path = self.fetch_output(self.path_to_fetch, self.path_is_dir,
+                        sftp, transport)
+
+        stdout, stderr = self.output_recorders()
+        if local_path is None:
+            return {
+                'code': 1,
+                'message': "%s isn't a %s" % (self.path_to_fetch,
+                    'directory' if self.path_is_dir else 'file'),
+            }
+        return {
+            'code': 0,
+            'message': 'Fetched %d files, %d bytes, to %s' % (
+                self.files_fetched, self.bytes_fetched, local_path),
+            'stdout': stdout.tail,
+            'streamed': True,
+        }
 
-            response = self.fetch_output(self.path_to_fetch, self.path_is_dir, sftp)
-        return response
+    def failure_message(self, action_result):
+        return 'Fetching "%s" from "%s@%s" failed.' % (
+                self.path_to_fetch, self.username, self.host)
 
-    def _copy_dir(self, sftp, src, dest):
-        file_list = sftp.listdir(path=src)
-        for f in file_list:
-            src_f = os.path.join(src,f)
-            dest_f = os.path.join(dest,f)
-            if S_ISDIR(sftp.stat(src_f).st_mode):
-                os.mkdir(os.path.join(dest,f))
-                self._copy_dir(sftp, src_f, dest_f)
-            sftp.get(remotepath=src_f, localpath=dest_f)
-
-    def fetch_output(self, p, is_dir, sftp):
+    def _list_dir(self, sftp, src, dest):
+        """
+        Make the directories under remote directory src in dest, and return
+        (remote path, local path, size) for each file to fetch into them.
+
+        listdir_attr gets the names, types and sizes of all the entries in a
+        directory in one request, instead of a stat for each. Only symlinks
+        need a stat, to follow them to what they point at.
+        """
+        files = []
+        for attr in sftp.listdir_attr(src):
+            src_f = os.path.join(src, attr.filename)
+            dest_f = os.path.join(dest, attr.filename)
+            if S_ISLNK(attr.st_mode):
+                attr = sftp.stat(src_f)
+            if S_ISDIR(attr.st_mode):
+                os.mkdir(dest_f)
+                files.extend(self._list_dir(sftp, src_f, dest_f))
+            else:
+                files.append((src_f, dest_f, attr.st_size))
+        return files
+
+    def _report_progress(self, total_files, total_bytes):
+        stdout, stderr = self.output_recorders()
+        stdout.write('Fetched %d/%d files, %d/%d bytes\n' % (
+            self.files_fetched, total_files, self.bytes_fetched, total_bytes))
+
+    def _fetch_files(self, files, sftp, transport=None):
+        """
+        Fetch (remote path, local path, size) files. With a transport, up to
+        FETCH_CONCURRENCY files are fetched at once, each session in a thread
+        of its own.
+        """
+        pending = Queue.Queue()
+        for f in files:
+            pending.put(f)
+        lock = threading.Lock()
+        errors = []
+        total_bytes = sum(size for remote, local, size in files)
+
+        def fetch(client):
+            while not self.cancelled and not errors:
+                try:
+                    remote, local, size = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                client.get(remotepath=remote, localpath=local)
+                with lock:
+                    self.files_fetched += 1
+                    self.bytes_fetched += size
+
+        def fetch_in_session():
+            try:
+                with closing(paramiko.SFTPClient.from_transport(transport)) as client:
+                    fetch(client)
+            except Exception, e:
+                with lock:
+                    errors.append(e)
+
+        sessions = min(self.FETCH_CONCURRENCY, len(files))
+        if transport is None or sessions <= 1:
+            fetch(sftp)
+        else:
+            threads = [threading.Thread(target=fetch_in_session) for i in range(sessions)]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            # Progress is recorded from this thread, which has the db connection
+            running = threads
+            while running:
+                running[0].join(self.PROGRESS_INTERVAL)
+                running = [t for t in running if t.is_alive()]
+                if running:
+                    self._report_progress(len(files), total_bytes)
+        if errors:
+            raise errors[0]
+        if self.cancelled:
+            raise Exception("Cancelled after fetching %d of %d files" % (
+                self.files_fetched, len(files)))
+        self._report_progress(len(files), total_bytes)
+
+    def fetch_output(self, p, is_dir, sftp, transport=None):
+        """
+        Fetch the file or directory at remote path p into a new directory in
+        ARTIFACT_DIR, returning the local path, or None if p isn't a directory
+        when is_dir or is one when not.
+        """
         # Assume that default directory is home of the login user
         location = p.replace('~', sftp.normalize('.'))
 
@@ -229,19 +408,13 @@ class FetchFileAction(RemoteSSHAction):
         dest = tempfile.mkdtemp(prefix=basename, dir=settings.ARTIFACT_DIR)
 
         if is_dir:
-            assert S_ISDIR(stat.st_mode)
-            self._copy_dir(sftp, location, dest)
+            if not S_ISDIR(stat.st_mode):
+                return None
+            self._fetch_files(self._list_dir(sftp, location, dest), sftp, transport)
             local_path = dest
         else:
             if S_ISDIR(stat.st_mode):
                 return None
             local_path = os.path.join(dest, basename)
-            sftp.get(remotepath=location, localpath=local_path)
-
-            # Code to read the file directly:
-            ## to copy file from remote to local
-            #f = sftp.open(location)
-            #content = f.read()
-            #f.close()
-            #return content
+            self._fetch_files([(location, local_path, stat.st_size)], sftp)
         return local_path
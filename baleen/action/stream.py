@@ -0,0 +1,97 @@
+import os
+import time
+import codecs
+import select
+import logging
+import subprocess
+
+from baleen.artifact.models import ActionOutput
+
+log = logging.getLogger('baleen.action')
+
+
+class OutputRecorder(object):
+    """
+    Records one output stream (e.g. stdout) of a running action.
+
+    Everything written goes straight to the live log file, and is appended
+    to the action's ActionOutput in chunks of at most FLUSH_SIZE characters, or
+    every FLUSH_INTERVAL seconds, so the output can be watched while the
+    action runs without the worker holding all of it in memory. Only the
+    last TAIL_SIZE characters are kept, for the action's response.
+    """
+    FLUSH_SIZE = 65536
+    FLUSH_INTERVAL = 2
+    TAIL_SIZE = 65536
+
+    def __init__(self, action_result, output_type, log_file=None):
+        self.action_result = action_result
+        self.output_type = output_type
+        self.log_file = log_file
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.buffer = []
+        self.buffered = 0
+        self.last_flush = time.time()
+        self.tail = u''
+        self.action_output = None
+
+    def write(self, data):
+        if self.log_file:
+            self.log_file.write(data)
+            self.log_file.flush()
+        text = self.decoder.decode(data)
+        if not text:
+            return
+        self.tail = (self.tail + text)[-self.TAIL_SIZE:]
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if (self.buffered >= self.FLUSH_SIZE
+                or time.time() - self.last_flush >= self.FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+        chunk = u''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if self.action_result is None:
+            return
+        if self.action_output is None:
+            self.action_output, created = ActionOutput.objects.get_or_create(
+                    action_result=self.action_result, output_type=self.output_type)
+        self.action_output.append(chunk)
+
+    def close(self):
+        tail = self.decoder.decode('', final=True)
+        if tail:
+            self.tail = (self.tail + tail)[-self.TAIL_SIZE:]
+            self.buffer.append(tail)
+        self.flush()
+
+
+def stream_process(process, stdout_recorder, stderr_recorder, read_size=65536):
+    """
+    Read process's stdout and stderr pipes as output arrives, passing it to
+    the recorders, until both are closed. Returns the exit status.
+    """
+    recorders = {
+        process.stdout.fileno(): stdout_recorder,
+        process.stderr.fileno(): stderr_recorder,
+    }
+    while recorders:
+        try:
+            readable, _, _ = select.select(recorders.keys(), [], [], 1)
+        except select.error:
+            # Interrupted by a signal
+            continue
+        for fd in readable:
+            data = os.read(fd, read_size)
+            if data:
+                recorders[fd].write(data)
+            else:
+                del recorders[fd]
+    stdout_recorder.flush()
+    stderr_recorder.flush()
+    return process.wait()
@@ -1,31 +1,59 @@
 import os
+import stat
+import time
 import unittest
+import threading
+import shutil
 import tempfile
+import subprocess
+import json
+import struct
+import tarfile
+import SocketServer
+import BaseHTTPServer
 
 from StringIO import StringIO
+from contextlib import closing
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.contrib.auth.models import User
 from django.utils.timezone import now
 
 from mock import Mock, patch
 
+import paramiko
+
 from baleen.action.ssh import RunCommandAction, FetchFileAction
 from baleen.action.project import CreateAction
 from baleen.action.docker import (
         TestWithComposeAction,
         BuildImageAction,
-        GetBuildArtifactAction
+        GetBuildArtifactAction,
+        TagGoodImageAction,
+        default_image,
+        build_cache_key,
+        docker_executor,
+        dockerfile_base_images,
+        prefetch_images,
+        pull_image,
+        start_prefetch,
         )
+from baleen.action import docker_api
 
+from baleen.action.executor import PlanExecutor
+from baleen.action.stream import OutputRecorder
 from baleen.action import (
+        Action,
+        ActionFailure,
         ActionPlan,
         DockerActionPlan
         )
 
 from baleen.project.models import Project, Hook, Credential, ActionResult
-from baleen.job.models import Job
+from baleen.job.models import Job, ImageBuild
 from baleen.artifact.models import output_types, XUnitOutput
+from baleen.utils import reset_gearman_clients
 
 class ActionPlanTest(TestCase):
 
@@ -66,6 +94,36 @@ class DockerActionPlanTest(TestCase):
         self.user.save()
         self.client.login(username='bob', password='bob')
 
+    def test_formulate_plan_timeouts(self):
+        self.create_plan("""
+timeout: 600
+build:
+    docker.example.com/blah:
+        context: .
+        timeout: 300
+    docker.example.com/other: other
+test:
+    timeout: 120
+    subject:
+        command: ./run_tests.sh
+artifacts:
+    xunit:
+        path: /app/xunit.xml
+        timeout: 30
+""")
+        steps = DockerActionPlan(self.job).formulate_plan()
+        timeouts = dict((s['name'], s.get('timeout')) for s in steps)
+        # Builds are independent, everything else waits on what's before it
+        self.assertEqual([s['depends_on'] for s in steps],
+                [[], [], [0, 1], [2], [0, 1, 2, 3]])
+        self.assertEqual(timeouts['Build docker image docker.example.com/blah'], 300)
+        self.assertEqual(timeouts['Build docker image docker.example.com/other'], None)
+        self.assertEqual(timeouts['Test with docker-compose'], 120)
+        self.assertEqual(timeouts['Get xunit build artifact: /app/xunit.xml'], 30)
+        test_step = [s for s in steps if s['action'] == 'test_with_compose'][0]
+        self.assertEqual(test_step['compose_data'].keys(), ['subject'])
+        self.assertEqual(self.job.timeout, 600)
+
     def test_formulate_blank_plan(self):
         self.create_plan('')
         ap = DockerActionPlan(self.job)
@@ -111,9 +169,66 @@ build:
         self.assertTrue(h)
 
 
+class PlanExecutorTest(unittest.TestCase):
+
+    def run_plan(self, steps, max_parallel, fail=None):
+        lock = threading.Lock()
+        events = []
+        running = set()
+        self.max_running = 0
+
+        def start_step(step):
+            events.append(('start', step['index']))
+            return step['index']
+
+        def run_step(step, started):
+            with lock:
+                running.add(started)
+                self.max_running = max(self.max_running, len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(started)
+                events.append(('done', started))
+            if started == fail:
+                raise ActionFailure('step %d failed' % started)
+
+        PlanExecutor(steps, max_parallel=max_parallel).run(start_step, run_step)
+        return events
+
+    def test_parallel(self):
+        steps = [
+            {'index': 0, 'depends_on': []},
+            {'index': 1, 'depends_on': []},
+            {'index': 2, 'depends_on': []},
+            {'index': 3, 'depends_on': [0, 1, 2]},
+            {'index': 4},
+        ]
+        events = self.run_plan(steps, max_parallel=2)
+        self.assertEqual(self.max_running, 2)
+        starts = [i for e, i in events if e == 'start']
+        self.assertEqual(starts, [0, 1, 2, 3, 4])
+        for index, depends_on in ((3, [0, 1, 2]), (4, [3])):
+            for d in depends_on:
+                self.assertTrue(events.index(('done', d)) < events.index(('start', index)))
+
+    def test_linear(self):
+        events = self.run_plan([{'index': 0}, {'index': 1}], max_parallel=4)
+        self.assertEqual(events, [('start', 0), ('done', 0), ('start', 1), ('done', 1)])
+
+    def test_failure(self):
+        steps = [
+            {'index': 0, 'depends_on': []},
+            {'index': 1, 'depends_on': []},
+            {'index': 2, 'depends_on': [0, 1]},
+        ]
+        with self.assertRaises(ActionFailure):
+            self.run_plan(steps, max_parallel=4, fail=0)
+
+
 class BaseActionTest(TestCase):
 
     def setUp(self):
+        reset_gearman_clients()
         self.project = Project(name='TestProject')
         self.project.save()
 
@@ -148,6 +263,143 @@ class ActionTest(BaseActionTest):
             })
         self.assertTrue(isinstance(action, CreateAction))
 
+    def test_load_actions(self):
+        from baleen.action import dispatch
+        with patch.object(dispatch, '_action_map', None):
+            with patch.object(dispatch, '_load_action_map') as load:
+                load.return_value = {'project': {'create': CreateAction}}
+                dispatch.load_actions()
+                dispatch.get_action_object({
+                    'group': 'project',
+                    'action': 'create',
+                    'project': 'TestProject',
+                    'name': 'build project',
+                    'index': 0
+                    })
+                self.assertEqual(load.call_count, 1)
+
+    def test_cancel(self):
+        action = CreateAction(project=self.project.name, index=0, name='TestAction')
+        p = action.popen(['sh', '-c', 'sleep 30 & sleep 30'])
+        action.cancel()
+        self.assertTrue(action.cancelled)
+        self.assertEqual(p.wait(), -15)
+        # Killing a finished process does nothing
+        action.cancel()
+
+    def test_run_command_streams_output(self):
+        class EchoAction(Action):
+            def execute(self, stdoutlog, stderrlog, action_result):
+                return self.run_command(['sh', '-c',
+                    'echo out; echo err >&2; echo "$GREETING"; exit 3'],
+                    env={'GREETING': 'hello'})
+
+        self.job.record_start(231)
+        action = EchoAction(project=self.project.name, index=0, name='Echo')
+        response = action.run(self.job)
+        self.assertEqual(response['code'], 3)
+        self.assertEqual(response['stdout'], 'out\nhello\n')
+        self.assertEqual(response['stderr'], 'err\n')
+
+        result = self.job.actionresult_set.get()
+        self.assertEqual(result.stdout.output, 'out\nhello\n')
+        self.assertEqual(result.stderr.output, 'err\n')
+        out_f, err_f = self.job.get_live_job_filenames(action)
+        with open(out_f) as f:
+            self.assertTrue(f.read().endswith('out\nhello\n'))
+
+    def test_output_recorder(self):
+        self.job.record_start(231)
+        action_result = self.job.record_action_start(
+                CreateAction(project=self.project.name, index=0, name='TestAction'))
+        log_file = StringIO()
+        recorder = OutputRecorder(action_result, output_types.STDOUT, log_file)
+        recorder.FLUSH_SIZE = 4
+        recorder.TAIL_SIZE = 5
+
+        recorder.write('ab')
+        self.assertEqual(action_result.stdout, None)
+        # A multibyte character split across reads
+        recorder.write('cd\xe2\x82')
+        self.assertEqual(action_result.stdout.output, 'abcd')
+        recorder.write('\xacef')
+        recorder.close()
+        self.assertEqual(action_result.stdout.output, u'abcd\u20acef')
+        self.assertEqual(recorder.tail, u'cd\u20acef')
+        self.assertEqual(log_file.getvalue(), 'abcd\xe2\x82\xacef')
+
+    def test_timeout(self):
+        class SleepAction(Action):
+            def execute(self, stdoutlog, stderrlog, action_result):
+                p = self.popen(['sleep', '30'])
+                p.wait()
+                return {'code': p.returncode}
+
+        self.job.record_start(231)
+        action = SleepAction(project=self.project.name, index=0, name='Sleep', timeout=0.2)
+        response = action.run(self.job)
+        self.assertTrue(response['timed_out'])
+        result = self.job.actionresult_set.get()
+        self.assertTrue(result.timed_out)
+        self.assertTrue('Timed out after 0.2 seconds' in result.message)
+
+        # Stopped because the whole job ran out of time
+        action = SleepAction(project=self.project.name, index=2, name='Sleep')
+        threading.Timer(0.2, action.time_out, args=("Job timed out after 60 seconds.",)).start()
+        action.run(self.job)
+        result = self.job.actionresult_set.get(index=2)
+        self.assertTrue(result.timed_out)
+        self.assertTrue('Job timed out after 60 seconds.' in result.message)
+
+        with self.settings(ACTION_TIMEOUT=120):
+            action = SleepAction(project=self.project.name, index=1, name='Sleep')
+            self.assertEqual(action.timeout, 120)
+
+
+class FakeChannel(object):
+    """
+    Stands in for a paramiko Channel, delivering one piece of stdout and
+    stderr each time it is read and then the exit status. Always readable.
+    """
+
+    def __init__(self, stdout, stderr, exit_status):
+        self.stdout = list(stdout)
+        self.stderr = list(stderr)
+        self.exit_status = exit_status
+        self.eof_received = False
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, 'x')
+
+    def fileno(self):
+        return self.read_fd
+
+    def exec_command(self, command):
+        pass
+
+    def recv_ready(self):
+        return bool(self.stdout)
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self.stderr)
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def exit_status_ready(self):
+        return not self.stdout and not self.stderr
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        if self.read_fd is not None:
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+            self.read_fd = self.write_fd = None
+
 
 class RunCommandActionTest(BaseActionTest):
 
@@ -176,6 +428,26 @@ class RunCommandActionTest(BaseActionTest):
 
         self.action.execute(stdout, stderr, None)
 
+    @patch('paramiko.RSAKey')
+    @patch('paramiko.SSHClient')
+    @patch('baleen.action.ssh.RunCommandAction._run_command')
+    def test_connections_shared_by_job(self, run_mock, ssh_mock, key_mock):
+        run_mock.return_value = {'code': 0}
+        self.job.record_start(231)
+        for i, host in enumerate(['a', 'a', 'b']):
+            action = RunCommandAction(project=self.project.name, index=i, name='TestAction',
+                    username='foo', host=host, command='true')
+            action.run(self.job)
+
+        # One connection for each host, kept open for the rest of the job
+        self.assertEqual(ssh_mock.return_value.connect.call_count, 2)
+        self.assertEqual([c[0][0] for c in ssh_mock.return_value.connect.call_args_list],
+                ['a', 'b'])
+        self.assertFalse(ssh_mock.return_value.close.called)
+
+        self.job.record_done()
+        self.assertEqual(ssh_mock.return_value.close.call_count, 2)
+
     def test_run_command(self):
         self.action = RunCommandAction(project=self.project.name, index=0, name='TestAction',
                 username='foo', command='echo "blah"')
@@ -183,19 +455,36 @@ class RunCommandActionTest(BaseActionTest):
         stdout = StringIO()
         stderr = StringIO()
         m = Mock()
-        chan = Mock()
-
+        chan = FakeChannel(['blah', 'blah'], ['argh', 'argh', 'argh'], 2)
         m.open_session.return_value = chan
-        chan.exit_status_ready.side_effect = [False, False, True]
-        chan.recv.side_effect = ['blah', 'blah']
-        chan.recv_ready.side_effect = [True, True, False]
-        chan.recv_stderr.side_effect = ['argh', 'argh', 'argh']
-        chan.recv_stderr_ready.side_effect = [True, True, True, False]
 
-        self.action._run_command('test', m, stdout, stderr)
+        self.job.record_start(231)
+        action_result = self.job.record_action_start(self.action)
+        started = time.time()
+        response = self.action._run_command('test', m, stdout, stderr, action_result)
+        # Output is read as soon as the channel is readable, without sleeping
+        self.assertTrue(time.time() - started < 0.5)
 
         self.assertEqual(stdout.getvalue(), 'blah'*2)
         self.assertEqual(stderr.getvalue(), 'argh'*3)
+        self.assertEqual(response['stdout'], 'blah'*2)
+        self.assertEqual(response['code'], 2)
+        self.assertTrue(response['streamed'])
+        self.assertEqual(action_result.stdout.output, 'blah'*2)
+        self.assertEqual(action_result.stderr.output, 'argh'*3)
+
+    def test_run_command_cancelled(self):
+        self.action = RunCommandAction(project=self.project.name, index=0, name='TestAction',
+                username='foo', command='sleep 100')
+        m = Mock()
+        chan = Mock()
+        m.open_session.return_value = chan
+        chan.exit_status_ready.return_value = False
+
+        self.action.cancel()
+        response = self.action._run_command('sleep 100', m)
+        self.assertEqual(response['code'], -1)
+        self.assertTrue(chan.close.called)
 
 
 class FetchFileActionTest(BaseActionTest):
@@ -213,6 +502,7 @@ class FetchFileActionTest(BaseActionTest):
     def test_fetch_output(self, tempfile_mock, ISDIR):
         sftp_mock = Mock()
         sftp_mock.normalize.return_value = 'robots'
+        sftp_mock.stat.return_value.st_size = 3
         tempfile_mock.mkdtemp.return_value = 'blahtempdir'
         path = '/rightnow'
 
@@ -222,31 +512,95 @@ class FetchFileActionTest(BaseActionTest):
         sftp_mock.stat.return_value = None
         self.assertEqual(self.action.fetch_output(path, False, sftp_mock), None)
 
-    @patch('baleen.action.ssh.S_ISDIR')
+    def sftp_attr(self, filename, mode, size=0):
+        attr = paramiko.SFTPAttributes()
+        attr.filename = filename
+        attr.st_mode = mode
+        attr.st_size = size
+        return attr
+
     @patch('os.mkdir')
-    def test_copy_dir(self, mkdir, ISDIR):
+    def test_list_dir(self, mkdir):
         sftp_mock = Mock()
-        sftp_mock.listdir.return_value = ['file1', 'file2']
-        ISDIR.return_value = False
-        self.action._copy_dir(sftp_mock, 'a', 'b')
-        self.assertTrue(sftp_mock.get.called)
+        sftp_mock.listdir_attr.side_effect = [
+            [self.sftp_attr('file1', stat.S_IFREG, 10), self.sftp_attr('sub', stat.S_IFDIR)],
+            [self.sftp_attr('file2', stat.S_IFREG, 5)],
+        ]
+        files = self.action._list_dir(sftp_mock, 'a', 'b')
+        self.assertEqual(files, [('a/file1', 'b/file1', 10), ('a/sub/file2', 'b/sub/file2', 5)])
+        mkdir.assert_called_once_with('b/sub')
+        # Sizes come from the listing, no stat per file
+        self.assertFalse(sftp_mock.stat.called)
+
+    @patch('os.mkdir')
+    def test_list_dir_follows_links(self, mkdir):
+        sftp_mock = Mock()
+        sftp_mock.listdir_attr.side_effect = [
+            [self.sftp_attr('linked', stat.S_IFLNK)],
+            [self.sftp_attr('file', stat.S_IFREG, 3)],
+        ]
+        sftp_mock.stat.return_value = self.sftp_attr('', stat.S_IFDIR)
+        files = self.action._list_dir(sftp_mock, 'a', 'b')
+        sftp_mock.stat.assert_called_once_with('a/linked')
+        self.assertEqual(files, [('a/linked/file', 'b/linked/file', 3)])
+
+    @patch('paramiko.SFTPClient')
+    def test_fetch_files_in_parallel(self, sftp_client):
+        sessions = []
+        def new_session(transport):
+            session = Mock()
+            sessions.append(session)
+            return session
+        sftp_client.from_transport.side_effect = new_session
+        files = [('r%d' % i, 'l%d' % i, i) for i in range(10)]
+
+        self.action._fetch_files(files, Mock(), Mock())
+        self.assertEqual(len(sessions), 4)
+        fetched = sorted(c[1]['remotepath'] for session in sessions
+                for c in session.get.call_args_list)
+        self.assertEqual(fetched, sorted(f[0] for f in files))
+        self.assertTrue(all(session.close.called for session in sessions))
+        self.assertEqual(self.action.files_fetched, 10)
+        self.assertEqual(self.action.bytes_fetched, 45)
+        # Reported along the way, depending on timing, and at the end
+        self.assertTrue(self.action.output_recorders()[0].tail.endswith(
+                'Fetched 10/10 files, 45/45 bytes\n'))
+
+    @patch('paramiko.SFTPClient')
+    def test_fetch_files_error(self, sftp_client):
+        sftp_client.from_transport.return_value.get.side_effect = IOError('gone')
+        with self.assertRaises(IOError):
+            self.action._fetch_files([('r', 'l', 1), ('r2', 'l2', 1)], Mock(), Mock())
 
     @patch('baleen.action.ssh.S_ISDIR')
     @patch('os.mkdir')
     def test_fetch_dir(self, mkdir, ISDIR):
         sftp_mock = Mock()
         sftp_mock.normalize.return_value = 'robots'
-        sftp_mock.listdir.return_value = ['file1', 'file2']
+        sftp_mock.listdir_attr.return_value = [self.sftp_attr('file1', 0), self.sftp_attr('file2', 0)]
         path = '/rightnow'
 
         ISDIR.return_value = False
-        with self.assertRaises(AssertionError):
-            self.action.fetch_output(path, True, sftp_mock)
+        self.assertEqual(self.action.fetch_output(path, True, sftp_mock), None)
 
-        ISDIR.side_effect = [True, True, False, False, False]
+        ISDIR.side_effect = [True, False, False]
         output_path = self.action.fetch_output(path, True, sftp_mock)
         self.assertTrue(output_path.startswith(
                 '/var/lib/baleen/build_artifacts/rightnow'))
+        self.assertEqual(sftp_mock.get.call_count, 2)
+
+    @patch('paramiko.SFTPClient')
+    @patch('baleen.action.ssh.FetchFileAction.fetch_output')
+    @patch('baleen.action.ssh.FetchFileAction.get_ssh_connection')
+    def test_execute(self, ssh_mock, fetch_mock, sftp_client):
+        fetch_mock.return_value = '/var/lib/baleen/build_artifacts/rightnowXYZ'
+        response = self.dir_action.execute(None, None, None)
+        self.assertEqual(response['code'], 0)
+        self.assertTrue(response['message'].startswith('Fetched 0 files, 0 bytes, to '))
+
+        fetch_mock.return_value = None
+        response = self.dir_action.execute(None, None, None)
+        self.assertEqual(response['code'], 1)
 
 
 class TestWithComposeActionTest(BaseActionTest):
@@ -289,7 +643,380 @@ class BuildImageActionTest(BaseActionTest):
         super(BuildImageActionTest, self).setUp()
 
         self.action = BuildImageAction(project=self.project.name, index=0,
-                name='BuildImageAction')
+                name='BuildImageAction', image='api', context='api')
+        self.job.build_definition = 'build:\n  api: api\ntest:\n  subject:\n    command: ./run_tests.sh\n'
+        self.job.record_start(231)
+        self.action.job = self.job
+
+    def test_build_cache_key(self):
+        repo = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repo)
+        subprocess.check_call(['git', 'init', '-q'], cwd=repo)
+        for path in ('api/Dockerfile', 'web/Dockerfile'):
+            os.makedirs(os.path.join(repo, os.path.dirname(path)))
+            with open(os.path.join(repo, path), 'w') as f:
+                f.write('FROM ubuntu\n')
+        git = ['git', '-c', 'user.name=baleen', '-c', 'user.email=baleen@example.com']
+        subprocess.check_call(git + ['add', '.'], cwd=repo)
+        subprocess.check_call(git + ['commit', '-q', '-m', 'initial'], cwd=repo)
+        self.job._job_dirs = {'build': repo}
+        step = {'image': 'api', 'context': 'api'}
+
+        key = build_cache_key(self.job, step)
+        self.assertEqual(len(key), 40)
+        self.assertNotEqual(build_cache_key(self.job, {'image': 'web', 'context': 'web'}), key)
+        # The whole repository as the context
+        self.assertNotEqual(build_cache_key(self.job, {'image': 'api', 'context': '.'}), None)
+
+        # Other images changing doesn't matter
+        with open(os.path.join(repo, 'web', 'Dockerfile'), 'a') as f:
+            f.write('RUN true\n')
+        subprocess.check_call(git + ['commit', '-q', '-a', '-m', 'web'], cwd=repo)
+        self.assertEqual(build_cache_key(self.job, step), key)
+
+        with open(os.path.join(repo, 'api', 'Dockerfile'), 'a') as f:
+            f.write('RUN true\n')
+        # Not committed
+        self.assertEqual(build_cache_key(self.job, step), None)
+        subprocess.check_call(git + ['commit', '-q', '-a', '-m', 'api'], cwd=repo)
+        self.assertNotEqual(build_cache_key(self.job, step), key)
+
+        self.assertEqual(build_cache_key(self.job, {'image': 'api', 'context': 'missing'}), None)
+
+    def previous_build(self):
+        previous_job = Job(project=self.project, success=True,
+                build_definition=self.job.build_definition)
+        previous_job.save()
+        return ImageBuild.objects.create(project=self.project, job=previous_job,
+                image='api', tag='baleen_%d' % previous_job.id, cache_key='k' * 40)
+
+    @patch('baleen.action.docker.build_cache_key')
+    @patch('baleen.action.Action.run_command')
+    def test_reuse_image(self, run_command, cache_key):
+        run_command.return_value = {'code': 0}
+        cache_key.return_value = 'k' * 40
+        previous = self.previous_build()
+
+        response = self.action.execute(None, None, None)
+        # Without --force, which docker 1.12 removed
+        self.assertEqual(run_command.call_args[0][0],
+                ['docker', 'tag', 'api:' + previous.tag, 'api:baleen_%d' % self.job.id])
+        self.assertTrue('reused image' in response['message'])
+        self.assertEqual(self.job.stash['images'],
+                {'api': {'cache_key': 'k' * 40, 'reused_from': previous.job_id, 'index': 0}})
+
+        # Every image was reused, so the tests and artifacts are skipped
+        test_action = TestWithComposeAction(project=self.project.name, index=1,
+                name='Test', compose_data='subject:\n  command: ./run_tests.sh\n')
+        test_action.job = self.job
+        response = test_action.execute(None, None, None)
+        self.assertEqual(response['code'], 0)
+        self.assertTrue(self.job.stash['tests_skipped'])
+        artifact_action = GetBuildArtifactAction(project=self.project.name, index=2,
+                name='Artifact', artifact_path='/tmp/blah', artifact_type='xunit')
+        artifact_action.job = self.job
+        self.assertTrue('Skipped' in artifact_action.execute(None, None, None)['message'])
+
+        # Once tagged, later jobs can reuse this job's image
+        tag_action = TagGoodImageAction(project=self.project.name, index=3, name='Tag')
+        tag_action.job = self.job
+        tag_action.execute(None, None, None)
+        self.assertEqual(ImageBuild.find(self.job, 'api', 'k' * 40).job, self.job)
+
+    @patch('baleen.action.Action.run_command')
+    def test_tag_every_image(self, run_command):
+        run_command.return_value = {'code': 0}
+        # Parallel builds can finish in any order
+        self.job.stash = {'docker_tag': 'baleen_1', 'images': {
+            'web': {'index': 1}, 'api': {'index': 0}}}
+        self.assertEqual(default_image(self.job.stash), 'web')
+
+        tag_action = TagGoodImageAction(project=self.project.name, index=3, name='Tag')
+        tag_action.job = self.job
+        self.assertEqual(tag_action.execute(None, None, None)['code'], 0)
+        self.assertEqual([c[0][0][-2:] for c in run_command.call_args_list],
+                [['api:baleen_1', 'api:latest'], ['web:baleen_1', 'web:latest']])
+
+    @patch('baleen.action.docker.build_cache_key')
+    @patch('baleen.action.Action.run_command')
+    def test_build_when_changed(self, run_command, cache_key):
+        run_command.return_value = {'code': 0}
+        cache_key.return_value = 'c' * 40
+        self.previous_build()
+
+        self.action.execute(None, None, None)
+        self.assertEqual(run_command.call_args[0][0][:2], ['docker', 'build'])
+        self.assertEqual(self.job.stash['images']['api']['reused_from'], None)
+
+    @patch('baleen.action.docker.build_cache_key')
+    @patch('baleen.action.Action.run_command')
+    def test_build_when_image_gone(self, run_command, cache_key):
+        run_command.side_effect = [{'code': 1}, {'code': 0}]
+        cache_key.return_value = 'k' * 40
+        self.previous_build()
+
+        self.action.execute(None, None, None)
+        self.assertEqual(run_command.call_args[0][0][:2], ['docker', 'build'])
+
+    def test_dockerfile_base_images(self):
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with closing(os.fdopen(fd, 'w')) as f:
+            f.write('ARG VERSION=14.04\n'
+                    'FROM --platform=linux/amd64 golang:1.4 AS builder\n'
+                    'RUN make\n'
+                    'from ubuntu:$VERSION\n'
+                    'FROM builder\n'
+                    'FROM docker.example.com:5000/base\n'
+                    'FROM scratch\n')
+        self.assertEqual(dockerfile_base_images(path),
+                ['golang:1.4', 'docker.example.com:5000/base'])
+        self.assertEqual(dockerfile_base_images(path + '.missing'), [])
+
+    @override_settings(DOCKER_REGISTRIES={'https://docker.example.com': {}})
+    def test_prefetch_images(self):
+        build_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, build_dir)
+        for context, base in (('api', 'ubuntu:14.04'),
+                ('web', 'docker.example.com/base'),
+                ('worker', 'docker.example.com/api'),
+                ('cron', 'docker.example.com/shared:1.0')):
+            os.makedirs(os.path.join(build_dir, context))
+            with open(os.path.join(build_dir, context, 'Dockerfile'), 'w') as f:
+                f.write('FROM %s\n' % base)
+        queued = Job(project=self.project)
+        queued.save()
+        queued._job_dirs = {'build': build_dir}
+
+        # Goes by the last imported baleen.yml until its own is imported
+        self.assertEqual(prefetch_images(queued), [])
+        self.job.import_build_definition('build:\n  docker.example.com/api: api\n'
+                '  web: web\n  worker: worker\n  cron: cron\n'
+                'test:\n  subject:\n    command: ./run_tests.sh\n')
+        ImageBuild.objects.create(project=self.project, job=self.job,
+                image='docker.example.com/shared', tag='baleen_1', cache_key='k' * 40)
+        # Images not in a known registry stay as they are on the docker host,
+        # as do the ones baleen builds and tags itself
+        self.assertEqual(prefetch_images(queued), ['docker.example.com/base'])
+        with self.settings(DOCKER_REGISTRIES={}):
+            self.assertEqual(prefetch_images(queued), [])
+
+    @override_settings(DOCKER_REGISTRIES={'https://docker.example.com': {}})
+    @patch('baleen.action.docker.build_cache_key')
+    @patch('baleen.action.Action.run_command')
+    def test_build_with_local_cache(self, run_command, cache_key):
+        run_command.return_value = {'code': 0}
+        cache_key.return_value = None
+        self.job.import_build_definition('build:\n  docker.example.com/api: api\n'
+                'test:\n  subject:\n    command: ./run_tests.sh\n')
+        self.job._job_dirs = {'build': '/nonexistent'}
+        # The image being built isn't pulled over its last good build
+        self.assertEqual(start_prefetch(self.job).images, [])
+
+        action = BuildImageAction(project=self.project.name, index=0,
+                name='BuildImageAction', image='docker.example.com/api', context='api')
+        action.job = self.job
+        action.execute(None, None, None)
+        self.assertEqual(run_command.call_args[0][0],
+                ['docker', 'build', '-t', 'docker.example.com/api:baleen_%d' % self.job.id, 'api'])
+
+        with self.settings(IMAGE_PREFETCH=False):
+            self.assertEqual(start_prefetch(self.job), None)
+
+
+class FakeDockerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        path = self.path.split('?', 1)[0]
+        self.server.requests.append((self.command, self.path, body))
+        response = self.server.routes.get((self.command, path), (404, '{"message": "No such thing"}'))
+        if callable(response):
+            response = response()
+        status, data = response
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if isinstance(data, list):
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in data:
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.flush()
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    do_POST = do_GET
+
+
+class FakeDockerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Answers Docker Engine API requests on a unix socket from routes """
+    daemon_threads = True
+
+    def __init__(self, path, routes):
+        SocketServer.UnixStreamServer.__init__(self, path, FakeDockerHandler)
+        self.routes = routes
+        self.requests = []
+        self.connections = 0
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on purpose
+        pass
+
+
+def docker_frame(stream_type, data):
+    return struct.pack('>BxxxL', stream_type, len(data)) + data
+
+
+class DockerAPITest(BaseActionTest):
+
+    def setUp(self):
+        super(DockerAPITest, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.routes = {}
+        self.server = FakeDockerServer(os.path.join(self.temp_dir, 'docker.sock'), self.routes)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(docker_api.get_client('unix://' + self.server.server_address).close)
+        settings_override = override_settings(DOCKER_EXECUTOR='api',
+                DOCKER_HOST='unix://' + self.server.server_address)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.job.stash = {'docker_image': 'docker.example.com:5000/api', 'docker_tag': 'baleen_1'}
+
+    def action(self, action_cls, **kwargs):
+        action = action_cls(project=self.project.name, index=0, name=action_cls.__name__, **kwargs)
+        action.job = self.job
+        return action
+
+    def test_split_image(self):
+        self.assertEqual(docker_api.split_image('api:latest'), ('api', 'latest'))
+        self.assertEqual(docker_api.split_image('docker.example.com:5000/api'),
+                ('docker.example.com:5000/api', None))
+
+    def test_build(self):
+        build_dir = os.path.join(self.temp_dir, 'build')
+        os.makedirs(os.path.join(build_dir, 'api', 'node_modules'))
+        for path in ('api/Dockerfile', 'api/.dockerignore', 'api/node_modules/x.js', 'api/debug.log'):
+            with open(os.path.join(build_dir, path), 'w') as f:
+                f.write('node_modules\n*.log\n' if path.endswith('ignore') else 'FROM ubuntu\n')
+        self.job._job_dirs = {'build': build_dir}
+        self.routes[('POST', '/build')] = (200, [
+            '{"stream": "Step 1 : FROM ubuntu\\n"}\r\n{"status": "Pulling", "id": "ab',
+            'c"}\r\n{"status": "Downloading", "id": "abc", "progressDetail": {"current": 1}}',
+            '{"stream": "Successfully built 123\\n"}',
+            ])
+        action = self.action(BuildImageAction, image='api', context='api')
+
+        response = action.execute(None, None, None)
+        self.assertEqual(response['code'], 0)
+        self.assertEqual(response['stdout'],
+                'Step 1 : FROM ubuntu\nabc: Pulling\nSuccessfully built 123\n')
+        method, path, body = self.server.requests[0]
+        self.assertTrue('t=api%3Abaleen_' + str(self.job.id) in path)
+        names = tarfile.open(fileobj=StringIO(body)).getnames()
+        self.assertEqual(sorted(names), ['.dockerignore', 'Dockerfile'])
+
+        self.routes[('POST', '/build')] = (200, ['{"error": "Oops", "errorDetail": {}}'])
+        response = self.action(BuildImageAction, image='api', context='api').execute(None, None, None)
+        self.assertEqual(response['code'], 1)
+        self.assertEqual(response['stderr'], 'Oops\n')
+
+    @patch('baleen.action.Action.run_command')
+    def test_test_with_compose(self, run_command):
+        run_command.return_value = {'code': 0}
+        self.job.build_definition = 'build:\n  api: api\n'
+        self.routes.update({
+            ('GET', '/containers/json'): (200, '[{"Id": "abc123"}]'),
+            ('GET', '/containers/abc123/json'): (200, '{"Config": {"Tty": false}}'),
+            ('GET', '/containers/abc123/logs'): (200, [
+                docker_frame(1, 'Ran 2 tests\n') + docker_frame(2, 'FAIL')[:6],
+                docker_frame(2, 'FAIL')[6:],
+                ]),
+            ('POST', '/containers/abc123/wait'): (200, '{"StatusCode": 3}'),
+            })
+        action = self.action(TestWithComposeAction, compose_data='subject:\n  command: ./run_tests.sh\n')
+
+        response = action.execute(None, None, None)
+        self.assertEqual(run_command.call_args[0][0][:2], ['docker-compose', '-f'])
+        self.assertEqual(self.job.stash['compose_test_container'], 'abc123')
+        self.assertEqual(response['stdout'], 'Ran 2 tests\n')
+        self.assertEqual(response['stderr'], 'FAIL')
+        self.assertEqual(response['code'], 3)
+        self.assertTrue('com.docker.compose.service%3Dsubject' in self.server.requests[0][1])
+        # Looking up the container shares a connection, streams get their own
+        self.assertEqual(self.server.connections, 3)
+
+    def test_pull_image(self):
+        self.routes[('POST', '/images/create')] = (200, [
+            '{"status": "Pulling from library/ubuntu", "id": "14.04"}',
+            '{"status": "Downloaded newer image for ubuntu:14.04"}',
+            ])
+        self.assertTrue(pull_image(self.job, 'docker.example.com:5000/api'))
+        method, path, body = self.server.requests[0]
+        self.assertTrue('fromImage=docker.example.com%3A5000%2Fapi' in path)
+        self.assertTrue('tag=latest' in path)
+
+        self.routes[('POST', '/images/create')] = (200, ['{"error": "not found"}'])
+        self.assertFalse(pull_image(self.job, 'api:latest'))
+        del self.routes[('POST', '/images/create')]
+        self.assertFalse(pull_image(self.job, 'api:latest'))
+
+    def test_cancel_wait(self):
+        exited = threading.Event()
+        self.addCleanup(exited.set)
+
+        def wait():
+            exited.wait(10)
+            return 200, '{"StatusCode": 0}'
+        self.routes[('POST', '/containers/abc123/wait')] = wait
+        action = self.action(TestWithComposeAction, compose_data='subject: {}\n')
+        threading.Timer(0.2, action.cancel).start()
+
+        started = time.time()
+        response = docker_executor(action).wait('abc123')
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(response['code'], -1)
+
+    def test_copy_artifact(self):
+        archive = StringIO()
+        with closing(tarfile.open(fileobj=archive, mode='w')) as tar:
+            info = tarfile.TarInfo('results.xml')
+            info.size = 8
+            tar.addfile(info, StringIO('<xunit/>'))
+        self.routes[('GET', '/containers/abc123/archive')] = (200, [archive.getvalue()])
+        self.job.stash['compose_test_container'] = 'abc123'
+        self.job._job_dirs = {'artifact': os.path.join(self.temp_dir, 'artifact')}
+        ar = ActionResult(action='Artifact', index=0, job=self.job, started_at=now())
+        ar.save()
+        action = self.action(GetBuildArtifactAction, artifact_path='/app/results.xml',
+                artifact_type='xunit')
+
+        response = action.execute(None, None, ar)
+        self.assertEqual(response['code'], 0)
+        self.assertEqual(self.server.requests[0][1],
+                '/containers/abc123/archive?path=%2Fapp%2Fresults.xml')
+        self.assertEqual(XUnitOutput.objects.get(action_result=ar).output, '<xunit/>')
+
+        del self.routes[('GET', '/containers/abc123/archive')]
+        response = self.action(GetBuildArtifactAction, artifact_path='/app/missing.xml',
+                artifact_type='xunit').execute(None, None, ar)
+        self.assertEqual(response['code'], 1)
 
 
 class GetBuildArtifactActionTest(BaseActionTest):
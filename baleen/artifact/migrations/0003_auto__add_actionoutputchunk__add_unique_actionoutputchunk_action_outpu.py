@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'ActionOutputChunk'
+        db.create_table(u'artifact_actionoutputchunk', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('action_output', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['artifact.ActionOutput'])),
+            ('seq', self.gf('django.db.models.fields.IntegerField')()),
+            ('offset', self.gf('django.db.models.fields.IntegerField')()),
+            ('data', self.gf('django.db.models.fields.TextField')()),
+        ))
+        db.send_create_signal(u'artifact', ['ActionOutputChunk'])
+
+        # Adding unique constraint on 'ActionOutputChunk', fields ['action_output', 'seq']
+        db.create_unique(u'artifact_actionoutputchunk', ['action_output_id', 'seq'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'ActionOutputChunk', fields ['action_output', 'seq']
+        db.delete_unique(u'artifact_actionoutputchunk', ['action_output_id', 'seq'])
+
+        # Deleting model 'ActionOutputChunk'
+        db.delete_table(u'artifact_actionoutputchunk')
+
+
+    models = {
+        u'artifact.actionoutput': {
+            'Meta': {'object_name': 'ActionOutput'},
+            'action_result': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['project.ActionResult']"}),
+            'data': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'output': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'output_type': ('django.db.models.fields.CharField', [], {'default': "'SO'", 'max_length': '2'})
+        },
+        u'artifact.actionoutputchunk': {
+            'Meta': {'ordering': "['action_output', 'seq']", 'unique_together': "(('action_output', 'seq'),)", 'object_name': 'ActionOutputChunk'},
+            'action_output': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['artifact.ActionOutput']"}),
+            'data': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'offset': ('django.db.models.fields.IntegerField', [], {}),
+            'seq': ('django.db.models.fields.IntegerField', [], {})
+        },
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Group']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Permission']"}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'job.job': {
+            'Meta': {'object_name': 'Job'},
+            'attempts': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'build_definition': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'build_definition_type': ('django.db.models.fields.CharField', [], {'max_length': '64', 'null': 'True', 'blank': 'True'}),
+            'cancel_requested_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'cancelled': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'commit': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'dispatched_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'docker_host': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'finished_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'github_data': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'lease_expires_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'manual_by': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']", 'null': 'True', 'blank': 'True'}),
+            'priority': ('django.db.models.fields.IntegerField', [], {'default': '20'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['project.Project']"}),
+            'received_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'rejected': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'started_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'stash': ('jsonfield.fields.JSONField', [], {'null': 'True', 'blank': 'True'}),
+            'success': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'superseded_by': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'superseded_jobs'", 'null': 'True', 'to': u"orm['job.Job']"}),
+            'worker_pid': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'})
+        },
+        u'project.actionresult': {
+            'Meta': {'ordering': "['job', 'started_at']", 'object_name': 'ActionResult'},
+            'action': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'action_slug': ('django.db.models.fields.CharField', [], {'max_length': '255', 'blank': 'True'}),
+            'finished_at': ('django.db.models.fields.DateTimeField', [], {'null': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'index': ('django.db.models.fields.IntegerField', [], {}),
+            'job': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['job.Job']"}),
+            'message': ('django.db.models.fields.TextField', [], {'blank': 'True'}),
+            'started_at': ('django.db.models.fields.DateTimeField', [], {}),
+            'status_code': ('django.db.models.fields.IntegerField', [], {'null': 'True'}),
+            'timed_out': ('django.db.models.fields.BooleanField', [], {'default': 'False'})
+        },
+        u'project.credential': {
+            'Meta': {'unique_together': "(('project', 'name'), ('user', 'name'))", 'object_name': 'Credential'},
+            'environment': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'project': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['project.Project']", 'null': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']", 'null': 'True'}),
+            'value': ('django.db.models.fields.TextField', [], {'max_length': '255'})
+        },
+        u'project.project': {
+            'Meta': {'object_name': 'Project'},
+            'branch': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'creator': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']", 'null': 'True'}),
+            'github_data_received': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'github_token': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'manual_config': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'private_key': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'private_key_for'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['project.Credential']"}),
+            'public_key': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'public_key_for'", 'null': 'True', 'on_delete': 'models.SET_NULL', 'to': u"orm['project.Credential']"}),
+            'repo_url': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'site_url': ('django.db.models.fields.URLField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['artifact']
\ No newline at end of file
@@ -68,6 +68,74 @@ class ActionOutput(models.Model):
                 self.get_output_type_display(),
                 self.action_result.action )
 
+    def _last_chunk(self):
+        return self.actionoutputchunk_set.order_by('-seq').first()
+
+    def append(self, data):
+        """
+        Add data to the end of the output as a new ActionOutputChunk, without
+        touching what is already stored. Output written this way is left out
+        of the `output` field, use read() or ActionResult.get_output to get it.
+        """
+        if not data:
+            return
+        if not hasattr(self, '_next_chunk'):
+            last = self._last_chunk()
+            if last is None:
+                self._next_chunk = (0, 0)
+            else:
+                self._next_chunk = (last.seq + 1, last.offset + len(last.data))
+        seq, offset = self._next_chunk
+        ActionOutputChunk.objects.create(action_output=self, seq=seq,
+                offset=offset, data=data)
+        self._next_chunk = (seq + 1, offset + len(data))
+
+    def read(self, offset=0):
+        """
+        Return the output from character offset onwards, reassembling it from
+        its chunks if it was appended a chunk at a time.
+        """
+        if self.output is not None:
+            return self.output[offset:]
+        chunks = self.actionoutputchunk_set.order_by('seq')
+        if offset:
+            first = chunks.filter(offset__lte=offset).order_by('-seq').first()
+            if first is not None:
+                chunks = chunks.filter(seq__gte=first.seq)
+        data = []
+        for chunk in chunks:
+            data.append(chunk.data[max(0, offset - chunk.offset):])
+        return u''.join(data)
+
+    @property
+    def length(self):
+        """ Number of characters of output stored """
+        if self.output is not None:
+            return len(self.output)
+        last = self._last_chunk()
+        if last is None:
+            return 0
+        return last.offset + len(last.data)
+
+
+class ActionOutputChunk(models.Model):
+    """
+    A piece of an ActionOutput that was saved while its action was still
+    running.
+
+    Chunks are only ever added, numbered by seq, and offset is the position of
+    the chunk's first character in the whole output, so output can be read
+    from any point without loading what comes before it.
+    """
+    action_output = models.ForeignKey(ActionOutput)
+    seq = models.IntegerField()
+    offset = models.IntegerField()
+    data = models.TextField()
+
+    class Meta:
+        ordering = ['action_output', 'seq']
+        unique_together = (('action_output', 'seq'),)
+
 
 class XUnitOutput(ActionOutput):
     objects = OutputManager(output_types.XUNIT)
@@ -49,6 +49,29 @@ class TestActionOutput(TestCase):
     def test_stderr(self):
         self.assertEqual(self.result.stderr.output, '')
 
+    def test_append_chunks(self):
+        self.job.record_action_start(self.action)
+        result = self.job.actionresult_set.latest('id')
+        output = ActionOutput.objects.create(action_result=result,
+                output_type=output_types.STDOUT)
+        output.append(u'abc')
+        output.append(u'')
+        output.append(u'defg')
+        # A new instance carries on from the last chunk
+        output = ActionOutput.objects.get(id=output.id)
+        output.append(u'h')
+
+        self.assertEqual([(c.seq, c.offset) for c in output.actionoutputchunk_set.all()],
+                [(0, 0), (1, 3), (2, 7)])
+        self.assertEqual(output.output, None)
+        self.assertEqual(output.length, 8)
+        self.assertEqual(output.read(), u'abcdefgh')
+        self.assertEqual(output.read(5), u'fgh')
+        self.assertEqual(output.read(3), u'defgh')
+        self.assertEqual(output.read(8), u'')
+        self.assertEqual(result.stdout.output, u'abcdefgh')
+        self.assertEqual(self.result.stdout.read(5), 'some output yo')
+
 
 class TestCoverageXMLOutput(TestCase):
 
@@ -8,5 +8,5 @@ class ActionResultInline(admin.ModelAdmin):
 
 class JobAdmin(admin.ModelAdmin):
     date_hierarchy = 'started_at'
-    list_display = ('id', 'project', 'started_at', 'success')
+    list_display = ('id', 'project', 'priority', 'docker_host', 'started_at', 'success')
 admin.site.register(Job, JobAdmin)
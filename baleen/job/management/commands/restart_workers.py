@@ -0,0 +1,54 @@
+import xmlrpclib
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = """
+Restart the baleen workers run by supervisord one at a time, so that there
+are always workers available to run jobs.
+
+Each worker is stopped with supervisord's stopsignal, which should be USR1
+so that the worker drains: it finishes the jobs it is running and then
+exits. See supervisord.conf.
+"""
+    option_list = BaseCommand.option_list + (
+            make_option('-u', '--url',
+                default=None,
+                action='store',
+                dest='url',
+                help="URL of supervisord's XML-RPC interface. "
+                     "Defaults to settings.SUPERVISOR_URL."
+            ),
+            make_option('-g', '--group',
+                default='worker',
+                action='store',
+                dest='group',
+                help="Supervisord program running the workers."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        url = options['url'] or settings.SUPERVISOR_URL
+        supervisor = xmlrpclib.ServerProxy(url).supervisor
+
+        try:
+            processes = [p for p in supervisor.getAllProcessInfo()
+                    if p['group'] == options['group']]
+        except (xmlrpclib.Error, IOError), e:
+            raise CommandError("Couldn't talk to supervisord at %s: %s" % (url, e))
+        if not processes:
+            raise CommandError("No processes in supervisord group %s" % options['group'])
+
+        for p in processes:
+            name = '%s:%s' % (p['group'], p['name'])
+            if p['statename'] == 'RUNNING':
+                print "Draining %s..." % name
+                # Blocks until the worker exits, or stopwaitsecs passes
+                supervisor.stopProcess(name, True)
+            print "Starting %s" % name
+            supervisor.startProcess(name, True)
+        print "Restarted %d workers" % len(processes)
@@ -1,21 +1,28 @@
 import os
+import time
+import errno
 import logging
 import sys
 import traceback
-import gearman
 import json
 import functools
+import threading
 
 from optparse import make_option
-from signal import signal, SIGTERM, SIGINT
+from signal import signal, SIGTERM, SIGINT, SIGUSR1, SIG_IGN
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
 
-from baleen.job.models import Job
+from baleen.job.models import Job, reap_expired_jobs
+from baleen.job.monitor import JobMonitor
+from baleen.job.queue import get_queue
 from baleen.project.models import ActionResult, Project
-from baleen.action.dispatch import get_action_object
-from baleen.utils import team_notify
+from baleen.action.dispatch import get_action_object, load_actions
+from baleen.action.docker import compose_down, start_prefetch
+from baleen.action.executor import PlanExecutor
+from baleen.utils import team_notify, get_docker_hosts
 
 import statsd
 from statsd.counter import Counter
@@ -26,29 +33,35 @@ log = logging.getLogger('baleen.worker')
 
 statsd.Connection.set_defaults(host='localhost', port=8125, sample_rate=1, disabled=True)
 
-class BaleenGearmanWorker(gearman.GearmanWorker):
-    def on_job_execute(self, current_job):
-        print "Job started"
-        return super(BaleenGearmanWorker, self).on_job_execute(current_job)
+# How often (in seconds) the worker wakes up from waiting on the queue to reap
+# finished job processes and look for jobs with expired leases.
+POLL_TIMEOUT = 5
 
-    def on_job_exception(self, current_job, exc_info):
-        result = str(exc_info)
-        return super(BaleenGearmanWorker, self).send_job_complete(
-                current_job, result)
 
-    def on_job_complete(self, current_job, job_result):
-        return super(BaleenGearmanWorker, self).send_job_complete(
-                current_job, job_result)
+def close_db_connections():
+    """
+    Close all database connections. Done before forking so that child
+    processes don't share (and later break) the parent's connection.
+    """
+    for conn in connections.all():
+        conn.close()
 
-    def after_poll(self, any_activity):
-        # Return True if you want to continue polling, replaces callback_fxn
-        return True
 
-gearman_worker = BaleenGearmanWorker([settings.GEARMAN_SERVER])
+class JobCancelled(Exception):
+    pass
+
 
 class Command(BaseCommand):
     help = """
 """
+    concurrency = 1
+    # Whether each job is run in a child process, see dispatch_job
+    fork_jobs = False
+    # Whether each job is run in a thread, see start_job_thread
+    thread_jobs = False
+    queue = None
+    # Set by SIGUSR1, see drain
+    draining = False
     option_list = BaseCommand.option_list + (
             make_option('-p', '--procnum',
                 default='0',
@@ -74,12 +87,52 @@ class Command(BaseCommand):
                 dest='keep',
                 help="Use with --build, won't delete the project after building it."
             ),
+            make_option('-n', '--concurrency',
+                default=None,
+                action='store',
+                type='int',
+                dest='concurrency',
+                help="Number of jobs to run at once, each in a child process. "
+                     "Defaults to settings.WORKER_CONCURRENCY."
+            ),
+            make_option('-d', '--docker-hosts',
+                default=None,
+                action='store',
+                dest='docker_hosts',
+                help="Comma separated names of the hosts in settings.DOCKER_HOSTS "
+                     "that this worker can reach. Defaults to all of them."
+            ),
+            make_option('-t', '--threads',
+                default=False,
+                action='store_true',
+                dest='threads',
+                help="Run concurrent jobs in threads of this process rather "
+                     "than in child processes."
+            ),
+            make_option('-w', '--warm',
+                default=False,
+                action='store_true',
+                dest='warm',
+                help="Load actions and log into docker registries at startup, "
+                     "then run every job in a child process that inherits them."
+            ),
         )
 
-    def _reset_jobs(self):
-        self.current_gearman_job = None
-        self.current_baleen_job = None
-        self.current_action = None
+    def _reset_jobs(self, job_id=None):
+        """
+        Forget about in-flight jobs, or just the job with job_id.
+
+        in_flight maps baleen job ids to a dict that may contain the
+        queue 'task' (only while its handler is still running the job, the
+        queue completes it once the handler returns), the baleen 'job', the
+        currently running 'actions', and,
+        when running concurrently, the 'pid' of the child process or the
+        'thread' running the job.
+        """
+        if job_id is None:
+            self.in_flight = {}
+        else:
+            self.in_flight.pop(job_id, None)
 
     def _get_statsd_counters(self, project):
         return {
@@ -105,36 +158,233 @@ class Command(BaseCommand):
         except Exception, e:
             print 'Error on team_notify: ' + str(e)
 
-    def run_task(self, worker, gm_job):
+    def run_task(self, task):
+        job_id = None
         try:
-            self.current_gearman_job = gm_job
-            task_data = json.loads(gm_job.data)
+            task_data = json.loads(task.data)
+            if task_data.get('job') and self.draining:
+                # Leave it for another worker
+                print "Draining, putting job %s back in the queue" % task_data['job']
+                Job.objects.get(id=task_data['job']).submit()
+                return ''
             if task_data.get('job'):
                 job_id = task_data.get('job')
+                if self.thread_jobs:
+                    return self.start_job_thread(job_id)
+                if self.fork_jobs:
+                    return self.dispatch_job(job_id)
+                self.in_flight[job_id] = {'task': task}
                 return self.run_job(job_id)
             else:
                 return "Unknown task type"
             print 'Task complete!'
         except Exception, e:
-            msg = "Unexpected error:" + sys.exc_info()[0]
+            msg = "Unexpected error:" + str(sys.exc_info()[0])
             msg += str(e)
             print msg
             traceback.print_tb(sys.exc_info()[2])
 
-            self.clear_current_action(msg)
+            if job_id is not None:
+                self.clear_current_action(job_id, msg)
+                self._reset_jobs(job_id)
+        return ''
+
+    def dispatch_job(self, job_id):
+        """
+        Hand the job to a child process, waiting for one of the running
+        children to finish if we are already running as many jobs as our
+        concurrency allows.
+
+        The parent keeps the queue connection and handles signals, the child
+        just runs the job and exits.
+        """
+        while len(self.child_pids()) >= self.concurrency:
+            self.reap_children(block=True)
+
+        close_db_connections()
+        pid = os.fork()
+        if pid == 0:
+            # Child: SIGTERM records the interruption of our own job, while
+            # SIGINT from a terminal is left to the parent to deal with.
+            signal(SIGTERM, self.clean_up)
+            signal(SIGINT, SIG_IGN)
+            signal(SIGUSR1, SIG_IGN)
+            self.concurrency = 1
+            self.fork_jobs = False
             self._reset_jobs()
+            self.in_flight[job_id] = {}
+            status = 1
+            try:
+                try:
+                    self.run_job(job_id)
+                except Exception, e:
+                    msg = "Unexpected error:" + str(sys.exc_info()[0])
+                    msg += str(e)
+                    print msg
+                    traceback.print_tb(sys.exc_info()[2])
+
+                    # A failed build has already been recorded by run_job
+                    if Job.objects.filter(worker_pid=os.getpid(), finished_at=None).exists():
+                        self.clear_current_action(job_id, msg)
+                # The job's outcome is recorded, whatever it was, so the parent
+                # only needs to step in if we didn't get this far
+                status = 0
+            finally:
+                close_db_connections()
+                os._exit(status)
+
+        print "Job %s handed to process %d" % (job_id, pid)
+        self.in_flight[job_id] = {'pid': pid}
+        # Return empty string since this is always invoked in background mode
         return ''
 
-    def _do_action(self, job, action, project_timer=None):
-        # record this process id so that we can kill it via the web interface
-        # supervisord will automatically create a replacement process.
+    def start_job_thread(self, job_id):
+        """
+        Run the job in a thread of this process, waiting for one of the
+        running jobs to finish if we are already running as many jobs as our
+        concurrency allows.
+
+        Jobs spend nearly all their time waiting on subprocesses, ssh channels
+        and the database, none of which hold up the other threads, so one
+        process can look after many of them without each carrying its own
+        copy of Django. Each thread uses its own database connection.
+        """
+        while len(self.job_threads()) >= self.concurrency:
+            self.reap_threads(timeout=1)
+
+        t = threading.Thread(target=self._run_job_thread, args=(job_id,),
+                name='job-%s' % job_id)
+        t.daemon = True
+        # The task is completed as soon as we return, so it isn't kept
+        self.in_flight[job_id] = {'thread': t}
+        t.start()
+        print "Job %s started in %s" % (job_id, t.name)
+        return ''
+
+    def _run_job_thread(self, job_id):
+        try:
+            self.run_job(job_id)
+        except Exception, e:
+            msg = "Unexpected error:" + str(sys.exc_info()[0])
+            msg += str(e)
+            print msg
+            traceback.print_tb(sys.exc_info()[2])
+
+            self.clear_current_action(job_id, msg)
+            self._reset_jobs(job_id)
+        finally:
+            connection.close()
+
+    def job_threads(self):
+        return [entry['thread'] for entry in self.in_flight.values()
+                if entry.get('thread')]
+
+    def reap_threads(self, timeout=0):
+        """
+        Forget jobs whose threads have finished, waiting up to timeout seconds
+        for one of them first.
+        """
+        threads = self.job_threads()
+        if threads and timeout:
+            threads[0].join(timeout)
+        for job_id, entry in self.in_flight.items():
+            thread = entry.get('thread')
+            if thread and not thread.is_alive():
+                self._reset_jobs(job_id)
+
+    def _in_flight_entry(self, job):
+        for entry in self.in_flight.values():
+            if entry.get('job') is job:
+                return entry
+        return self.in_flight.setdefault(job.id, {'job': job})
+
+    def child_pids(self):
+        return dict((entry['pid'], job_id)
+                for job_id, entry in self.in_flight.items()
+                if entry.get('pid'))
+
+    def reap_children(self, block=False):
+        """
+        Collect exited job processes so their slots can be reused.
+
+        If a child died without recording the outcome of its job (e.g. it
+        crashed or was SIGKILLed) then the job is marked as failed here.
+        """
+        children = self.child_pids()
+        while children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    break
+                if e.errno == errno.EINTR:
+                    # Interrupted by a signal, e.g. to drain
+                    continue
+                raise
+            if pid == 0:
+                break
+            job_id = children.pop(pid, None)
+            if job_id is None:
+                continue
+            if os.WIFSIGNALED(status):
+                print "Process %d running job %s was killed by signal %d" % (
+                        pid, job_id, os.WTERMSIG(status))
+            elif status != 0:
+                print "Process %d running job %s exited with status %d" % (
+                        pid, job_id, os.WEXITSTATUS(status))
+            if status != 0:
+                self.clear_current_action(job_id,
+                        "Worker process running the job exited unexpectedly.")
+                close_db_connections()
+            self._reset_jobs(job_id)
+            # Only wait for one child when blocking
+            block = False
+
+    def on_poll(self, any_activity):
+        self.reap_children()
+        self.reap_threads()
+        if time.time() - self.last_reaped > settings.JOB_LEASE_DURATION:
+            self.last_reaped = time.time()
+            for job in reap_expired_jobs():
+                print "Recovered job %d from a worker that stopped responding" % job.id
+            close_db_connections()
+        if self.draining and not self.in_flight:
+            print "Drained, exiting"
+            return False
+        return True
 
+    def drain(self, *args):
+        """
+        Stop taking new jobs, and exit once the jobs in flight have finished.
+        Used to restart workers without failing their jobs, see
+        restart_workers.
+        """
+        print "Draining, will exit once running jobs have finished"
+        self.draining = True
+        if self.queue:
+            self.queue.stop_taking_tasks()
+
+    def _start_action(self, job, action):
+        """
+        Create the Action for a plan step and record that it is starting.
+        Returns the Action and its ActionResult.
+        """
         log.debug("Doing action %s" % action)
+        entry = self._in_flight_entry(job)
+        if entry.get('cancelled'):
+            raise JobCancelled()
         a = get_action_object(action)
-        self.current_action = a
-        response = a.run(job)
+        action_result = job.record_action_start(a)
+        entry.setdefault('actions', []).append(a)
+        return a, action_result
+
+    def _run_action(self, job, a, action_result, project_timer=None):
+        entry = self._in_flight_entry(job)
+        try:
+            response = a.run(job, action_result)
+        finally:
+            entry['actions'].remove(a)
         log.debug("Action completed with response %s" % str(response))
-        self.current_action = None
 
         if response['code'] != 0:
 
@@ -145,23 +395,50 @@ class Command(BaseCommand):
             project_timer.intermediate(a.statsd_name)
         print "Action success."
 
+    def _do_action(self, job, action, project_timer=None):
+        a, action_result = self._start_action(job, action)
+        self._run_action(job, a, action_result, project_timer)
+
+    def _run_plan(self, job, actions, project_timer=None):
+        """ Run the steps of the job's action plan, in parallel where possible """
+        executor = PlanExecutor(actions)
+        executor.run(
+                lambda step: self._start_action(job, step),
+                lambda step, started: self._run_action(job, started[0], started[1], project_timer)
+                )
 
     def run_job(self, job_id):
         worker_pid = os.getpid()
-        job = Job.objects.get(id=job_id)
-
-        self.current_baleen_job = job
-
-        # Only one job per project!  Until we have per-project queues,
-        # just reject this job if there's already another one running
-        # for the same project.
-        if job.project.current_job():
-            print "Job already in progress!"
-            job.reject()
-            self._reset_jobs()
+        # The in_flight key for the job we were asked to run
+        task_job_id = job_id
+        requested_job = Job.objects.get(id=job_id)
+
+        # Don't let lower priority lanes starve, if a job has been waiting for
+        # too long then run it instead and put the requested job back.
+        starved_job = requested_job.starved_job()
+        if starved_job and requested_job.queued:
+            print "Job %s has waited too long, running it before job %s" % (starved_job.id, job_id)
+            requested_job.submit()
+            requested_job = starved_job
+
+        # Only one job per project! If the project is busy then the job waits
+        # in the project's queue and gets resubmitted when the running job is
+        # done. Otherwise we run whichever job is at the head of the queue.
+        job = requested_job.claim(worker_pid)
+        if job is None:
+            print "Job %s is queued behind another job for the same project" % requested_job.id
+            self._reset_jobs(task_job_id)
             return ''
+        if job.id != requested_job.id:
+            print "Job %s is ahead of job %s in the project queue" % (job.id, requested_job.id)
+        job_id = job.id
+
+        self.in_flight.setdefault(task_job_id, {})['job'] = job
 
-        print "Running job %s" % job_id
+        job.place(self.docker_hosts)
+        print "Running job %s on docker host %s" % (job_id, job.docker_host)
+        # Warm the docker host's cache while the code is checked out
+        start_prefetch(job)
 
         # Get statsd connections
         project_t = Timer('baleen.%s.duration' % job.project.statsd_name)
@@ -173,8 +450,11 @@ class Command(BaseCommand):
 
         project_t.start()
         all_t.start()
-        job.record_start(worker_pid)
 
+        monitor = JobMonitor(job,
+                on_cancel=functools.partial(self.cancel_job, job),
+                on_timeout=functools.partial(self.time_out_job, job))
+        monitor.start()
         try:
             sync_actions = job.checkout_repo_plan()
             for action in sync_actions:
@@ -182,53 +462,133 @@ class Command(BaseCommand):
 
             print "Finished sync with git"
 
-            actions = job.project.action_plan()
-            for action in actions:
-                self._do_action(job, action, project_t)
-
-            job.record_done()
+            actions = job.action_plan()
+            self._run_plan(job, actions, project_t)
         except Exception, e:
+            # The plan only raises once none of its steps are still running,
+            # so nothing is left using the job's checkout or connections.
+            if self.job_lost(job):
+                self._reset_jobs(task_job_id)
+                return ''
+            if self._in_flight_entry(job).get('cancelled'):
+                self.finish_cancelled_job(job)
+                self._reset_jobs(task_job_id)
+                return ''
+            job.record_done(success=False)
             self.notify(job.failure_message(html=False), color='red')
             raise e
+        finally:
+            monitor.stop()
 
+        if self.job_lost(job):
+            self._reset_jobs(task_job_id)
+            return ''
+        # Outside the try, a hook or queue error once the job is recorded
+        # mustn't turn a good build into a failed one.
+        job.record_done()
         self.notify(job.success_message(), color='green')
         all_t.stop()
         project_t.stop()
         counters['project']['success'] += 1
         counters['all']['success'] += 1
-        self._reset_jobs()
+        self._reset_jobs(task_job_id)
 
         print "Job completed."
         # Return empty string since this is always invoked in background mode, so
         # no-one would see the response anyway
         return ''
 
+    def job_lost(self, job):
+        """
+        Whether job was taken back from us after its lease expired, in which
+        case the outcome is no longer ours to record.
+        """
+        if job.renew_lease():
+            return False
+        print "Job %s was taken back after its lease expired, leaving it" % job.id
+        return True
+
+    def cancel_job(self, job):
+        """
+        Called from the job's monitor thread when the job has been cancelled.
+        Stops the action that is running, run_job then notices the
+        cancellation and cleans up instead of running the next action.
+        """
+        print "Cancelling job %s" % job.id
+        entry = self._in_flight_entry(job)
+        entry['cancelled'] = True
+        for action in list(entry.get('actions', [])):
+            action.cancel()
+
+    def time_out_job(self, job):
+        """ Called from the job's monitor thread when the job times out """
+        print "Job %s timed out" % job.id
+        entry = self._in_flight_entry(job)
+        entry['cancelled'] = True
+        entry['timed_out'] = "Job timed out after %s seconds." % job.timeout
+        for action in list(entry.get('actions', [])):
+            action.time_out(entry['timed_out'])
+
+    def finish_cancelled_job(self, job):
+        try:
+            compose_down(job)
+        except Exception, e:
+            print "Error cleaning up containers for job %s: %s" % (job.id, str(e))
+        timed_out = self._in_flight_entry(job).get('timed_out')
+        if timed_out:
+            job.record_interrupted(timed_out)
+            self.notify(job.failure_message(html=False), color='red')
+            print "Job %s timed out." % job.id
+        else:
+            job.record_cancelled()
+            print "Job %s cancelled." % job.id
+
     def handle(self, *args, **options):
-        self.current_gearman_job = None
-        self.current_baleen_job = None
-        self.current_action = None
+        self._reset_jobs()
 
         self.worker_process_number = options['worker_number']
+        self.concurrency = options['concurrency'] or settings.WORKER_CONCURRENCY
+        self.thread_jobs = options['threads']
+        # Children also keep a warm parent clear of anything a job leaves
+        # behind, and mean killing a job doesn't lose the warm start.
+        self.fork_jobs = not self.thread_jobs and (self.concurrency > 1 or options['warm'])
+        self.docker_hosts = None
+        if options['docker_hosts']:
+            self.docker_hosts = options['docker_hosts'].split(',')
+            unknown = set(self.docker_hosts) - set(get_docker_hosts())
+            if unknown:
+                raise CommandError("Unknown docker hosts: %s" % ', '.join(unknown))
 
         signal(SIGTERM, self.clean_up)
         signal(SIGINT, self.clean_up)
+        signal(SIGUSR1, self.drain)
 
         if options['build']:
             self.build(options['build'], keep_project=options['keep'])
             sys.exit(0)
         elif options['clear_jobs']:
             print "Removing all jobs in queue..."
-            gearman_worker.register_task(settings.GEARMAN_JOB_LABEL, functools.partial(self.clear_job))
+            handler = self.clear_job
         else:
             # Default is to wait for jobs
-            gearman_worker.register_task(settings.GEARMAN_JOB_LABEL, functools.partial(self.run_task))
+            handler = self.run_task
 
-        print "baleen worker reporting for duty, sir/m'am!"
-        gearman_worker.work()
+        if options['warm']:
+            print "Loading actions..."
+            load_actions()
+            close_db_connections()
 
-    def clear_job(self, worker, gm_job):
-        job_id = json.loads(gm_job.data).get('job_id', None)
-        result = "Clearing job for job_id %d" % str(job_id)
+        print "baleen worker reporting for duty, sir/m'am!"
+        if self.concurrency > 1:
+            print "Running up to %d jobs at once%s" % (self.concurrency,
+                    " in threads" if self.thread_jobs else "")
+        self.last_reaped = 0
+        self.queue = get_queue()
+        self.queue.work(handler, poll_callback=self.on_poll, poll_timeout=POLL_TIMEOUT)
+
+    def clear_job(self, task):
+        job_id = json.loads(task.data).get('job_id', None)
+        result = "Clearing job for job_id %s" % job_id
         return result
 
     def build(self, build_dir, keep_project=False):
@@ -248,8 +608,9 @@ class Command(BaseCommand):
         job = Job(project=p, manual_by=p.creator)
         job.save()
 
-        self.current_baleen_job = job
+        self.in_flight[job.id] = {'job': job}
 
+        monitor = None
         try:
             job._job_dirs = {
                     'build': build_dir,
@@ -258,6 +619,12 @@ class Command(BaseCommand):
                     'checkout': None
                     }
             job.record_start(os.getpid())
+            job.place()
+            # Renew the job's lease, or other workers would take it for lost
+            monitor = JobMonitor(job,
+                    on_cancel=functools.partial(self.cancel_job, job),
+                    on_timeout=functools.partial(self.time_out_job, job))
+            monitor.start()
 
             # import baleen file
             import_action_spec = {
@@ -269,10 +636,10 @@ class Command(BaseCommand):
                 }
             self._do_action(job, import_action_spec)
 
-            actions = job.project.action_plan()
-            for action in actions:
-                self._do_action(job, action)
+            actions = job.action_plan()
+            self._run_plan(job, actions)
 
+            monitor.stop()
             job.record_done()
             self._reset_jobs()
 
@@ -283,34 +650,67 @@ class Command(BaseCommand):
             print(msg)
             traceback.print_tb(sys.exc_info()[2])
 
-            self.clear_current_action(msg)
+            self.clear_current_action(job.id, msg)
             self._reset_jobs()
+        finally:
+            if monitor:
+                monitor.stop()
 
         if not keep_project:
             p.delete()
 
 
-    def clear_current_action(self, msg=None):
-        if self.current_action:
-            if msg is None:
-                msg = "Action was interrupted by kill/term signal."
-
+    def clear_current_action(self, job_id, msg=None):
+        """
+        Record that the in-flight job with job_id, and the action it is
+        currently running, didn't finish successfully.
+
+        When the job is being run by a child process, this process won't know
+        what action was running, so the job works it out from its in progress
+        action results.
+        """
+        if msg is None:
+            msg = "Action was interrupted by kill/term signal."
+
+        entry = self.in_flight.get(job_id, {})
+        job = entry.get('job')
+        if job is None and entry.get('pid'):
+            # The child may have run a job from further up the project queue
+            job = Job.objects.filter(worker_pid=entry['pid'], finished_at=None).first()
+        if job is None:
             try:
-                self.current_baleen_job.record_action_response(self.current_action, {
+                job = Job.objects.get(id=job_id)
+            except Job.DoesNotExist:
+                return
+        for action in list(entry.get('actions', [])):
+            try:
+                job.record_action_response(action, {
                     'success': False,
                     'message': msg,
                 })
             except ActionResult.DoesNotExist:
-                self.current_baleen_job.record_done(success=False)
-        elif self.current_baleen_job:
-            self.current_baleen_job.record_done(success=False)
+                pass
+        job.record_interrupted(msg)
+
+    def stop_child(self, pid):
+        try:
+            os.kill(pid, SIGTERM)
+            os.waitpid(pid, 0)
+        except OSError:
+            # Already gone
+            pass
 
     def clean_up(self, *args):
         print "Exiting, please wait while we update job status"
-        if self.current_baleen_job:
-            self.clear_current_action()
-        if self.current_gearman_job:
-            # We need to tell gearman to forget about this job
-            gearman_worker.send_job_complete(self.current_gearman_job, data='')
+        for job_id, entry in self.in_flight.items():
+            if entry.get('pid'):
+                self.stop_child(entry['pid'])
+            # Job threads die with us, but not the commands they started
+            for action in list(entry.get('actions', [])):
+                action.cancel()
+            self.clear_current_action(job_id)
+            if entry.get('task'):
+                # We need to tell the queue to forget about this job
+                get_queue().complete(entry['task'])
         self._reset_jobs()
         sys.exit(1)
@@ -1,13 +1,16 @@
 import os
 import sys
+import datetime
 import traceback
 import json
+import yaml
 import gearman
 import logging
 import signal
 import requests
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.utils.timezone import now
@@ -15,14 +18,37 @@ from django.core.urlresolvers import reverse
 from django.utils.safestring import mark_safe
 
 from baleen.artifact.models import ActionOutput, output_types
-from baleen.utils import mkdir_p
+from baleen.utils import mkdir_p, get_docker_hosts
+from baleen.job.queue import get_queue
 
 from jsonfield import JSONField
 
 log = logging.getLogger('baleen.job')
 
 
-def manual_run(project, user=None):
+class priorities(object):
+    """
+    Priority lanes for jobs, lower values are run first.
+    """
+    MANUAL = 10
+    PUSH = 20
+    TRIGGER = 30
+
+    DETAILS = (
+        (MANUAL, 'Manual deploy'),
+        (PUSH, 'Push'),
+        (TRIGGER, 'Dependency trigger'),
+    )
+
+    # How each lane is submitted to gearman
+    GEARMAN = {
+        MANUAL: gearman.PRIORITY_HIGH,
+        PUSH: gearman.PRIORITY_NONE,
+        TRIGGER: gearman.PRIORITY_LOW,
+    }
+
+
+def manual_run(project, user=None, priority=priorities.MANUAL):
     """ Manually instantiate a job for project """
     last_j = project.last_job()
     if last_j and last_j.github_data:
@@ -31,11 +57,29 @@ def manual_run(project, user=None):
         blank_job = Job(project=project, manual_by=user)
     else:
         blank_job = Job(project=project, manual_by=project.creator)
+    blank_job.priority = priority
     blank_job.save()
     blank_job.submit()
     return blank_job
 
 
+def submit_jobs(jobs):
+    """ Send several jobs to the queue in one go """
+    get_queue().submit(jobs)
+
+
+def reap_expired_jobs():
+    """
+    Find running jobs whose worker has stopped renewing their lease (probably
+    because it has died) and requeue or fail them.
+    """
+    expired = Job.objects.filter(finished_at=None, started_at__isnull=False,
+            lease_expires_at__lt=now())
+    recovered = [job for job in expired if job.recover(submit=False)]
+    submit_jobs([job for job in recovered if job.queued])
+    return recovered
+
+
 class Job(models.Model):
     """
     A job is a CI build based on a build definition within the project's repo.
@@ -47,10 +91,16 @@ class Job(models.Model):
 
     build_definition = models.TextField(null=True, blank=True)
     build_definition_type = models.CharField(max_length=64, null=True, blank=True) 
+    # Parsed from build_definition, and the action plan compiled from it,
+    # when the job imports its baleen.yml. See import_build_definition.
+    build_data = JSONField(blank=True, null=True)
+    plan = JSONField(blank=True, null=True)
 
     stash = JSONField(blank=True, null=True,
             help_text="Stash can have values written and read from during a build")
 
+    priority = models.IntegerField(choices=priorities.DETAILS, default=priorities.PUSH)
+
     received_at = models.DateTimeField(auto_now_add=True)
     started_at = models.DateTimeField(null=True, blank=True)
     finished_at = models.DateTimeField(null=True, blank=True)
@@ -59,20 +109,57 @@ class Job(models.Model):
     manual_by = models.ForeignKey(User, null=True, blank=True)
 
     rejected = models.BooleanField(default=False)
+
+    # A running job's worker keeps pushing this forward, if it passes then the
+    # worker is assumed dead and the job is requeued or failed.
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    # Set when the database queue hands the job to a worker, see
+    # baleen.job.queue.DatabaseQueue
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    # Set from the web interface to ask the job's worker to stop it
+    cancel_requested_at = models.DateTimeField(null=True, blank=True)
+    cancelled = models.BooleanField(default=False)
+    attempts = models.IntegerField(default=0,
+            help_text="How many times a worker has started this job")
+
+    superseded_by = models.ForeignKey('self', null=True, blank=True,
+            related_name='superseded_jobs',
+            help_text="A newer job for the same branch that this job was folded into")
     worker_pid = models.IntegerField(null=True, blank=True)
+    docker_host = models.CharField(max_length=255, null=True, blank=True,
+            help_text="Name of the docker host the job's images are built and tested on")
 
     def __unicode__(self):
         return "Job for '%s' at %s" % (self.project.name, unicode(self.received_at))
 
     def submit(self):
-        """ Send job to gearman """
-        gearman_client = gearman.GearmanClient([settings.GEARMAN_SERVER])
-        gearman_client.submit_job(settings.GEARMAN_JOB_LABEL, json.dumps({'job': self.id}), background=True)
+        """ Send job to the queue, in the lane for the job's priority """
+        get_queue().submit([self])
 
-    def save(self):
+    def starved_job(self):
+        """
+        Gearman always hands out jobs from higher priority lanes first, so a
+        steady stream of pushes could leave dependency triggered builds
+        waiting forever.
+
+        Return the longest waiting job from a lower priority lane, that has
+        been queued for more than settings.JOB_PRIORITY_AGING seconds and whose
+        project is free to run it, or None. Manual deploys never give way.
+        """
+        if self.priority == priorities.MANUAL:
+            return None
+        waited_since = now() - datetime.timedelta(seconds=settings.JOB_PRIORITY_AGING)
+        starved = Job.objects.filter(started_at=None, finished_at=None,
+                priority__gt=self.priority,
+                received_at__lt=waited_since).order_by('received_at', 'id')
+        for job in starved:
+            if not job.project.current_job():
+                return job
+
+    def save(self, *args, **kwargs):
         if self.build_definition_type is None:
             self.build_definition_type = self.detect_plan_type()
-        super(Job, self).save()
+        super(Job, self).save(*args, **kwargs)
 
     def detect_plan_type(self):
         # assume it's docker until we support new types
@@ -96,10 +183,31 @@ class Job(models.Model):
                 },
             ]
         
-    def action_plan(self):
+    def import_build_definition(self, raw_definition):
+        """
+        Store the job's baleen.yml, along with its parsed data and the action
+        plan compiled from it, so they don't need to be worked out again.
+        """
+        self.build_definition = raw_definition
+        self.build_data = yaml.safe_load(raw_definition)
+        self.plan = self.compile_plan()
+        self.save(update_fields=['build_definition', 'build_definition_type',
+            'build_data', 'plan'])
+
+    def get_build_data(self):
+        """ The parsed build definition, None if there isn't a valid one """
+        if self.build_data is None and self.build_definition:
+            # Imported before build_data was stored
+            try:
+                return yaml.safe_load(self.build_definition)
+            except yaml.YAMLError:
+                return None
+        return self.build_data
+
+    def compile_plan(self):
         """
         Work out what kind of build definition we're working with and return
-        the appropriate ActionPlan instance.
+        the plan of the appropriate ActionPlan.
         """
         from baleen.action import DockerActionPlan
         if not self.build_definition:
@@ -112,15 +220,30 @@ class Job(models.Model):
 
         return plan.formulate_plan()
 
+    def action_plan(self):
+        """ The steps of the job's action plan """
+        if self.plan is not None:
+            return self.plan
+        return self.compile_plan()
+
     def record_action_start(self, action):
         from baleen.project.models import ActionResult
         a = ActionResult(action=action.name, index=action.index, job=self, started_at=now())
         a.save()
         return a
 
-    def record_action_response(self, action, response):
+    def record_action_response(self, action, response, action_result=None):
+        """
+        Record how action finished, and any output in response, in a single
+        transaction. The job isn't finished here, even if the action failed,
+        see record_done. action_result is the ActionResult from
+        record_action_start, otherwise the one Action.run recorded or, failing
+        that, the one with the action's name and index is used.
+        """
         from baleen.project.models import ActionResult
-        a = ActionResult.objects.get(action=action.name, index=action.index, job=self)
+        a = action_result or getattr(action, 'action_result', None)
+        if a is None or a.job_id != self.id:
+            a = ActionResult.objects.get(action=action.name, index=action.index, job=self)
 
         log.debug("Got matching action result %s" % str(a))
 
@@ -137,38 +260,129 @@ class Job(models.Model):
             #raise Exception('Support hooks')
             pass
 
-        log.debug("Setting finished to timestamp now")
         a.finished_at = now()
+        a.timed_out = response.get('timed_out', False)
 
         # Handle adding a summary message
         if not a.success:
-            log.debug("Creating failure message")
             a.message = action.failure_message(a)
-        log.debug("Adding response message to actionresult")
         a.message += (' ' + response.get('message', ''))
 
-        if not a.success:
-            # If a action belonging to this job fails, then the whole job is marked
-            # unsuccessful
-            log.debug("No success so record job done.")
-            self.record_done(success=False)
+        with transaction.atomic():
+            a.save(update_fields=['status_code', 'finished_at', 'timed_out', 'message'])
+            self._record_action_outputs(a, response)
 
-        log.debug("Saving action result")
-        a.save()
+        # A failed action fails the job, but the job is only recorded as done
+        # by whatever runs it, once none of its actions are still running.
+        return a
 
-        for stdio, out_type in (('stderr', output_types.STDERR), ('stdout', output_types.STDOUT)):
-            a_std, created = ActionOutput.objects.get_or_create(action_result=a, output_type=out_type)
-            a_std.output=response.get(stdio,'')
-            log.debug("Got output %s and added to actionoutput" % stdio)
-            a_std.save()
-            log.debug("Saved %s" % stdio)
+    def _record_action_outputs(self, a, response):
+        new_outputs = []
+        stdio = {}
+        if not response.get('streamed'):
+            # Streamed output was saved while the action ran, and response only
+            # has its tail
+            stdio = {
+                output_types.STDOUT: response.get('stdout'),
+                output_types.STDERR: response.get('stderr'),
+            }
+            existing = dict(ActionOutput.objects.filter(action_result=a,
+                    output_type__in=stdio.keys()).values_list('output_type', 'id'))
+            for output_type, output in stdio.items():
+                if output_type not in existing:
+                    new_outputs.append(ActionOutput(action_result=a,
+                        output_type=output_type, output=output or ''))
+                elif output is not None:
+                    ActionOutput.objects.filter(id=existing[output_type]).update(output=output)
 
         for output_type, the_output in response.get('output', {}).items():
             # Check we are expecting output for this action
-            ao = ActionOutput(output=the_output, action_result=a, output_type=output_type)
-            ao.save()
+            new_outputs.append(ActionOutput(output=the_output, action_result=a,
+                output_type=output_type))
 
-        return a
+        if new_outputs:
+            ActionOutput.objects.bulk_create(new_outputs)
+
+    @property
+    def branch_ref(self):
+        if self.github_data:
+            return self.github_data.get('ref')
+
+    def supersede_pending(self):
+        """
+        Coalesce builds: older jobs for the same project and branch that
+        haven't started yet are marked as superseded by this job and will
+        never run. Their commits are folded into this job's github_data so
+        that the commit list and compare url cover all of them, and this job
+        takes the most urgent of their priorities, so that a manual deploy
+        waiting in the queue doesn't drop to the push lane.
+
+        Returns the list of superseded jobs.
+        """
+        ref = self.branch_ref
+        if ref is None:
+            return []
+
+        pending = Job.objects.filter(project=self.project_id,
+                started_at=None, finished_at=None,
+                received_at__lte=self.received_at
+                ).exclude(id=self.id).order_by('received_at', 'id')
+
+        superseded = []
+        for job in pending:
+            if job.branch_ref != ref:
+                continue
+            # Only supersede the job if a worker hasn't started it meanwhile
+            updated = Job.objects.filter(id=job.id, started_at=None).update(
+                    finished_at=now(), superseded_by=self)
+            if updated:
+                superseded.append(job)
+
+        if superseded:
+            self._fold_github_data([j.github_data for j in superseded])
+            self.priority = min([self.priority] + [j.priority for j in superseded])
+            self.save()
+            log.debug("Job %d superseded jobs %s" % (self.id, [j.id for j in superseded]))
+        return superseded
+
+    def _fold_github_data(self, older_github_data):
+        data = self.github_data
+        commits = []
+        seen = set()
+        for d in older_github_data + [dict(data)]:
+            for c in d.get('commits', []):
+                if c.get('id') in seen:
+                    continue
+                seen.add(c.get('id'))
+                commits.append(c)
+        data['commits'] = commits
+
+        # Compare from before the oldest push
+        before = older_github_data[0].get('before')
+        if before and data.get('after') and data.get('compare'):
+            base_url = data['compare'].rsplit('/', 1)[0]
+            data['compare'] = '%s/%s...%s' % (base_url, before[:12], data['after'][:12])
+            data['before'] = before
+        self.github_data = data
+
+    def claim(self, pid):
+        """ Try to start the next job in this job's project queue.
+
+        Jobs for a project run one at a time, in the order they were received.
+        The job started is the oldest queued job for the project, which isn't
+        necessarily this one. If the project already has a running job then
+        nothing is started and None is returned, the queue will be kicked off
+        again when the running job calls record_done.
+        """
+        from baleen.project.models import Project
+        with transaction.atomic():
+            project = Project.objects.select_for_update().get(id=self.project_id)
+            if project.current_job():
+                return None
+            job = project.next_queued_job()
+            if job is not None:
+                job.record_start(pid)
+            return job
 
     def record_start(self, pid):
         """ Indicate that this job is going to now be run. It is active.
@@ -184,16 +398,144 @@ class Job(models.Model):
         self.success = False
         self.worker_pid = pid
         self.finished_at = None
+        self.lease_expires_at = self.new_lease_expiry()
+        self.attempts += 1
         self.stash = {}
         self.save()
 
-    def record_done(self, success=True):
-        self.success = success
-        self.finished_at = now()
-        self.worker_pid = None
+    @staticmethod
+    def new_lease_expiry():
+        return now() + datetime.timedelta(seconds=settings.JOB_LEASE_DURATION)
+
+    def renew_lease(self):
+        """
+        Returns False if the job is no longer running, or no longer this
+        attempt's: the reaper has taken it back, or another worker has since
+        claimed it.
+        """
+        expires_at = self.new_lease_expiry()
+        renewed = Job.objects.filter(id=self.id, finished_at=None,
+                started_at__isnull=False, lease_expires_at__isnull=False,
+                attempts=self.attempts, worker_pid=self.worker_pid
+                ).update(lease_expires_at=expires_at)
+        if renewed:
+            self.lease_expires_at = expires_at
+        return bool(renewed)
+
+    def place(self, host_names=None):
+        """
+        Choose the docker host to run this job on, from host_names, or any
+        host in settings.DOCKER_HOSTS if not given.
+
+        The host with the lowest ratio of running jobs to the number of builds
+        it can handle is picked, with ties going to the host with more cpus
+        and memory. If every host is at capacity then the least loaded is
+        used anyway.
+        """
+        hosts = get_docker_hosts()
+        if host_names:
+            hosts = dict((n, hosts[n]) for n in host_names if n in hosts)
+
+        running = dict(
+                (r['docker_host'], r['running']) for r in
+                Job.objects.filter(started_at__isnull=False, finished_at=None,
+                    docker_host__in=hosts.keys()
+                    ).exclude(id=self.id).values('docker_host').annotate(running=Count('id'))
+                )
+
+        def load(name):
+            details = hosts[name]
+            builds = details.get('builds')
+            n = running.get(name, 0)
+            full = builds is not None and n >= builds
+            ratio = float(n) / builds if builds else n
+            return (full, ratio, -details.get('cpus', 0), -details.get('memory', 0), name)
+
+        self.docker_host = min(hosts, key=load)
+        if load(self.docker_host)[0]:
+            log.warning("All docker hosts are busy, placing job %d on %s anyway" % (
+                self.id, self.docker_host))
         self.save()
+        return self.docker_host
+
+    @property
+    def docker_url(self):
+        """ The DOCKER_HOST for the daemon the job was placed on """
+        details = get_docker_hosts().get(self.docker_host)
+        if details is None:
+            return getattr(settings, 'DOCKER_HOST', '')
+        return details['url']
+
+    def recover(self, submit=True):
+        """
+        Deal with a job whose worker has stopped renewing its lease.
+
+        The job is put back in the queue if it has any attempts left,
+        otherwise it is marked as failed. Jobs someone asked to cancel are
+        recorded as cancelled instead. Returns False if another worker dealt
+        with the job first. Pass submit=False to send requeued jobs to
+        gearman yourself, e.g. with submit_jobs.
+        """
+        # Make sure another worker's reaper hasn't got to the job first
+        recovered = Job.objects.filter(id=self.id, finished_at=None,
+                lease_expires_at=self.lease_expires_at).update(lease_expires_at=None)
+        if not recovered:
+            return False
+        self.lease_expires_at = None
+
+        msg = "The worker running this job stopped responding."
+        requeued = False
+        if self.attempts < settings.JOB_MAX_ATTEMPTS:
+            # Only update what is reset, this instance may be stale and a
+            # cancel can come in at any time.
+            requeued = Job.objects.filter(id=self.id, cancel_requested_at=None
+                    ).update(started_at=None, worker_pid=None)
+        cancel_requested_at = Job.objects.filter(id=self.id
+                ).values_list('cancel_requested_at', flat=True)[0]
+        if requeued:
+            log.warning("Requeuing job %d after its lease expired" % self.id)
+            for a in self.actionresult_set.filter(finished_at=None):
+                a.status_code = -1
+                a.finished_at = now()
+                a.message = msg + " The job was requeued."
+                a.save()
+            self.started_at = None
+            self.worker_pid = None
+            if submit:
+                self.submit()
+        elif cancel_requested_at:
+            log.warning("Cancelling job %d after its lease expired" % self.id)
+            self.cancel_requested_at = cancel_requested_at
+            self.record_cancelled()
+        else:
+            log.warning("Failing job %d after its lease expired" % self.id)
+            self.record_interrupted(msg)
+        return True
 
-        if not success and settings.MAILGUN_KEY:
+    def record_done(self, success=True):
+        from baleen.project.models import Project
+        from baleen.action.ssh import close_ssh_pool
+        close_ssh_pool(self.id)
+        was_running = self.finished_at is None
+        with transaction.atomic():
+            # Lock the project so that a job being claimed at the same time
+            # either sees this one as still running, or gets started by us.
+            project = Project.objects.select_for_update().get(id=self.project_id)
+            self.success = success
+            self.finished_at = now()
+            self.worker_pid = None
+            self.lease_expires_at = None
+            self.save()
+            next_job = project.next_queued_job() if was_running else None
+
+        if next_job:
+            log.debug("Submitting next queued job %d for project %s" % (next_job.id, project.name))
+            next_job.submit()
+
+        if success and was_running:
+            self.trigger_hooks()
+
+        if not success and not self.cancelled and settings.MAILGUN_KEY:
             commits = None
             if self.github_data:
                 commits = self.github_data.get('commits')
@@ -217,6 +559,33 @@ class Job(models.Model):
                 traceback.print_tb(sys.exc_info()[2])
 
 
+    def trigger_hooks(self):
+        """
+        Queue builds of the projects waiting on this project to build, in the
+        dependency trigger lane. See DockerActionPlan.formulate_plan.
+        """
+        from baleen.project.models import Hook
+        for hook in Hook.objects.filter(project=self.project_id, trigger_build__isnull=False):
+            hook.activate()
+            if hook.one_off:
+                hook.delete()
+
+    def record_interrupted(self, msg):
+        """
+        Mark any actions still in progress, and the job itself, as failed.
+
+        Used when whatever was running the job has gone away without getting
+        a chance to record a response for the action it was running.
+        """
+        if self.done or not self.started_at:
+            return
+        for a in self.actionresult_set.filter(finished_at=None):
+            a.status_code = -1
+            a.finished_at = now()
+            a.message = msg
+            a.save()
+        self.record_done(success=False)
+
     @property
     def job_dirs(self):
         if hasattr(self, '_job_dirs'):
@@ -239,6 +608,14 @@ class Job(models.Model):
     def done(self):
         return self.finished_at is not None
 
+    @property
+    def queued(self):
+        return self.started_at is None and self.finished_at is None
+
+    @property
+    def superseded(self):
+        return self.superseded_by_id is not None
+
     def reject(self):
         self.started_at = now()
         self.finished_at = now()
@@ -246,7 +623,57 @@ class Job(models.Model):
         self.success = False
         self.save()
 
+    def cancel(self):
+        """
+        Stop the job. A queued job is marked as cancelled straight away,
+        while a running job is flagged so that the worker running it notices
+        (see JobMonitor), kills what the job is running and records the
+        cancellation itself.
+        """
+        cancelled = Job.objects.filter(id=self.id, started_at=None, finished_at=None
+                ).update(cancelled=True, success=False, started_at=now(), finished_at=now())
+        if not cancelled:
+            Job.objects.filter(id=self.id, finished_at=None
+                    ).update(cancel_requested_at=now())
+
+    def cancel_requested(self):
+        return Job.objects.filter(id=self.id, finished_at=None,
+                cancel_requested_at__isnull=False).exists()
+
+    @property
+    def timeout(self):
+        """
+        Seconds the job can run for, from "timeout:" in baleen.yml or
+        settings.JOB_TIMEOUT
+        """
+        build_data = self.get_build_data()
+        if isinstance(build_data, dict) and build_data.get('timeout'):
+            return build_data['timeout']
+        return settings.JOB_TIMEOUT
+
+    def timed_out(self):
+        """ Whether the running job has gone past its timeout """
+        # The build definition is imported while the job runs, so reload it
+        job = Job.objects.filter(id=self.id, finished_at=None).only(
+                'started_at', 'build_definition', 'build_data').first()
+        if job is None or not job.started_at or not job.timeout:
+            return False
+        return now() - job.started_at > datetime.timedelta(seconds=job.timeout)
+
+    def record_cancelled(self):
+        """ Called by the worker once it has stopped a cancelled job """
+        if self.done:
+            return
+        for a in self.actionresult_set.filter(finished_at=None):
+            a.status_code = -1
+            a.finished_at = now()
+            a.message = "Job was cancelled."
+            a.save()
+        self.cancelled = True
+        self.record_done(success=False)
+
     def kill(self):
+        """ Terminate the whole worker process running this job, see cancel """
         try:
             if self.finished_at == None and self.worker_pid:
                 os.kill(self.worker_pid, signal.SIGTERM)
@@ -256,12 +683,19 @@ class Job(models.Model):
             pass
         self.record_done(success=False)
 
-    def get_live_job_filenames(self):
+    def get_live_job_filenames(self, action=None):
+        """
+        Files the running action's output is teed to. Each action gets its own
+        pair, since parallel steps run at the same time.
+        """
         p = self.project
         log_dir = self.job_dirs['logs']
         mkdir_p(log_dir)
-        out_f = os.path.join(log_dir, '%s-%s-stdout.log' % (p.name, p.id))
-        err_f = os.path.join(log_dir, '%s-%s-stderr.log' % (p.name, p.id))
+        name = '%s-%s' % (p.name, p.id)
+        if action is not None:
+            name += '-%s' % action.index
+        out_f = os.path.join(log_dir, '%s-stdout.log' % name)
+        err_f = os.path.join(log_dir, '%s-stderr.log' % name)
         return out_f, err_f
 
     def get_action_results_with_output(self, output_type):
@@ -324,7 +758,8 @@ class Job(models.Model):
 
     @property
     def ordered_actions(self):
-        return self.actionresult_set.order_by('started_at')
+        # Steps started together are recorded in plan order
+        return self.actionresult_set.order_by('started_at', 'id')
 
     def get_absolute_url(self):
         return reverse(
@@ -333,3 +768,29 @@ class Job(models.Model):
                     project_id=self.project.id,
                     job_id=self.id
                 ))
+
+
+class ImageBuild(models.Model):
+    """
+    A docker image from a successful job, recorded so that later jobs whose
+    source for the image hasn't changed can reuse it instead of building it
+    again. See BuildImageAction.
+    """
+    project = models.ForeignKey('project.Project')
+    job = models.ForeignKey(Job)
+    image = models.CharField(max_length=255)
+    tag = models.CharField(max_length=255)
+    # Identifies the source the image was built from, see build_cache_key
+    cache_key = models.CharField(max_length=40, db_index=True)
+    docker_host = models.CharField(max_length=255, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return "%s:%s" % (self.image, self.tag)
+
+    @classmethod
+    def find(cls, job, image, cache_key):
+        """ The latest build of image with cache_key on job's docker host """
+        return cls.objects.filter(project=job.project_id, image=image,
+                cache_key=cache_key, docker_host=job.docker_host
+                ).order_by('-created_at', '-id').first()
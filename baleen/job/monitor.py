@@ -0,0 +1,61 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+log = logging.getLogger('baleen.job')
+
+
+class JobMonitor(threading.Thread):
+    """
+    Runs alongside a job in the worker, renewing the job's lease so that
+    other workers know it is still alive. Calls on_cancel (once) if someone
+    asks for the job to be cancelled, or if the lease can't be renewed
+    because the job was taken back, and on_timeout (once) if the job runs
+    for longer than its timeout.
+    """
+    daemon = True
+
+    def __init__(self, job, interval=None, on_cancel=None, on_timeout=None):
+        super(JobMonitor, self).__init__(name='monitor-job-%d' % job.id)
+        self.job = job
+        if interval is None:
+            # Renew often enough that a slow renewal won't lose the lease
+            interval = settings.JOB_LEASE_DURATION / 3.0
+        self.interval = interval
+        self.on_cancel = on_cancel
+        self.on_timeout = on_timeout
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                self.check()
+        finally:
+            # Each thread gets its own db connection
+            connection.close()
+
+    def check(self):
+        try:
+            if not self.job.renew_lease():
+                log.warning("Job %d lost its lease, stopping it" % self.job.id)
+                self.stopped.set()
+                if self.on_cancel:
+                    on_cancel, self.on_cancel = self.on_cancel, None
+                    on_cancel()
+            elif self.on_cancel and self.job.cancel_requested():
+                log.info("Cancelling job %d" % self.job.id)
+                on_cancel, self.on_cancel = self.on_cancel, None
+                on_cancel()
+            elif self.on_timeout and self.job.timed_out():
+                log.info("Job %d timed out" % self.job.id)
+                on_timeout, self.on_timeout = self.on_timeout, None
+                on_timeout()
+        except Exception:
+            log.exception("Failed to renew lease for job %d" % self.job.id)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
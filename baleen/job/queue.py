@@ -0,0 +1,269 @@
+"""
+Queues that carry jobs from where they are created (webhooks, the web
+interface, finished jobs kicking off the next one) to the workers.
+
+The backend is chosen with settings.JOB_QUEUE_BACKEND:
+
+- 'gearman' sends jobs through gearmand at settings.GEARMAN_SERVER.
+- 'db' uses the Job table itself, workers claim queued jobs with a
+  conditional update. On PostgreSQL workers are woken with LISTEN/NOTIFY,
+  otherwise they poll every settings.DB_QUEUE_POLL_INTERVAL seconds.
+- 'local' keeps jobs in memory, so only a worker in the same process sees
+  them. For tests and benchmarks that shouldn't need any other service.
+
+A dotted path to a JobQueue subclass can also be given.
+"""
+import json
+import time
+import select
+import logging
+import threading
+import Queue
+import itertools
+
+from datetime import timedelta
+from importlib import import_module
+
+import gearman
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.timezone import now
+
+from baleen.utils import gearman_client
+
+log = logging.getLogger('baleen.job')
+
+# Channel used to wake up workers using the db queue on PostgreSQL
+NOTIFY_CHANNEL = 'baleen_jobs'
+
+
+class Task(object):
+    """ A unit of work handed to a worker, data is a JSON string """
+
+    def __init__(self, data):
+        self.data = data
+
+
+class JobQueue(object):
+    # Cleared by stop_taking_tasks
+    taking_tasks = True
+
+    def submit(self, jobs):
+        """ Make jobs available to workers """
+        raise NotImplementedError
+
+    def submit_event(self, event):
+        """ Publish an event for anything listening to the queue """
+        log.debug("%s ignoring event %s" % (self.__class__.__name__, event))
+
+    def work(self, handler, poll_callback=None, poll_timeout=None):
+        """
+        Call handler(task) for each task that arrives, and
+        poll_callback(any_activity) at least every poll_timeout seconds.
+        Returns when poll_callback returns False.
+        """
+        raise NotImplementedError
+
+    def complete(self, task):
+        """ Tell the queue a task won't be finished by this worker """
+        pass
+
+    def stop_taking_tasks(self):
+        """
+        Stop handing tasks to this worker, work keeps calling poll_callback
+        until it returns False.
+        """
+        self.taking_tasks = False
+
+
+class BaleenGearmanWorker(gearman.GearmanWorker):
+    # Called after each poll of the gearman connections, return False to stop
+    # working.
+    poll_callback = None
+
+    def on_job_execute(self, current_job):
+        print "Job started"
+        return super(BaleenGearmanWorker, self).on_job_execute(current_job)
+
+    def on_job_exception(self, current_job, exc_info):
+        result = str(exc_info)
+        return super(BaleenGearmanWorker, self).send_job_complete(
+                current_job, result)
+
+    def on_job_complete(self, current_job, job_result):
+        return super(BaleenGearmanWorker, self).send_job_complete(
+                current_job, job_result)
+
+    def after_poll(self, any_activity):
+        # Return True if you want to continue polling, replaces callback_fxn
+        if self.poll_callback:
+            return self.poll_callback(any_activity)
+        return True
+
+
+class GearmanQueue(JobQueue):
+
+    def __init__(self):
+        self.worker = None
+
+    def _request(self, job):
+        from baleen.job.models import priorities
+        return {
+            'task': settings.GEARMAN_JOB_LABEL,
+            'data': json.dumps({'job': job.id}),
+            'priority': priorities.GEARMAN.get(job.priority),
+        }
+
+    def submit(self, jobs):
+        requests = [self._request(job) for job in jobs]
+        if not requests:
+            return
+        with gearman_client() as client:
+            if len(requests) == 1:
+                r = requests[0]
+                client.submit_job(r['task'], r['data'], priority=r['priority'], background=True)
+            else:
+                client.submit_multiple_jobs(requests, background=True, wait_until_complete=False)
+
+    def submit_event(self, event):
+        with gearman_client() as client:
+            client.submit_job(settings.GEARMAN_JOB_LABEL, json.dumps({'event': event}), background=True)
+
+    def work(self, handler, poll_callback=None, poll_timeout=None):
+        self.worker = BaleenGearmanWorker([settings.GEARMAN_SERVER])
+        self.worker.register_task(settings.GEARMAN_JOB_LABEL,
+                lambda worker, gm_job: handler(gm_job))
+        self.worker.poll_callback = poll_callback
+        self.worker.work(poll_timeout=poll_timeout)
+
+    def complete(self, task):
+        if self.worker:
+            self.worker.send_job_complete(task, data='')
+
+    def stop_taking_tasks(self):
+        super(GearmanQueue, self).stop_taking_tasks()
+        if self.worker:
+            # Tell gearmand we can't do jobs any more
+            self.worker.unregister_task(settings.GEARMAN_JOB_LABEL)
+
+
+class DatabaseQueue(JobQueue):
+
+    def submit(self, jobs):
+        from baleen.job.models import Job
+        ids = [job.id for job in jobs]
+        if not ids:
+            return
+        Job.objects.filter(id__in=ids).update(dispatched_at=None)
+        if connection.vendor == 'postgresql':
+            connection.cursor().execute('NOTIFY %s' % NOTIFY_CHANNEL)
+
+    def stale_dispatch(self):
+        """ Jobs dispatched before this were lost by their worker """
+        return now() - timedelta(seconds=settings.JOB_LEASE_DURATION)
+
+    def claim_next(self):
+        """
+        Return a Task for the first queued job whose project is idle, after
+        marking it as dispatched so that no other worker takes it, or None.
+        """
+        from baleen.job.models import Job
+        stale = self.stale_dispatch()
+        busy = Job.objects.filter(finished_at=None).filter(
+                Q(started_at__isnull=False) | Q(dispatched_at__gte=stale)
+                ).values_list('project_id', flat=True)
+        candidates = Job.objects.filter(started_at=None, finished_at=None,
+                superseded_by=None).filter(
+                Q(dispatched_at=None) | Q(dispatched_at__lt=stale)
+                ).exclude(project__in=list(busy)
+                ).order_by('priority', 'received_at', 'id')
+        for job in candidates[:10]:
+            # Only one worker's update can match the dispatched_at it saw
+            claimed = Job.objects.filter(id=job.id, started_at=None,
+                    dispatched_at=job.dispatched_at).update(dispatched_at=now())
+            if claimed:
+                return Task(json.dumps({'job': job.id}))
+        return None
+
+    def wait(self, timeout):
+        if connection.vendor != 'postgresql':
+            time.sleep(timeout)
+            return
+        connection.cursor().execute('LISTEN %s' % NOTIFY_CHANNEL)
+        pg_connection = connection.connection
+        try:
+            ready = select.select([pg_connection], [], [], timeout)[0]
+        except select.error:
+            # Interrupted by a signal
+            return
+        if ready:
+            pg_connection.poll()
+            del pg_connection.notifies[:]
+
+    def work(self, handler, poll_callback=None, poll_timeout=None):
+        timeout = settings.DB_QUEUE_POLL_INTERVAL
+        if connection.vendor == 'postgresql' and poll_timeout:
+            # Notifications wake us up, no need to poll more than asked
+            timeout = poll_timeout
+        while True:
+            task = self.claim_next() if self.taking_tasks else None
+            if task is not None:
+                handler(task)
+            else:
+                self.wait(timeout)
+            if poll_callback and not poll_callback(task is not None):
+                return
+
+
+class LocalQueue(JobQueue):
+
+    def __init__(self):
+        self.tasks = Queue.PriorityQueue()
+        self.counter = itertools.count()
+
+    def submit(self, jobs):
+        for job in jobs:
+            # Lowest priority value first, then in order of submission
+            self.tasks.put((job.priority, next(self.counter), json.dumps({'job': job.id})))
+
+    def work(self, handler, poll_callback=None, poll_timeout=None):
+        while True:
+            try:
+                if not self.taking_tasks:
+                    time.sleep(poll_timeout or 1)
+                    raise Queue.Empty()
+                priority, n, data = self.tasks.get(timeout=poll_timeout or 1)
+                task = Task(data)
+            except Queue.Empty:
+                task = None
+            if task is not None:
+                handler(task)
+            if poll_callback and not poll_callback(task is not None):
+                return
+
+
+QUEUE_BACKENDS = {
+    'gearman': GearmanQueue,
+    'db': DatabaseQueue,
+    'local': LocalQueue,
+}
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """ Return the process wide queue for settings.JOB_QUEUE_BACKEND """
+    global _queue
+    with _queue_lock:
+        backend = getattr(settings, 'JOB_QUEUE_BACKEND', 'gearman')
+        if _queue is None or _queue[0] != backend:
+            if backend in QUEUE_BACKENDS:
+                queue_cls = QUEUE_BACKENDS[backend]
+            else:
+                module_name, cls_name = backend.rsplit('.', 1)
+                queue_cls = getattr(import_module(module_name), cls_name)
+            _queue = (backend, queue_cls())
+        return _queue[1]
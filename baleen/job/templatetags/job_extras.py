@@ -134,7 +134,9 @@ def render_trigger(job):
 @register.filter()
 def job_status_badge(job):
     preamble = '<a href="%s">' % reverse('view_job', kwargs=dict(project_id=job.project.id, job_id=job.id))
-    if not job.started_at:
+    if job.superseded:
+        badge_span = '<span class="label">superseded</span></a>'
+    elif not job.started_at:
         badge_span = '<span class="label">pending</span>'
     elif not job.finished_at:
         badge_span = '<span class="label">in progress</span></a>'
@@ -142,6 +144,8 @@ def job_status_badge(job):
         badge_span = '<span class="label label-success">success</span></a>'
     elif job.rejected:
         badge_span = '<span class="label">rejected</span></a>'
+    elif job.cancelled:
+        badge_span = '<span class="label">cancelled</span></a>'
     else:
         badge_span = '<span class="label label-important">failure</span></a>'
     return mark_safe(preamble + badge_span)
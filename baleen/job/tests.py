@@ -1,14 +1,27 @@
+import os
+import json
+import time
+import threading
+import gearman
+
+from datetime import timedelta
+
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.utils.timezone import now
 
-from baleen.project.models import Project, ActionResult
-from baleen.job.models import Job, manual_run
+from baleen.project.models import Project, ActionResult, Hook
+from baleen.job.models import Job, manual_run, priorities, reap_expired_jobs, submit_jobs
+from baleen.job.monitor import JobMonitor
+from baleen.job.queue import get_queue, DatabaseQueue, LocalQueue, GearmanQueue
 from baleen.artifact.models import (
         output_types, ActionOutput
         )
 from baleen.action.ssh import RunCommandAction
+from baleen.utils import reset_gearman_clients
 
 from mock import patch, Mock
 
@@ -29,6 +42,8 @@ class JobTest(TestCase):
         self.job = Job(project=self.project, github_data={})
         self.job.save()
 
+        reset_gearman_clients()
+
     def test_unicode(self):
         self.assertTrue('Job' in unicode(self.job))
 
@@ -39,6 +54,46 @@ class JobTest(TestCase):
         self.job.submit()
         self.assertTrue(c.submit_job.called)
 
+    @patch('gearman.GearmanClient')
+    def test_submit_priority(self, m):
+        c = Mock()
+        m.return_value = c
+        self.job.priority = priorities.TRIGGER
+        self.job.submit()
+        self.assertEqual(c.submit_job.call_args[1]['priority'], gearman.PRIORITY_LOW)
+
+    @patch('gearman.GearmanClient')
+    def test_submit_reuses_client(self, m):
+        self.job.submit()
+        self.job.submit()
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(m.return_value.submit_job.call_count, 2)
+
+    @patch('gearman.GearmanClient')
+    def test_submit_reconnects_after_error(self, m):
+        m.return_value.submit_job.side_effect = gearman.errors.ServerUnavailable()
+        self.assertRaises(gearman.errors.ServerUnavailable, self.job.submit)
+        m.return_value.submit_job.side_effect = None
+        self.job.submit()
+        self.assertEqual(m.call_count, 2)
+
+    @patch('gearman.GearmanClient')
+    def test_submit_jobs(self, m):
+        c = Mock()
+        m.return_value = c
+        other_job = Job(project=self.project, priority=priorities.MANUAL)
+        other_job.save()
+
+        submit_jobs([self.job, other_job])
+        self.assertEqual(c.submit_multiple_jobs.call_count, 1)
+        requests = c.submit_multiple_jobs.call_args[0][0]
+        self.assertEqual([r['priority'] for r in requests],
+                [gearman.PRIORITY_NONE, gearman.PRIORITY_HIGH])
+        self.assertFalse(c.submit_multiple_jobs.call_args[1]['wait_until_complete'])
+
+        submit_jobs([])
+        self.assertEqual(c.submit_multiple_jobs.call_count, 1)
+
     @patch('gearman.GearmanClient')
     def test_manual_run(self, m):
         c = Mock()
@@ -48,6 +103,8 @@ class JobTest(TestCase):
 
         job.submit()
         self.assertTrue(c.submit_job.called)
+        self.assertEqual(job.priority, priorities.MANUAL)
+        self.assertEqual(c.submit_job.call_args[1]['priority'], gearman.PRIORITY_HIGH)
 
     @patch('gearman.GearmanClient')
     def test_manual_no_prior_job(self, m):
@@ -74,6 +131,303 @@ class JobTest(TestCase):
         self.job.kill()
         self.assertTrue(m.called)
 
+    def test_claim(self):
+        job = self.job.claim(231)
+        self.assertEqual(job, self.job)
+        self.assertTrue(job.started_at)
+        self.assertEqual(self.project.current_job(), job)
+
+    @patch('baleen.job.models.Job.submit')
+    def test_claim_project_busy(self, submit):
+        self.job.claim(231)
+        second_job = Job(project=self.project, github_data={})
+        second_job.save()
+
+        self.assertEqual(second_job.claim(232), None)
+        self.assertEqual(self.project.next_queued_job(), second_job)
+
+        self.job.record_done()
+        self.assertTrue(submit.called)
+        self.assertEqual(second_job.claim(232), second_job)
+
+    def test_claim_runs_head_of_queue(self):
+        second_job = Job(project=self.project, github_data={})
+        second_job.save()
+
+        job = second_job.claim(231)
+        self.assertEqual(job, self.job)
+        self.assertEqual(self.project.next_queued_job(), second_job)
+
+    def test_supersede_pending(self):
+        def push(before, after, commits, ref='refs/heads/master'):
+            job = Job(project=self.project, github_data={
+                'ref': ref,
+                'before': before,
+                'after': after,
+                'compare': 'https://github.com/o/r/compare/%s...%s' % (before, after),
+                'commits': [{'id': c, 'message': c} for c in commits],
+                })
+            job.save()
+            return job
+
+        first = push('aaa', 'bbb', ['bbb'])
+        other_branch = push('zzz', 'yyy', ['yyy'], ref='refs/heads/other')
+        second = push('bbb', 'ccc', ['ccc'])
+        latest = push('ccc', 'ddd', ['ddd'])
+
+        self.assertItemsEqual(latest.supersede_pending(), [first, second])
+
+        for job in Job.objects.filter(id__in=[first.id, second.id]):
+            self.assertTrue(job.superseded)
+            self.assertTrue(job.done)
+            self.assertEqual(job.superseded_by, latest)
+        self.assertFalse(Job.objects.get(id=other_branch.id).done)
+
+        latest = Job.objects.get(id=latest.id)
+        self.assertEqual([c['id'] for c in latest.github_data['commits']],
+                ['bbb', 'ccc', 'ddd'])
+        self.assertTrue(latest.github_data['compare'].endswith('/compare/aaa...ddd'))
+        self.assertEqual(render_commits(latest), '3 commits')
+
+    def test_supersede_started_job(self):
+        self.job.github_data = {'ref': 'refs/heads/master', 'commits': []}
+        self.job.save()
+        self.job.claim(231)
+        newer = Job(project=self.project, github_data={'ref': 'refs/heads/master', 'commits': []})
+        newer.save()
+        self.assertEqual(newer.supersede_pending(), [])
+
+    def test_supersede_manual_job(self):
+        manual = Job(project=self.project, priority=priorities.MANUAL,
+                github_data={'ref': 'refs/heads/master', 'commits': []})
+        manual.save()
+        push = Job(project=self.project, priority=priorities.PUSH,
+                github_data={'ref': 'refs/heads/master', 'commits': []})
+        push.save()
+        self.assertEqual(push.supersede_pending(), [manual])
+        # Still in the manual lane
+        self.assertEqual(Job.objects.get(id=push.id).priority, priorities.MANUAL)
+
+    def test_next_queued_job_priority(self):
+        manual_job = Job(project=self.project, priority=priorities.MANUAL)
+        manual_job.save()
+        self.assertEqual(self.project.next_queued_job(), manual_job)
+
+    def test_starved_job(self):
+        other_project = Project(name='OtherProject')
+        other_project.save()
+        trigger_job = Job(project=other_project, priority=priorities.TRIGGER)
+        trigger_job.save()
+
+        self.assertEqual(self.job.starved_job(), None)
+
+        Job.objects.filter(id=trigger_job.id).update(
+                received_at=now() - timedelta(seconds=settings.JOB_PRIORITY_AGING + 1))
+        self.assertEqual(self.job.starved_job(), trigger_job)
+
+        # Manual deploys don't give way
+        self.job.priority = priorities.MANUAL
+        self.assertEqual(self.job.starved_job(), None)
+
+    @patch('baleen.job.models.Job.submit')
+    def test_trigger_hooks(self, submit):
+        other_project = Project(name='OtherProject')
+        other_project.save()
+        Hook.objects.create(project=self.project, trigger_build=other_project, one_off=True)
+        self.job.record_start(231)
+
+        self.job.record_done()
+        triggered = Job.objects.get(project=other_project)
+        self.assertEqual(triggered.priority, priorities.TRIGGER)
+        self.assertTrue(submit.called)
+        # Only waiting for the one build
+        self.assertFalse(Hook.objects.exists())
+
+    def test_renew_lease(self):
+        self.job.record_start(231)
+        expiry = self.job.lease_expires_at
+        self.assertTrue(self.job.renew_lease())
+        self.assertTrue(Job.objects.get(id=self.job.id).lease_expires_at > expiry)
+
+        self.job.record_done()
+        self.assertFalse(self.job.renew_lease())
+
+    def test_renew_lost_lease(self):
+        self.job.record_start(231)
+        Job.objects.filter(id=self.job.id).update(lease_expires_at=now() - timedelta(seconds=1))
+        Job.objects.get(id=self.job.id).recover(submit=False)
+        # Requeued, so the worker that had it can't carry on
+        self.assertFalse(self.job.renew_lease())
+
+        # Nor once another worker has claimed it again
+        Job.objects.get(id=self.job.id).record_start(232)
+        self.assertFalse(self.job.renew_lease())
+
+    def test_monitor_lost_lease(self):
+        self.job.record_start(231)
+        on_cancel = Mock()
+        monitor = JobMonitor(self.job, interval=60, on_cancel=on_cancel)
+        Job.objects.filter(id=self.job.id).update(started_at=None, lease_expires_at=None)
+        monitor.check()
+        self.assertEqual(on_cancel.call_count, 1)
+        self.assertTrue(monitor.stopped.is_set())
+
+    def test_monitor(self):
+        self.job.record_start(231)
+        monitor = JobMonitor(self.job, interval=60)
+        with patch.object(self.job, 'renew_lease') as renew_lease:
+            monitor.check()
+            self.assertTrue(renew_lease.called)
+
+    def test_monitor_cancel(self):
+        self.job.record_start(231)
+        on_cancel = Mock()
+        monitor = JobMonitor(self.job, interval=60, on_cancel=on_cancel)
+        monitor.check()
+        self.assertFalse(on_cancel.called)
+
+        self.job.cancel()
+        monitor.check()
+        monitor.check()
+        self.assertEqual(on_cancel.call_count, 1)
+
+    def test_monitor_timeout(self):
+        self.job.record_start(231)
+        on_timeout = Mock()
+        monitor = JobMonitor(self.job, interval=60, on_timeout=on_timeout)
+        monitor.check()
+        self.assertFalse(on_timeout.called)
+
+        Job.objects.filter(id=self.job.id).update(
+                started_at=now() - timedelta(seconds=settings.JOB_TIMEOUT + 1))
+        monitor.check()
+        monitor.check()
+        self.assertEqual(on_timeout.call_count, 1)
+
+    def test_import_build_definition(self):
+        self.job.import_build_definition(
+                "timeout: 60\nbuild:\n  api: api\ntest:\n  subject:\n    command: ./run_tests.sh\n")
+        job = Job.objects.get(id=self.job.id)
+        self.assertEqual(job.build_data['build'], {'api': 'api'})
+        self.assertEqual([step['action'] for step in job.plan],
+                ['build_image', 'test_with_compose', 'tag_good_image'])
+
+        # The stored copies are used rather than parsing baleen.yml again
+        with patch('yaml.safe_load', side_effect=AssertionError):
+            self.assertEqual(job.action_plan(), job.plan)
+            # Newer jobs still waiting to import baleen.yml are passed over
+            Job.objects.create(project=self.project)
+            with self.assertNumQueries(1):
+                self.assertEqual(self.project.action_plan(), job.plan)
+            self.assertEqual(job.timeout, 60)
+
+    def test_timeout(self):
+        self.assertEqual(self.job.timeout, settings.JOB_TIMEOUT)
+        self.job.build_definition = "timeout: 60\nbuild: {}"
+        self.assertEqual(self.job.timeout, 60)
+        self.job.save()
+
+        self.assertFalse(self.job.timed_out())
+        self.job.record_start(231)
+        self.assertFalse(self.job.timed_out())
+        Job.objects.filter(id=self.job.id).update(started_at=now() - timedelta(seconds=61))
+        self.assertTrue(self.job.timed_out())
+
+    def test_cancel_queued(self):
+        self.job.cancel()
+        job = Job.objects.get(id=self.job.id)
+        self.assertTrue(job.done)
+        self.assertTrue(job.cancelled)
+        self.assertFalse(job.success)
+
+    def test_cancel_running(self):
+        self.job.record_start(231)
+        self.job.record_action_start(self.action)
+        self.assertFalse(self.job.cancel_requested())
+        self.job.cancel()
+        self.assertTrue(self.job.cancel_requested())
+        # Left for the worker to stop
+        self.assertFalse(Job.objects.get(id=self.job.id).done)
+
+        self.job.record_cancelled()
+        job = Job.objects.get(id=self.job.id)
+        self.assertTrue(job.done)
+        self.assertTrue(job.cancelled)
+        self.assertEqual(job.actionresult_set.get().status_code, -1)
+        self.assertFalse(job.cancel_requested())
+
+    @patch('baleen.job.models.submit_jobs')
+    def test_reap_expired_jobs(self, submit):
+        self.job.record_start(231)
+        self.job.record_action_start(self.action)
+        self.assertEqual(reap_expired_jobs(), [])
+
+        # Lease expires, job gets requeued
+        Job.objects.filter(id=self.job.id).update(lease_expires_at=now() - timedelta(seconds=1))
+        self.assertEqual(reap_expired_jobs(), [self.job])
+        self.assertEqual(submit.call_args[0][0], [self.job])
+        job = Job.objects.get(id=self.job.id)
+        self.assertTrue(job.queued)
+        self.assertEqual(job.actionresult_set.get().status_code, -1)
+
+        # Until it runs out of attempts
+        job.record_start(232)
+        self.assertEqual(job.attempts, settings.JOB_MAX_ATTEMPTS)
+        Job.objects.filter(id=self.job.id).update(lease_expires_at=now() - timedelta(seconds=1))
+        self.assertEqual(reap_expired_jobs(), [job])
+        job = Job.objects.get(id=self.job.id)
+        self.assertTrue(job.done)
+        self.assertFalse(job.success)
+
+    def test_recover_cancelled_job(self):
+        self.job.record_start(231)
+        stale = Job.objects.get(id=self.job.id)
+        self.job.cancel()
+        Job.objects.filter(id=self.job.id).update(lease_expires_at=stale.lease_expires_at)
+        # Someone wanted it stopped, so it isn't run again
+        self.assertTrue(stale.recover(submit=False))
+        job = Job.objects.get(id=self.job.id)
+        self.assertTrue(job.done)
+        self.assertTrue(job.cancelled)
+        self.assertFalse(job.queued)
+        self.assertNotEqual(job.cancel_requested_at, None)
+
+    def test_place(self):
+        hosts = {
+            'small': {'url': 'tcp://small:2375', 'builds': 1, 'cpus': 2},
+            'big': {'url': 'tcp://big:2375', 'builds': 1, 'cpus': 8},
+        }
+        with self.settings(DOCKER_HOSTS=hosts):
+            self.assertEqual(self.job.place(), 'big')
+            self.assertEqual(self.job.docker_url, 'tcp://big:2375')
+            self.job.record_start(231)
+
+            other_project = Project(name='OtherProject')
+            other_project.save()
+            other_job = Job(project=other_project)
+            other_job.save()
+            self.assertEqual(other_job.place(), 'small')
+            # Only hosts the worker can reach
+            self.assertEqual(other_job.place(['big']), 'big')
+
+    @override_settings(DOCKER_HOSTS={}, DOCKER_HOST='tcp://docker:2375')
+    def test_place_default(self):
+        self.assertEqual(self.job.place(), 'default')
+        self.assertEqual(self.job.docker_url, 'tcp://docker:2375')
+
+    def test_record_interrupted(self):
+        self.job.record_start(231)
+        self.job.record_action_start(self.action)
+
+        self.job.record_interrupted('Gone away')
+
+        self.assertTrue(self.job.done)
+        self.assertFalse(self.job.success)
+        result = self.job.actionresult_set.get()
+        self.assertEqual(result.status_code, -1)
+        self.assertEqual(result.message, 'Gone away')
+        self.assertTrue(result.finished_at)
+
     def test_record_action_start(self):
         self.job.record_action_start(self.action)
 
@@ -103,11 +457,37 @@ class JobTest(TestCase):
         result = self.job.record_action_response(self.action, response)
 
         self.assertFalse(result.success)
+        # The job is finished by the worker once its other actions are done
+        self.assertFalse(Job.objects.get(id=self.job.id).done)
+
+    def test_record_action_queries(self):
+        # Savepoints around the transaction are two more
+        with self.assertNumQueries(1):
+            result = self.job.record_action_start(self.action)
+        with self.assertNumQueries(5):
+            self.job.record_action_response(self.action, {
+                'code': 0,
+                'stdout': 'out',
+                'stderr': 'err',
+                'output': {output_types.XUNIT: '<xml></xml>', output_types.COVERAGE_XML: '<xml></xml>'},
+                }, result)
+        self.assertEqual(result.stdout.output, 'out')
+        self.assertEqual(result.stderr.output, 'err')
+        self.assertEqual(result.actionoutput_set.count(), 4)
+
+        # Output streamed while the action ran is left alone
+        result = self.job.record_action_start(self.action)
+        with self.assertNumQueries(3):
+            self.job.record_action_response(self.action,
+                    {'code': 0, 'stdout': 'tail', 'streamed': True}, result)
+        self.assertEqual(result.stdout, None)
 
     def test_get_filenames(self):
         result = self.job.get_live_job_filenames()
         self.assertTrue('stdout' in result[0])
         self.assertTrue('stderr' in result[1])
+        # Parallel actions don't share a file
+        self.assertNotEqual(self.job.get_live_job_filenames(self.action), result)
 
     def test_get_action_results_with_output(self):
         self.job.record_action_start(self.action)
@@ -133,12 +513,80 @@ class JobTest(TestCase):
         response = self.client.get(url)
         self.assertContains(response, 'TestProject')
 
+    def test_action_output_tail(self):
+        self.job.record_start(231)
+        result = self.job.record_action_start(self.action)
+        output = ActionOutput.objects.create(action_result=result,
+                output_type=output_types.STDOUT)
+        output.append(u'hello ')
+        output.append(u'world')
+        url = reverse('action_output_tail', kwargs=dict(project_id=self.project.id,
+            job_id=self.job.id, action_result_id=result.id, stream='stdout'))
+
+        response = self.client.get(url, {'offset': 3})
+        self.assertEqual(json.loads(response.content),
+                {'output': 'lo world', 'offset': 11, 'finished': False})
+        response = self.client.get(url, {'offset': 11})
+        self.assertEqual(json.loads(response.content)['output'], '')
+
+        url = reverse('action_output_tail', kwargs=dict(project_id=self.project.id,
+            job_id=self.job.id, action_result_id=result.id, stream='stderr'))
+        response = self.client.get(url)
+        self.assertEqual(json.loads(response.content)['offset'], 0)
+        response = self.client.get(url, {'offset': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_action_output_stream(self):
+        self.job.record_start(231)
+        result = self.job.record_action_start(self.action)
+        output = ActionOutput.objects.create(action_result=result,
+                output_type=output_types.STDOUT)
+        output.append(u'hello ')
+        output.append(u'world')
+        url = reverse('action_output_stream', kwargs=dict(project_id=self.project.id,
+            job_id=self.job.id, action_result_id=result.id, stream='stdout'))
+
+        # Off unless the server can hold streams open
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        with self.settings(LIVE_OUTPUT_EVENTS=True, LIVE_OUTPUT_STREAM_DURATION=0):
+            response = self.client.get(url, HTTP_LAST_EVENT_ID='6')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            self.assertEqual(''.join(response.streaming_content),
+                    'id: 11\ndata: "world"\n\n')
+
+        self.job.record_action_response(self.action, {'code': 0, 'streamed': True})
+        with self.settings(LIVE_OUTPUT_EVENTS=True):
+            response = self.client.get(url)
+        self.assertEqual(''.join(response.streaming_content),
+                'id: 11\ndata: "hello world"\n\nevent: done\ndata: \n\n')
+
+    def test_view_job_follows_running_action(self):
+        self.job.record_start(231)
+        result = self.job.record_action_start(self.action)
+        url = reverse('view_job', kwargs=dict(project_id=self.project.id, job_id=self.job.id))
+        stream_url = reverse('action_output_stream', kwargs=dict(
+            project_id=self.project.id, job_id=self.job.id,
+            action_result_id=result.id, stream='stdout'))
+        response = self.client.get(url)
+        self.assertContains(response, reverse('action_output_tail', kwargs=dict(
+            project_id=self.project.id, job_id=self.job.id,
+            action_result_id=result.id, stream='stdout')))
+        self.assertNotContains(response, stream_url)
+        # Polls as often as the settings say, and looks for actions started since
+        self.assertContains(response, 'var pollInterval = %s * 1000;' % settings.LIVE_OUTPUT_POLL_INTERVAL)
+        self.assertContains(response, 'data-action-result-id="%d"' % result.id)
+        self.assertContains(response, 'data-running="true"')
+        with self.settings(LIVE_OUTPUT_EVENTS=True):
+            self.assertContains(self.client.get(url), stream_url)
+
     def test_mark_done(self):
         url = reverse('mark_job_done', kwargs=dict(project_id=self.project.id, job_id=self.job.id))
         response = self.client.get(url)
         self.assertEqual(response.status_code, 302)
 
         self.assertEqual(self.job.success, False)
+        self.assertTrue(Job.objects.get(id=self.job.id).cancelled)
 
     def test_view_html_coverage(self):
         self.job.record_action_start(self.action)
@@ -194,6 +642,417 @@ class JobTest(TestCase):
                 'unknown broke the build for TestProject - https://deploy.example.com/project/\d+/job/\d+ \(doh\)')
 
 
+class QueueTest(TestCase):
+
+    def setUp(self):
+        self.project = Project(name='TestProject')
+        self.project.save()
+        self.other_project = Project(name='OtherProject')
+        self.other_project.save()
+
+        self.job = Job(project=self.project, github_data={})
+        self.job.save()
+
+    def test_get_queue(self):
+        self.assertTrue(isinstance(get_queue(), GearmanQueue))
+        with self.settings(JOB_QUEUE_BACKEND='db'):
+            self.assertTrue(isinstance(get_queue(), DatabaseQueue))
+            self.assertTrue(get_queue() is get_queue())
+        with self.settings(JOB_QUEUE_BACKEND='baleen.job.queue.LocalQueue'):
+            self.assertTrue(isinstance(get_queue(), LocalQueue))
+
+    def test_db_claim_next(self):
+        queue = DatabaseQueue()
+        manual_job = Job(project=self.other_project, priority=priorities.MANUAL)
+        manual_job.save()
+
+        task = queue.claim_next()
+        self.assertEqual(json.loads(task.data), {'job': manual_job.id})
+        task = queue.claim_next()
+        self.assertEqual(json.loads(task.data), {'job': self.job.id})
+        # Both jobs have been handed out
+        self.assertEqual(queue.claim_next(), None)
+
+        # Until they are submitted again
+        queue.submit([self.job])
+        task = queue.claim_next()
+        self.assertEqual(json.loads(task.data), {'job': self.job.id})
+
+    def test_db_claim_next_project_busy(self):
+        queue = DatabaseQueue()
+        self.job.record_start(231)
+        next_job = Job(project=self.project)
+        next_job.save()
+        self.assertEqual(queue.claim_next(), None)
+
+        with self.settings(JOB_QUEUE_BACKEND='db'):
+            self.job.record_done(True)
+        task = queue.claim_next()
+        self.assertEqual(json.loads(task.data), {'job': next_job.id})
+
+    def test_db_claim_next_stale(self):
+        queue = DatabaseQueue()
+        self.assertTrue(queue.claim_next())
+        # The worker that took the job went away before starting it
+        Job.objects.filter(id=self.job.id).update(
+                dispatched_at=now() - timedelta(seconds=settings.JOB_LEASE_DURATION + 1))
+        task = queue.claim_next()
+        self.assertEqual(json.loads(task.data), {'job': self.job.id})
+
+    def test_local_queue(self):
+        queue = LocalQueue()
+        manual_job = Job(project=self.other_project, priority=priorities.MANUAL)
+        manual_job.save()
+        queue.submit([self.job, manual_job])
+
+        handled = []
+        polls = []
+        def poll_callback(any_activity):
+            polls.append(any_activity)
+            return len(polls) < 3
+        queue.work(lambda task: handled.append(json.loads(task.data)['job']),
+                poll_callback=poll_callback, poll_timeout=0.01)
+        self.assertEqual(handled, [manual_job.id, self.job.id])
+        self.assertEqual(polls, [True, True, False])
+
+
+class WorkerTest(TestCase):
+
+    def setUp(self):
+        from baleen.job.management.commands.worker import Command
+        self.project = Project(name='TestProject')
+        self.project.save()
+
+        self.action = RunCommandAction(project=self.project.name, index=0, name='TestAction',
+                username='foo', command='echo "blah"')
+
+        self.job = Job(project=self.project, github_data={})
+        self.job.save()
+        self.job.record_start(231)
+
+        self.worker = Command()
+        self.worker._reset_jobs()
+
+    def test_run_task_forks_when_warm(self):
+        task = Mock(data=json.dumps({'job': self.job.id}))
+        with patch.object(self.worker, 'dispatch_job') as dispatch_job:
+            with patch.object(self.worker, 'run_job') as run_job:
+                self.worker.run_task(task)
+                self.assertTrue(run_job.called)
+                self.assertFalse(dispatch_job.called)
+
+                self.worker.fork_jobs = True
+                self.worker.run_task(task)
+                dispatch_job.assert_called_with(self.job.id)
+
+    @patch('baleen.job.management.commands.worker.close_db_connections')
+    @patch('baleen.job.management.commands.worker.signal')
+    @patch('os._exit')
+    @patch('os.fork', return_value=0)
+    def test_child_exit_status(self, fork, exit, signal, close_db_connections):
+        self.worker.concurrency = 2
+
+        def failed_job(job_id):
+            self.job.record_done(False)
+            raise Exception("Action failed")
+        # An ordinary failed build is recorded by the child, which exits cleanly
+        with patch.object(self.worker, 'run_job', side_effect=failed_job):
+            with patch.object(self.worker, 'clear_current_action') as clear_current_action:
+                self.worker.dispatch_job(self.job.id)
+        exit.assert_called_once_with(0)
+        self.assertFalse(clear_current_action.called)
+
+        # A job left unfinished is recorded as failed before exiting
+        other_job = Job(project=self.project)
+        other_job.save()
+        other_job.record_start(os.getpid())
+        with patch.object(self.worker, 'run_job', side_effect=Exception("Broken")):
+            self.worker.dispatch_job(other_job.id)
+        self.assertEqual(exit.call_args[0], (0,))
+        job = Job.objects.get(id=other_job.id)
+        self.assertTrue(job.done)
+        self.assertFalse(job.success)
+
+    def test_run_task_in_threads(self):
+        self.worker.thread_jobs = True
+        self.worker.concurrency = 2
+        other_job = Job(project=self.project)
+        other_job.save()
+        release = threading.Event()
+        started = []
+
+        def run_job(job_id):
+            started.append(job_id)
+            release.wait(5)
+        with patch.object(self.worker, 'run_job', side_effect=run_job):
+            for job in (self.job, other_job):
+                self.assertEqual(self.worker.run_task(Mock(data=json.dumps({'job': job.id}))), '')
+            # Both jobs are running at once, in this process
+            self.assertEqual(len(self.worker.job_threads()), 2)
+            self.assertEqual(self.worker.child_pids(), {})
+
+            release.set()
+            for t in self.worker.job_threads():
+                t.join(5)
+            self.worker.reap_threads()
+        self.assertItemsEqual(started, [self.job.id, other_job.id])
+        self.assertEqual(self.worker.in_flight, {})
+
+    @patch('baleen.job.management.commands.worker.get_queue')
+    def test_clean_up_completes_unfinished_tasks(self, get_queue):
+        self.worker.thread_jobs = True
+        self.worker.concurrency = 1
+        release = threading.Event()
+        task = Mock(data=json.dumps({'job': self.job.id}))
+        with patch.object(self.worker, 'run_job', side_effect=lambda job_id: release.wait(5)), \
+                patch.object(self.worker, 'clear_current_action'):
+            self.worker.run_task(task)
+            # The queue already completed the task when run_task returned
+            with self.assertRaises(SystemExit):
+                self.worker.clean_up()
+            self.assertFalse(get_queue.return_value.complete.called)
+
+            # Unlike a task still being run inline
+            self.worker.in_flight[self.job.id] = {'task': task}
+            with self.assertRaises(SystemExit):
+                self.worker.clean_up()
+            get_queue.return_value.complete.assert_called_once_with(task)
+
+            release.set()
+            for t in threading.enumerate():
+                if t.name == 'job-%d' % self.job.id:
+                    t.join(5)
+
+    @patch('baleen.job.management.commands.worker.JobMonitor')
+    def test_build_renews_lease(self, job_monitor):
+        with patch.object(self.worker, '_do_action'), patch.object(self.worker, '_run_plan'):
+            self.worker.build('/tmp/baleen_build', keep_project=True)
+        job = job_monitor.call_args[0][0]
+        self.assertTrue(job_monitor.return_value.start.called)
+        self.assertTrue(job_monitor.return_value.stop.called)
+        self.assertTrue(Job.objects.get(id=job.id).done)
+
+    def other_job(self):
+        """ A queued job for a project that isn't busy """
+        other_project = Project(name='OtherProject')
+        other_project.save()
+        job = Job(project=other_project, github_data={
+            'commits': [{'author': {'email': 'bob@example.com'}}],
+            'compare': 'https://github.com/example/other/compare/a...b',
+            'repository': {'name': 'other'},
+            })
+        job.save()
+        self.worker.docker_hosts = None
+        return job
+
+    def run_one_step(self, job, run):
+        """ Run job with a plan of one step whose action runs with run """
+        action = Mock(statsd_name='step')
+        action.name = 'Step'
+        action.index = 0
+        action.run.side_effect = run
+        with patch('baleen.job.management.commands.worker.get_action_object', return_value=action), \
+                patch('baleen.job.management.commands.worker.JobMonitor'), \
+                patch.object(Job, 'checkout_repo_plan', return_value=[]), \
+                patch.object(Job, 'action_plan', return_value=[{'index': 0}]):
+            self.assertEqual(self.worker.run_job(job.id), '')
+        return action
+
+    @override_settings(MAILGUN_KEY='key')
+    @patch('requests.post')
+    @patch('baleen.job.management.commands.worker.compose_down')
+    def test_cancel_running_action(self, compose_down, post):
+        job = self.other_job()
+
+        def run(job, action_result):
+            self.worker.cancel_job(job)
+            # Killed, so the command fails
+            return {'code': -1}
+        action = self.run_one_step(job, run)
+
+        self.assertTrue(action.cancel.called)
+        job = Job.objects.get(id=job.id)
+        self.assertTrue(job.done)
+        self.assertTrue(job.cancelled)
+        self.assertFalse(job.success)
+        self.assertEqual(job.actionresult_set.get().message, "Job was cancelled.")
+        # Nobody broke the build
+        self.assertFalse(post.called)
+
+    @patch('baleen.job.management.commands.worker.compose_down')
+    def test_time_out_running_action(self, compose_down):
+        job = self.other_job()
+
+        def run(job, action_result):
+            self.worker.time_out_job(job)
+            return {'code': -1}
+        with patch.object(self.worker, 'notify') as notify:
+            action = self.run_one_step(job, run)
+
+        message = "Job timed out after %s seconds." % settings.JOB_TIMEOUT
+        action.time_out.assert_called_with(message)
+        self.assertTrue(notify.called)
+        job = Job.objects.get(id=job.id)
+        self.assertTrue(job.done)
+        self.assertFalse(job.cancelled)
+        self.assertFalse(job.success)
+        self.assertEqual(job.actionresult_set.get().message, message)
+
+    @patch('baleen.job.management.commands.worker.JobMonitor')
+    def test_lost_job_is_left_alone(self, job_monitor):
+        job = self.other_job()
+
+        def run_plan(job, actions, project_timer=None):
+            # The reaper requeues the job, and another worker claims it
+            Job.objects.filter(id=job.id).update(started_at=now(), attempts=2)
+        with patch.object(Job, 'checkout_repo_plan', return_value=[]), \
+                patch.object(self.worker, '_run_plan', side_effect=run_plan), \
+                patch.object(self.worker, 'notify') as notify:
+            self.assertEqual(self.worker.run_job(job.id), '')
+        job = Job.objects.get(id=job.id)
+        self.assertFalse(job.done)
+        self.assertFalse(notify.called)
+
+    def test_hook_error_after_success(self):
+        job = self.other_job()
+        with patch.object(Job, 'trigger_hooks', side_effect=Exception("Broken hook")), \
+                patch.object(self.worker, 'notify') as notify:
+            with self.assertRaises(Exception):
+                self.run_one_step(job, lambda job, action_result: {'code': 0})
+        # Still a good build, and nobody is told otherwise
+        job = Job.objects.get(id=job.id)
+        self.assertTrue(job.done)
+        self.assertTrue(job.success)
+        self.assertFalse(notify.called)
+
+    @patch('baleen.job.management.commands.worker.JobMonitor')
+    @patch('baleen.job.management.commands.worker.get_action_object')
+    def test_failed_step_waits_for_siblings(self, get_action_object, job_monitor):
+        job = self.other_job()
+        sibling_finished = threading.Event()
+
+        def run_sibling(job, action_result):
+            time.sleep(0.2)
+            sibling_finished.set()
+            return {'code': 0}
+        failing = Mock(statsd_name='fail')
+        failing.run.return_value = {'code': 1}
+        sibling = Mock(statsd_name='sibling')
+        sibling.run.side_effect = run_sibling
+        get_action_object.side_effect = [failing, sibling]
+        steps = [{'index': 0, 'depends_on': []}, {'index': 1, 'depends_on': []}]
+        finished = []
+
+        def record_done(success=True):
+            finished.append((success, sibling_finished.is_set()))
+        with patch.object(Job, 'checkout_repo_plan', return_value=[]), \
+                patch.object(Job, 'action_plan', return_value=steps), \
+                patch.object(Job, 'record_action_start'), \
+                patch.object(Job, 'record_done', side_effect=record_done), \
+                patch.object(self.worker, 'notify'):
+            with self.assertRaises(Exception):
+                self.worker.run_job(job.id)
+        # Finished once, as a failure, after the other step was done with it
+        self.assertEqual(finished, [(False, True)])
+
+    def test_drain(self):
+        self.worker.queue = Mock()
+        self.worker.last_reaped = time.time()
+        self.worker.in_flight[self.job.id] = {'job': self.job}
+        self.worker.drain()
+        self.assertTrue(self.worker.queue.stop_taking_tasks.called)
+
+        # Jobs handed to a draining worker go back in the queue
+        other_job = Job(project=self.project)
+        other_job.save()
+        with patch('baleen.job.models.Job.submit') as submit:
+            with patch.object(self.worker, 'run_job') as run_job:
+                self.worker.run_task(Mock(data=json.dumps({'job': other_job.id})))
+                self.assertTrue(submit.called)
+                self.assertFalse(run_job.called)
+
+        # Keep working until the running job is done
+        self.assertTrue(self.worker.on_poll(False))
+        self.worker._reset_jobs(self.job.id)
+        self.assertFalse(self.worker.on_poll(False))
+
+    @patch('xmlrpclib.ServerProxy')
+    def test_restart_workers(self, server_proxy):
+        from baleen.job.management.commands.restart_workers import Command as RestartCommand
+        supervisor = server_proxy.return_value.supervisor
+        supervisor.getAllProcessInfo.return_value = [
+                {'group': 'worker', 'name': 'worker_00', 'statename': 'RUNNING'},
+                {'group': 'worker', 'name': 'worker_01', 'statename': 'STOPPED'},
+                {'group': 'baleen_web', 'name': '0', 'statename': 'RUNNING'},
+                ]
+        RestartCommand().execute(group='worker', url=None)
+        supervisor.stopProcess.assert_called_once_with('worker:worker_00', True)
+        self.assertEqual([c[0][0] for c in supervisor.startProcess.call_args_list],
+                ['worker:worker_00', 'worker:worker_01'])
+
+    def test_clear_current_action(self):
+        self.job.record_action_start(self.action)
+        self.worker.in_flight[self.job.id] = {'job': self.job, 'actions': [self.action]}
+
+        self.worker.clear_current_action(self.job.id)
+
+        job = Job.objects.get(id=self.job.id)
+        self.assertTrue(job.done)
+        self.assertEqual(job.actionresult_set.get().status_code, -1)
+
+    @patch('baleen.job.management.commands.worker.compose_down')
+    def test_cancel_job(self, compose_down):
+        from baleen.job.management.commands.worker import JobCancelled
+        action = Mock()
+        self.worker.in_flight[self.job.id] = {'job': self.job, 'actions': [action]}
+        self.worker.cancel_job(self.job)
+        self.assertTrue(action.cancel.called)
+
+        # The worker stops before running another action
+        with self.assertRaises(JobCancelled):
+            self.worker._do_action(self.job, {})
+
+        self.worker.finish_cancelled_job(self.job)
+        compose_down.assert_called_with(self.job)
+        job = Job.objects.get(id=self.job.id)
+        self.assertTrue(job.cancelled)
+        self.assertTrue(job.done)
+
+    @patch('baleen.job.management.commands.worker.compose_down')
+    def test_time_out_job(self, compose_down):
+        action = Mock()
+        self.worker.in_flight[self.job.id] = {'job': self.job, 'actions': [action]}
+        self.worker.time_out_job(self.job)
+        self.assertTrue(action.time_out.called)
+
+        with patch.object(self.worker, 'notify'):
+            self.worker.finish_cancelled_job(self.job)
+        job = Job.objects.get(id=self.job.id)
+        self.assertTrue(job.done)
+        self.assertFalse(job.cancelled)
+        self.assertFalse(job.success)
+
+    def test_clear_current_action_in_child(self):
+        self.job.record_action_start(self.action)
+        other_job = Job(project=self.project, github_data={})
+        other_job.save()
+        other_job.record_start(232)
+        # The parent process only knows the pid of the child running the job
+        self.worker.in_flight[self.job.id] = {'pid': 231}
+        self.worker.in_flight[other_job.id] = {'pid': 232}
+
+        with patch.object(self.worker, 'stop_child') as stop_child:
+            with self.assertRaises(SystemExit):
+                self.worker.clean_up()
+
+        self.assertEqual(stop_child.call_count, 2)
+        self.assertEqual(self.worker.in_flight, {})
+        for job in Job.objects.filter(id__in=[self.job.id, other_job.id]):
+            self.assertTrue(job.done)
+            self.assertFalse(job.success)
+        self.assertEqual(self.job.actionresult_set.get().status_code, -1)
+
+
 from baleen.job.templatetags.job_extras import (job_status_badge,
         render_trigger, render_commits,
         render_xunit_summary, render_coverage)
@@ -216,6 +1075,11 @@ class JobTemplateTagsTest(TestCase):
 
     def test_status_badge(self):
         self.assertTrue('pending' in job_status_badge(self.job))
+        newer = Job(project=self.project, github_data={})
+        newer.save()
+        self.job.superseded_by = newer
+        self.assertTrue('superseded' in job_status_badge(self.job))
+        self.job.superseded_by = None
         self.job.started_at = now()
         self.job.save()
         self.assertTrue('in progress' in job_status_badge(self.job))
@@ -228,6 +1092,10 @@ class JobTemplateTagsTest(TestCase):
         self.job.save()
         self.assertTrue('rejected' in job_status_badge(self.job))
         self.job.rejected = False
+        self.job.cancelled = True
+        self.job.save()
+        self.assertTrue('cancelled' in job_status_badge(self.job))
+        self.job.cancelled = False
         self.job.save()
         self.assertTrue('failure' in job_status_badge(self.job))
 
@@ -1,16 +1,19 @@
 import os
+import json
+import time
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404, render_to_response, render, get_list_or_404, redirect
-from django.http import HttpResponseBadRequest, HttpResponse, Http404
+from django.http import HttpResponseBadRequest, HttpResponse, Http404, StreamingHttpResponse
 from django.template import RequestContext
 
 from sendfile import sendfile
 
 from baleen.project.models import ActionResult
 from baleen.job.models import Job
-from baleen.artifact.models import CoverageHTMLOutput, output_types
+from baleen.artifact.models import ActionOutput, CoverageHTMLOutput, output_types
 
 
 @login_required()
@@ -22,16 +25,98 @@ def view_job(request, project_id, job_id):
         'xunit_result': job.get_action_results_with_output(output_types.XUNIT),
         'coverage_xml_result': job.get_action_results_with_output(output_types.COVERAGE_XML),
         'coverage_html_result': job.get_action_results_with_output(output_types.COVERAGE_HTML),
-        'github_data': job.github_data if job.github_data else {}
+        'github_data': job.github_data if job.github_data else {},
+        'live_output_events': settings.LIVE_OUTPUT_EVENTS,
+        'live_output_poll_interval': settings.LIVE_OUTPUT_POLL_INTERVAL,
     }
     context_instance=RequestContext(request)
     return render_to_response('project/view_job.html', context, context_instance)
 
+def _get_output_tail(job_id, action_result_id, output_type, offset):
+    """
+    Return the output of an action after character offset, the offset the
+    next read should start from, and whether the action has finished.
+    """
+    action_result = get_object_or_404(ActionResult, id=action_result_id, job_id=job_id)
+    action_output = ActionOutput.objects.filter(action_result=action_result,
+            output_type=output_type).first()
+    output = action_output.read(offset) if action_output else u''
+    return output, offset + len(output), not action_result.in_progress
+
+def _output_type_and_offset(request, stream):
+    output_type = {
+        'stdout': output_types.STDOUT,
+        'stderr': output_types.STDERR,
+    }.get(stream)
+    if output_type is None:
+        raise Http404
+    # EventSource sends the id of the last event it saw when it reconnects
+    offset = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('offset') or 0
+    try:
+        return output_type, max(0, int(offset))
+    except ValueError:
+        return output_type, None
+
+@login_required()
+def action_output_tail(request, project_id, job_id, action_result_id, stream):
+    """
+    Return what an action has written to stdout or stderr after ?offset=, as
+    JSON with the offset to ask for next time.
+    """
+    output_type, offset = _output_type_and_offset(request, stream)
+    if offset is None:
+        return HttpResponseBadRequest('offset must be a number')
+    output, offset, finished = _get_output_tail(job_id, action_result_id, output_type, offset)
+    return HttpResponse(json.dumps({
+            'output': output,
+            'offset': offset,
+            'finished': finished,
+        }), content_type='application/json')
+
+@login_required()
+def action_output_stream(request, project_id, job_id, action_result_id, stream):
+    """
+    Server-sent events carrying stdout or stderr of an action as it is
+    written, starting from ?offset=. Each event's id is the offset after it,
+    and a "done" event is sent once the action finishes.
+
+    The stream is closed after LIVE_OUTPUT_STREAM_DURATION seconds, browsers
+    reconnect and carry on from the last event they received. Only available
+    when LIVE_OUTPUT_EVENTS is on.
+    """
+    if not settings.LIVE_OUTPUT_EVENTS:
+        raise Http404
+    output_type, offset = _output_type_and_offset(request, stream)
+    if offset is None:
+        return HttpResponseBadRequest('offset must be a number')
+    # 404 before starting the stream if the action doesn't exist
+    output, offset, finished = _get_output_tail(job_id, action_result_id, output_type, offset)
+
+    def events(output, offset, finished):
+        ends_at = time.time() + settings.LIVE_OUTPUT_STREAM_DURATION
+        while True:
+            if output:
+                yield 'id: %d\ndata: %s\n\n' % (offset, json.dumps(output))
+            if finished:
+                yield 'event: done\ndata: \n\n'
+                return
+            if time.time() >= ends_at:
+                return
+            time.sleep(settings.LIVE_OUTPUT_POLL_INTERVAL)
+            output, offset, finished = _get_output_tail(job_id, action_result_id, output_type, offset)
+
+    response = StreamingHttpResponse(events(output, offset, finished),
+            content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx holding the events back
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @login_required()
 def mark_job_done(request, project_id, job_id):
-    """ Used to kill a job that's stuck """
+    """ Cancel a queued or running job """
     job = get_object_or_404(Job, id=job_id)
-    job.kill()
+    job.cancel()
     return redirect(reverse('show_project', kwargs=dict(project_id=project_id)))
 
 @login_required()
@@ -57,11 +57,13 @@ class Project(models.Model):
 
     def action_plan(self):
         """
-        This is just the action plan from the last job run. The action plan is
-        recalculated when the github repo is pulled and the build definition
-        file is parsed.
+        This is just the action plan stored on the last job that imported a
+        build definition. The action plan is recalculated when the github repo
+        is pulled and the build definition file is parsed.
         """
-        j = self.last_job()
+        j = Job.objects.filter(project=self).exclude(
+                plan__isnull=True, build_definition__isnull=True
+                ).order_by('-received_at').first()
         if j:
             return j.action_plan()
         else:
@@ -112,6 +114,11 @@ class Project(models.Model):
         qs = Job.objects.filter(project=self, finished_at=None, started_at__isnull=False)
         return qs.first()
 
+    def next_queued_job(self):
+        """ The oldest job that is waiting to be run """
+        qs = Job.objects.filter(project=self, started_at=None, finished_at=None)
+        return qs.order_by('priority', 'received_at', 'id').first()
+
     def last_job(self):
         """ Get the last deployment job.
 
@@ -208,7 +215,9 @@ class Hook(models.Model):
     one_off = models.BooleanField(default=False)
 
     def activate(self, *args, **kwargs):
-        pass
+        if self.trigger_build:
+            from baleen.job.models import manual_run, priorities
+            manual_run(self.trigger_build, priority=priorities.TRIGGER)
 
 
 class ActionResult(models.Model):
@@ -231,15 +240,16 @@ class ActionResult(models.Model):
     finished_at = models.DateTimeField(null=True)
 
     status_code = models.IntegerField(null=True)
+    timed_out = models.BooleanField(default=False)
 
     message = models.TextField(blank=True)
 
     def __unicode__(self):
         return "ActionResult for action %s in job %s" % (self.action, self.job.id)
 
-    def save(self):
+    def save(self, *args, **kwargs):
         self.action_slug = slugify(unicode(self.action))
-        super(ActionResult, self).save()
+        super(ActionResult, self).save(*args, **kwargs)
 
     @property
     def success(self):
@@ -269,9 +279,13 @@ class ActionResult(models.Model):
 
     def get_output(self, output_type):
         try:
-            return self.actionoutput_set.get(output_type=output_type)
+            action_output = self.actionoutput_set.get(output_type=output_type)
         except ActionOutput.DoesNotExist:
-            pass
+            return None
+        if action_output.output is None:
+            # Streamed output is stored in chunks, put it back together
+            action_output.output = action_output.read()
+        return action_output
 
     class Meta:
         ordering = ['job', 'started_at']
@@ -7,6 +7,7 @@ from django.core.urlresolvers import reverse
 
 from baleen.project.models import Project
 from baleen.action.ssh import RemoteSSHAction
+from baleen.utils import reset_gearman_clients
 
 from mock import patch
 
@@ -14,6 +15,7 @@ from mock import patch
 class ProjectTest(TestCase):
 
     def setUp(self):
+        reset_gearman_clients()
         self.project = Project(name='TestProject')
         self.project.save()
         self.action = RemoteSSHAction(project=self.project.name, index=0, name='TestAction',
@@ -42,6 +44,7 @@ class ProjectTest(TestCase):
 class ProjectTestView(TestCase):
 
     def setUp(self):
+        reset_gearman_clients()
         self.project = Project(name='TestProject')
         self.project.save()
         self.action = RemoteSSHAction(project=self.project.name, index=0, name='TestAction',
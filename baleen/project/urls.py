@@ -14,6 +14,10 @@ urlpatterns += patterns('',
         'baleen.job.views.view_job', name='view_job'),
     url(r'^(?P<project_id>\d+)/job/(?P<job_id>\d+)/done$',
         'baleen.job.views.mark_job_done', name='mark_job_done'),
+    url(r'^(?P<project_id>\d+)/job/(?P<job_id>\d+)/action/(?P<action_result_id>\d+)/(?P<stream>stdout|stderr)$',
+        'baleen.job.views.action_output_tail', name='action_output_tail'),
+    url(r'^(?P<project_id>\d+)/job/(?P<job_id>\d+)/action/(?P<action_result_id>\d+)/(?P<stream>stdout|stderr)/events$',
+        'baleen.job.views.action_output_stream', name='action_output_stream'),
 
     url(r'^(?P<project_id>\d+)/job/(?P<job_id>\d+)/htmlcov/(?P<filename>.+)$',
         'baleen.job.views.view_html_coverage', name='view_html_coverage'),
@@ -188,11 +188,73 @@ ARTIFACT_DIR = os.path.join(BUILD_ROOT, 'build_artifacts')
 
 CRISPY_TEMPLATE_PACK = 'bootstrap'
 
+# How jobs get to workers: 'gearman', 'db' or 'local' (in process only, for
+# tests). See baleen.job.queue.
+JOB_QUEUE_BACKEND = 'gearman'
 GEARMAN_SERVER = 'localhost'
 GEARMAN_JOB_LABEL = 'baleen_job'
+# Seconds between checks for new jobs with the 'db' queue, when not using
+# PostgreSQL notifications.
+DB_QUEUE_POLL_INTERVAL = 1
+
+# Number of jobs each "manage.py worker" process runs at once. When greater
+# than 1 the worker forks a child process for each job.
+WORKER_CONCURRENCY = 1
+
+# Number of independent steps of a job's action plan, like building separate
+# images, that are run at the same time.
+MAX_PARALLEL_ACTIONS = 4
+
+# XML-RPC interface of the supervisord running the workers, used by
+# "manage.py restart_workers"
+SUPERVISOR_URL = 'http://localhost:9001/RPC2'
+
+# Default number of seconds a job, and each of its actions, can run for before
+# being stopped. Override with "timeout:" in baleen.yml, at the top level for
+# the job or on build, test and artifact entries for actions. None for no limit.
+JOB_TIMEOUT = 2 * 60 * 60
+ACTION_TIMEOUT = 60 * 60
+
+# The job page follows the output of running actions by polling for new
+# output. Server-sent events can be used instead, but each open stream holds
+# on to a server process, so only turn LIVE_OUTPUT_EVENTS on when serving with
+# threads or an async server. Seconds between checks for new output, and how
+# long each event stream is kept open before the browser has to reconnect.
+LIVE_OUTPUT_EVENTS = False
+LIVE_OUTPUT_POLL_INTERVAL = 1
+LIVE_OUTPUT_STREAM_DURATION = 30
+
+# Seconds a job can wait in a lower priority lane before a worker will run it
+# in place of a job from a higher priority lane.
+JOB_PRIORITY_AGING = 15 * 60
+
+# Workers renew a lease on the jobs they are running. Jobs whose lease expires
+# are put back in the queue, until they've been started JOB_MAX_ATTEMPTS
+# times, after which they are failed.
+JOB_LEASE_DURATION = 60
+JOB_MAX_ATTEMPTS = 2
 
 GITHUB_HOOK_URL = SITE_URL
 
+# Docker daemons to run builds on, keyed by a name for the host. Jobs are
+# placed on the least loaded host a worker can reach. For each host:
+#  - 'url' is the DOCKER_HOST value used to reach the daemon
+#  - 'builds' is how many jobs can build on it at once (no limit if missing)
+#  - 'cpus' and 'memory' (GB) are optional, bigger hosts win ties
+# If empty, all builds use DOCKER_HOST.
+DOCKER_HOSTS = {}
+
+# How docker actions talk to the docker host: 'cli' runs the docker client,
+# 'api' uses the Docker Engine API over a kept open connection to DOCKER_HOST
+# (a unix:// socket or tcp://). docker-compose and registry logins always use
+# their command line clients.
+DOCKER_EXECUTOR = 'cli'
+
+# Pull the base images of the images a job builds while the job checks out
+# its code. Only images in DOCKER_REGISTRIES are pulled, and not the ones
+# baleen builds itself. Builds don't wait for the pulls.
+IMAGE_PREFETCH = True
+
 ACTION_MODULES = {
     'project': "baleen.action.project",
     'docker': "baleen.action.docker",
@@ -4,6 +4,8 @@ import tarfile
 import errno
 import paramiko
 import json
+import gearman
+import threading
 
 from urllib2 import Request, urlopen
 from hashlib import sha256
@@ -107,6 +109,55 @@ def get_credential_key_pair(name, project=None, user=None):
     return priv, public
 
 
+def get_docker_hosts():
+    """
+    Return the docker daemons that builds can be placed on, as a dict of
+    host name to details. Uses settings.DOCKER_HOSTS, or if that isn't set,
+    the single settings.DOCKER_HOST.
+    """
+    hosts = getattr(settings, 'DOCKER_HOSTS', None)
+    if hosts:
+        return hosts
+    return {'default': {'url': getattr(settings, 'DOCKER_HOST', '')}}
+
+
+# Idle gearman clients, shared by everything in the process that submits jobs
+# so that a burst of webhooks doesn't open a new connection for each one.
+_gearman_pool = {'pid': None, 'clients': []}
+_gearman_pool_lock = threading.Lock()
+
+
+@contextmanager
+def gearman_client():
+    """
+    Borrow a gearman client from the process wide pool, creating one if none
+    are idle. Clients connect lazily, and one that raises is dropped rather
+    than returned to the pool, so the next use reconnects.
+    """
+    with _gearman_pool_lock:
+        if _gearman_pool['pid'] != os.getpid():
+            # Connections can't be shared with a parent process
+            _gearman_pool['pid'] = os.getpid()
+            _gearman_pool['clients'] = []
+        pool = _gearman_pool['clients']
+        client = pool.pop() if pool else None
+    if client is None:
+        client = gearman.GearmanClient([settings.GEARMAN_SERVER])
+
+    yield client
+
+    with _gearman_pool_lock:
+        if _gearman_pool['pid'] == os.getpid():
+            _gearman_pool['clients'].append(client)
+
+
+def reset_gearman_clients():
+    """ Forget all pooled gearman clients """
+    with _gearman_pool_lock:
+        _gearman_pool['pid'] = None
+        _gearman_pool['clients'] = []
+
+
 def full_path_split(path):
     folders=[]
     while 1:
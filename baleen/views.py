@@ -45,9 +45,11 @@ def github(request, github_token):
     project.github_data_received = True
     project.save()
 
-    # Submit the job!
+    # Submit the job! Any older jobs for this branch that are still waiting
+    # won't be built, this job will build their commits instead.
     job = Job(project=project, github_data=github_data)
     job.save()
+    job.supersede_pending()
     job.submit()
 
     return HttpResponse('processed')
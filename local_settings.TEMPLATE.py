@@ -43,6 +43,21 @@ MAILGUN_URL = ''
 
 DOCKER_HOST = ''
 
+# Talk to the docker host through its API rather than the docker client
+#DOCKER_EXECUTOR = 'api'
+
+# Use these instead of DOCKER_HOST to spread builds over several daemons
+#DOCKER_HOSTS = {
+#    'build1': {'url': 'tcp://build1:2375', 'builds': 4, 'cpus': 8, 'memory': 16},
+#    'build2': {'url': 'tcp://build2:2375', 'builds': 2, 'cpus': 4, 'memory': 8},
+#}
+
+# How many jobs each worker process will run at once
+#WORKER_CONCURRENCY = 1
+
+# Use the database to queue jobs instead of gearmand
+#JOB_QUEUE_BACKEND = 'db'
+
 DOCKER_REGISTRIES = {
     'DOCKER REGISTRY HOST': {
         'user': '',